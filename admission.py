@@ -0,0 +1,219 @@
+# admission.py
+
+import math
+import sqlite3
+import threading
+import time
+from flask import g, jsonify, request
+import metrics
+from permissions import api_operations, current_user
+
+# Buckets untouched for this many seconds are full again and are dropped
+BUCKET_IDLE_TIMEOUT = 3600
+SWEEP_INTERVAL = 60
+
+
+# Key of a caller's session bucket: the logged-in user of a valid session, otherwise the
+# client address. Cookies that name no session do not get buckets of their own.
+def caller_key(user, remote_addr):
+
+    return f"user:{user['user_id']}" if user else f"addr:{remote_addr}"
+
+
+# Address of a client behind `hops` trusted reverse proxies: the hops-th entry from the right of
+# X-Forwarded-For, as werkzeug's ProxyFix reads it for Flask requests. The peer address is used
+# when no proxy is trusted or the header has fewer entries.
+def client_address(remote_addr, forwarded_for, hops):
+
+    if hops and forwarded_for:
+        addresses = [address.strip() for address in forwarded_for.split(",")]
+        if len(addresses) >= hops:
+            return addresses[-hops]
+    return remote_addr
+
+
+# In-process backend: token buckets in a dictionary
+class MemoryBackend:
+
+    blocking = False
+
+    def __init__(self, **options):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept_at = time.monotonic()
+
+    # Take a token from each bucket, given as (key, rate, burst): refilled at rate tokens per second
+    # up to burst tokens. Tokens are only taken when every bucket has one. Returns the seconds
+    # until each bucket will have a token, all 0 if the tokens were taken.
+    def take(self, buckets):
+        now = time.monotonic()
+        with self.lock:
+            levels = []
+            for key, rate, burst in buckets:
+                tokens, updated = self.buckets.get(key, (burst, now))
+                levels.append(min(burst, tokens + (now - updated) * rate))
+            waits = [0 if tokens >= 1 else (1 - tokens) / rate for tokens, (_, rate, _) in zip(levels, buckets)]
+            if not any(waits):
+                for tokens, (key, _, _) in zip(levels, buckets):
+                    self.buckets[key] = (tokens - 1, now)
+            if now - self.swept_at > SWEEP_INTERVAL:
+                self.swept_at = now
+                for stale in [key for key, (_, updated) in self.buckets.items() if now - updated > BUCKET_IDLE_TIMEOUT]:
+                    del self.buckets[stale]
+        return waits
+
+
+# Shared backend: an SQLite file every worker process on the host opens, so a session's
+# budget is the same whichever worker serves it
+class SQLiteBackend:
+
+    blocking = True
+
+    def __init__(self, path, **options):
+        self.path = path
+        self.local = threading.local()
+        self.swept_at = time.time()
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    # One connection per thread; SQLite connections cannot be shared between threads
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def take(self, buckets):
+        conn = self.connect()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            levels = []
+            for key, rate, burst in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                levels.append(burst if row is None else min(burst, row[0] + (now - row[1]) * rate))
+            waits = [0 if tokens >= 1 else (1 - tokens) / rate for tokens, (_, rate, _) in zip(levels, buckets)]
+            if not any(waits):
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    [(key, tokens - 1, now) for tokens, (key, _, _) in zip(levels, buckets)],
+                )
+            if now - self.swept_at > SWEEP_INTERVAL:
+                self.swept_at = now
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - BUCKET_IDLE_TIMEOUT,))
+        return waits
+
+
+# Backend names accepted by the RATE_LIMIT_BACKEND setting
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+# Admission control for expensive operations, declared per operation in swagger.yml:
+#
+#   x-rate-limit:
+#     class: heavy                   # concurrency class, limited by ADMISSION_CONCURRENCY
+#     session: {rate: 5, burst: 20}  # token bucket per logged-in user (per client address otherwise)
+#     route: {rate: 50, burst: 100}  # token bucket shared by every caller of the operation
+#
+# ADMISSION_OVERRIDES replaces these settings per operationId. A request over a bucket is answered
+# 429 and one over its class's concurrency limit 503, both with Retry-After, before the handler
+# runs or a database connection is taken.
+class AdmissionControl:
+
+    def __init__(self):
+        self.backend = None
+        self.limits = {}
+        self.operation_limits = {}
+        self.slots = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app, api):
+        config = app.config
+        if not config["RATE_LIMITS_ENABLED"]:
+            return
+        self.backend = BACKENDS[config["RATE_LIMIT_BACKEND"]](path=config["RATE_LIMIT_PATH"])
+
+        for limit_class, limit in config["ADMISSION_CONCURRENCY"].items():
+            self.slots[limit_class] = threading.BoundedSemaphore(limit)
+            self.in_flight[limit_class] = 0
+            metrics.register_gauge(f"admission_in_flight_{limit_class}", lambda limit_class=limit_class: self.in_flight[limit_class])
+
+        overrides = config["ADMISSION_OVERRIDES"]
+        for endpoint, operation in api_operations(api):
+            limits = overrides.get(operation["operationId"], operation.get("x-rate-limit"))
+            if not limits:
+                continue
+            if limits.get("class") is not None and limits["class"] not in self.slots:
+                raise ValueError(f"{operation['operationId']}: unknown concurrency class '{limits['class']}'.")
+            self.limits[endpoint] = (operation["operationId"], limits)
+            self.operation_limits[operation["operationId"]] = limits
+
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def admit(self):
+        entry = self.limits.get(request.endpoint)
+        if entry is None:
+            return None
+        operation_id, limits = entry
+
+        rejection, limit_class = self.acquire(operation_id, limits, caller_key(current_user(), request.remote_addr))
+        if rejection:
+            message, status, retry_after = rejection
+            return jsonify({"error": message}), status, {"Retry-After": retry_after}
+        g.admission_class = limit_class
+        return None
+
+    # Take the tokens and concurrency slot of one request from caller (see caller_key). Returns (rejection, limit_class):
+    # rejection is None or (message, status code, Retry-After), and limit_class is the class whose
+    # slot was taken, to be given back with release_class once the response is finished.
+    def acquire(self, operation_id, limits, caller):
+        buckets = []
+        reasons = []
+        session_limit = limits.get("session")
+        if session_limit:
+            buckets.append((f"{operation_id}|session|{caller}", session_limit["rate"], session_limit["burst"]))
+            reasons.append("session")
+        route_limit = limits.get("route")
+        if route_limit:
+            buckets.append((f"{operation_id}|route", route_limit["rate"], route_limit["burst"]))
+            reasons.append("route")
+
+        if buckets:
+            for reason, wait in zip(reasons, self.backend.take(buckets)):
+                if wait:
+                    return self.reject(operation_id, reason, 429, wait), None
+
+        limit_class = limits.get("class")
+        if limit_class is not None:
+            if not self.slots[limit_class].acquire(blocking=False):
+                return self.reject(operation_id, "concurrency", 503, 1), None
+            with self.lock:
+                self.in_flight[limit_class] += 1
+        return None, limit_class
+
+    # Give back the concurrency slot once the response, streamed or not, is finished
+    def release(self, exc=None):
+        self.release_class(g.pop("admission_class", None))
+
+    def release_class(self, limit_class):
+        if limit_class is not None:
+            with self.lock:
+                self.in_flight[limit_class] -= 1
+            self.slots[limit_class].release()
+
+    def reject(self, operation_id, reason, status, wait):
+        metrics.inc("admission_rejected", operation=operation_id, reason=reason)
+        message = "Too many requests." if status == 429 else "Server busy."
+        return f"{message} Retry later.", status, str(max(1, math.ceil(wait)))
+
+
+admission_control = AdmissionControl()
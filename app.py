@@ -1,36 +1,93 @@
 # app.py
 
-from flask import render_template
-from features import search_feature_by_name
+import os
+from flask import Response, jsonify, make_response, render_template
 import config
-from config import connex_app
 from models import Trail
+from loading import apply_profile, query_budget
+from cache import document_cache
+from sessions import session_store
+from auth_client import auth_client
+from admission import admission_control
+from bulk import row_validator
+from spatial import spatial_index
+from fulltext import search_index
+from facets import facet_index
+from autocomplete import feature_name_index
+import metrics
+import permissions
+import spec_cache
+from startup import startup_timer
+from telemetry import SERVER_ERROR_MESSAGE, request_telemetry
+import validation
+from versions import TRAILS, FEATURES, collection_versions, validators, not_modified, with_validators
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = config.connex_app
-app.add_api(config.basedir / "swagger.yml")
+startup_timer.init_app(app.app)
+# Client address and scheme as seen by the trusted reverse proxies (see PROXY_HOPS in config.py)
+proxy_hops = app.app.config["PROXY_HOPS"]
+if proxy_hops:
+    app.app.wsgi_app = ProxyFix(app.app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops)
+api = spec_cache.add_api(
+    app, config.basedir / "swagger.yml", app.app.config["SPEC_CACHE_PATH"], **validation.api_options(app.app.config)
+)
+request_telemetry.init_app(app.app, api)
+admission_control.init_app(app.app, api)
+row_validator.init_app(api)
+permissions.init_app(app.app, api)
+session_store.init_app(app.app)
+auth_client.init_app(app.app)
+document_cache.init_app(app.app)
+spatial_index.init_app(app.app)
+search_index.init_app(app.app)
+facet_index.init_app(app.app)
+feature_name_index.init_app(app.app)
 
 @app.route("/")
 def home():
     try:
-        # Fetch all trails from the database
-        trails = Trail.query.all()
-        trails_with_features = []
-        for trail in trails:
-            trail_data = {
-                "trail_name": trail.trail_name,
-                "trail_summary": trail.trail_summary,
-                "location": trail.location,
-                "difficulty": trail.difficulty,
-                "route_type": trail.route_type,
-                "features": [tf.feature.feature_name for tf in trail.features]
-            }
-            trails_with_features.append(trail_data)
-
-        return render_template("home.html", trails=trails_with_features)
+        # Answer conditional requests from the trails and features change counters, before anything is read
+        etag, last_modified = validators(collection_versions(TRAILS, FEATURES), "home")
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        with query_budget("trail_features"):
+            # Fetch all trails from the database
+            trails = apply_profile(Trail.query, "trail_features").all()
+            trails_with_features = []
+            for trail in trails:
+                trail_data = {
+                    "trail_name": trail.trail_name,
+                    "trail_summary": trail.trail_summary,
+                    "location": trail.location,
+                    "difficulty": trail.difficulty,
+                    "route_type": trail.route_type,
+                    "features": [tf.feature.feature_name for tf in trail.features]
+                }
+                trails_with_features.append(trail_data)
+
+        response = make_response(render_template("home.html", trails=trails_with_features))
+        return with_validators(response, etag, last_modified)
     except Exception as e:
-        return f"An error occurred: {str(e)}", 500
+        request_telemetry.record_error(e)
+        return SERVER_ERROR_MESSAGE, 500
+
+# Runtime counters and gauges (cache hits and misses, evictions, ...)
+@app.route("/stats")
+def stats():
+    return jsonify(metrics.snapshot())
+
+# The same metrics, with per-operation latency and SQL histograms, for Prometheus to scrape
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+startup_timer.mark_ready()
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    app.run(host="0.0.0.0", port=8000, debug=os.environ.get("FLASK_DEBUG", "0") == "1")
 
 
@@ -0,0 +1,308 @@
+# asgi.py
+#
+# ASGI entry point. The read operations of async_reads.py run as coroutines on an async engine,
+# so a slow database round trip does not pin a thread; every other request (writes, streaming,
+# facets, the UI, ...) is handed to the WSGI app on a thread pool and behaves as before.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000 --workers 4
+
+import asyncio
+import inspect
+import io
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+from connexion.decorators.validation import coerce_type
+from werkzeug.http import parse_date, parse_etags
+import metrics
+from app import app, api
+from async_reads import ASYNC_OPERATIONS, async_read_engine, error_reply
+from admission import admission_control, caller_key, client_address
+from background import run_blocking
+from engines import STICKY_COOKIE
+from permissions import OPERATION_ROLES, role_error
+from sessions import session_store
+from startup import startup_timer
+from telemetry import request_telemetry
+from validation import CompiledParameterValidator
+
+flask_app = app.app
+
+# End of a streamed WSGI body
+_DONE = object()
+
+# Seconds between checks for a gone client while a worker thread waits on a full queue
+PUT_CHECK_INTERVAL = 1
+
+
+# Raised in a worker thread whose client has disconnected
+class ClientGone(Exception):
+    pass
+
+
+# Runs the WSGI app for ASGI requests, one worker thread per request. Response bodies are passed
+# on chunk by chunk, so streamed responses stay streamed. When the client goes away mid-body the
+# worker thread stops at its next chunk and closes the response, which releases its database
+# connection and admission slot.
+class WSGIBridge:
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=16)
+        started = {}
+        cancelled = threading.Event()
+
+        # Hand an item to the event loop, waiting while the queue is full unless the client is gone
+        def put(item):
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    return future.result(timeout=PUT_CHECK_INTERVAL)
+                except FutureTimeoutError:
+                    if cancelled.is_set():
+                        future.cancel()
+                        raise ClientGone() from None
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+        def run():
+            try:
+                result = self.wsgi_app(wsgi_environ(scope, bytes(body)), start_response)
+                try:
+                    for chunk in result:
+                        if cancelled.is_set():
+                            return
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                put(_DONE)
+            except ClientGone:
+                pass
+            except BaseException as err:
+                if not cancelled.is_set():
+                    put(err)
+
+        future = loop.run_in_executor(self.executor, run)
+        try:
+            item = await queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+            while item is not _DONE:
+                await send({"type": "http.response.body", "body": item, "more_body": True})
+                item = await queue.get()
+                if isinstance(item, BaseException):
+                    raise item
+            await send({"type": "http.response.body", "body": b""})
+        except BaseException:
+            # The client went away (or the task was cancelled): stop the worker thread and unblock
+            # a put it is waiting on
+            cancelled.set()
+            while not queue.empty():
+                queue.get_nowait()
+            raise
+        await future
+
+
+# WSGI environ for an ASGI HTTP scope (PEP 3333)
+def wsgi_environ(scope, body):
+
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            separator = "; " if name == "COOKIE" else ", "
+            environ[key] = f"{environ[key]}{separator}{value}" if key in environ else value
+    return environ
+
+
+# The async read operations, matched by method and path. Routes are compiled from the resolved
+# spec, and their parameters checked by the same compiled validator the WSGI app uses.
+class AsyncRoute:
+
+    def __init__(self, base_path, path, operation):
+        pattern = re.sub(r"\{(\w+)\}", r"(?P<\1>[^/]+)", path)
+        self.regex = re.compile(f"^{re.escape(base_path)}{pattern}/?$")
+        self.operation_id = operation["operationId"]
+        self.coroutine = ASYNC_OPERATIONS[self.operation_id]
+        # Parameters only the sync handler reads (stream, ...) are checked by handle_async
+        accepted = inspect.signature(self.coroutine).parameters
+        self.parameters = [parameter for parameter in operation.get("parameters", []) if parameter["name"] in accepted]
+        self.validator = CompiledParameterValidator(self.parameters, api)
+
+    # Keyword arguments for the coroutine, or None to leave the request to the WSGI app, which
+    # answers invalid parameters with its usual 400
+    def arguments(self, path_values, query):
+        kwargs = {}
+        for parameter in self.parameters:
+            location, name = parameter["in"], parameter["name"]
+            raw = path_values.get(name) if location == "path" else query.get(name)
+            if self.validator.validate_parameter(location, raw, parameter):
+                return None
+            if raw is not None:
+                kwargs[name] = coerce_type(parameter, raw, location, name)
+        return kwargs
+
+
+def compile_routes():
+
+    routes = []
+    for path, path_item in api.specification.raw["paths"].items():
+        operation = path_item.get("get")
+        if operation and operation["operationId"] in ASYNC_OPERATIONS:
+            routes.append(AsyncRoute(api.base_path, path, operation))
+    # Literal paths before templated ones (/trails/search before /trails/{trail_id})
+    routes.sort(key=lambda route: route.regex.pattern.count("(?P<"))
+    return routes
+
+
+class ASGIApp:
+
+    def __init__(self):
+        self.routes = compile_routes()
+        self.wsgi = WSGIBridge(flask_app, flask_app.config["ASGI_WSGI_THREADS"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        startup_timer.request_started()
+        handled = await self.handle_async(scope, send)
+        if not handled:
+            metrics.inc("asgi_requests", path="wsgi")
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await async_read_engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # Serve a plain JSON read on the async path. Returns False when the request is left to the WSGI app.
+    async def handle_async(self, scope, send):
+        if scope["method"] != "GET":
+            return False
+        for route in self.routes:
+            match = route.regex.match(scope["path"])
+            if match:
+                break
+        else:
+            return False
+
+        headers = {}
+        for name, value in scope["headers"]:
+            headers.setdefault(name.decode("latin-1"), value.decode("latin-1"))
+        query = dict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+        cookies = {name: morsel.value for name, morsel in SimpleCookie(headers.get("cookie", "")).items()}
+
+        # Streams, NDJSON, facets and clients reading their own writes take the sync path
+        if "ndjson" in headers.get("accept", "") or query.get("stream", "0") != "0":
+            return False
+        if {"features", "exclude_features", "facets"} & query.keys() or STICKY_COOKIE in cookies:
+            return False
+        kwargs = route.arguments(match.groupdict(), query)
+        if kwargs is None:
+            return False
+
+        metrics.inc("asgi_requests", path="async")
+        state = request_telemetry.start(route.operation_id)
+        status = 500
+        try:
+            client = client_address(
+                (scope.get("client") or ("", 0))[0], headers.get("x-forwarded-for"), flask_app.config["PROXY_HOPS"]
+            )
+            response = await self.serve(route, kwargs, headers, cookies, client)
+            status = response[0]
+            await respond(send, response)
+        finally:
+            request_telemetry.finish(state, status)
+        return True
+
+    # The response of an async read: permission and admission checks, then the coroutine. Session
+    # and bucket lookups on a shared SQLite backend run on the loop's executor, not on the loop.
+    async def serve(self, route, kwargs, headers, cookies, client):
+        session_id = cookies.get("session_id")
+        user = await run_blocking(session_store.backend.blocking, session_store.get, session_id) if session_id else None
+        roles = OPERATION_ROLES.get(route.operation_id)
+        if roles is not None:
+            error = role_error(roles, user)
+            if error:
+                return error_reply(*error)
+
+        limits = admission_control.operation_limits.get(route.operation_id)
+        limit_class = None
+        if limits:
+            caller = caller_key(user, client)
+            rejection, limit_class = await run_blocking(
+                admission_control.backend.blocking, admission_control.acquire, route.operation_id, limits, caller
+            )
+            if rejection:
+                message, status, retry_after = rejection
+                status, response_headers, body = error_reply(message, status)
+                return status, response_headers + [("retry-after", retry_after)], body
+
+        try:
+            conditional = (parse_etags(headers.get("if-none-match")), parse_date(headers.get("if-modified-since")))
+            return await route.coroutine(conditional, **kwargs)
+        finally:
+            admission_control.release_class(limit_class)
+
+
+async def respond(send, response):
+
+    status, headers, body = response
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+application = ASGIApp()
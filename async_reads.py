@@ -0,0 +1,252 @@
+# async_reads.py
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.http import http_date, quote_etag
+import engines
+from config import app
+from models import Trail
+from cache import document_cache, cache_key, versioned_key, TRAIL_GROUP, TRAIL_LISTING_GROUP, FEATURE_SEARCH_GROUP
+from serializers import FieldsetError, collect_feature_names, feature_names_statements, fieldset_serializer, search_serializer
+from trails import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, listing_statement
+from features import (
+    DEFAULT_PAGE_SIZE as DEFAULT_FEATURE_PAGE_SIZE, MAX_PAGE_SIZE as MAX_FEATURE_PAGE_SIZE,
+    features_page, features_page_statement, feature_by_name_statement, linked_trails_statement,
+)
+from versions import (
+    TRAILS, FEATURES, collection_versions_statement, versions_from_rows, trail_version_statement, validators, is_fresh,
+)
+from telemetry import SERVER_ERROR_MESSAGE, request_telemetry
+
+# Async drivers standing in for the sync drivers of SQLALCHEMY_DATABASE_URI. aioodbc runs pyodbc
+# on a thread pool and takes the same URL query (driver=..., etc.) as mssql+pyodbc.
+ASYNC_DRIVERS = {
+    "mssql": "mssql+aioodbc",
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+# Async engine for the read operations of the ASGI mode (see asgi.py). It reads
+# ASYNC_DATABASE_URI, or SQLALCHEMY_DATABASE_URI with its driver swapped for an async one, with
+# the pool settings of the sync engine. It is created on first use, inside the event loop.
+class AsyncReadEngine:
+
+    def __init__(self):
+        self.engine = None
+
+    def async_uri(self, config):
+        if config["ASYNC_DATABASE_URI"]:
+            return config["ASYNC_DATABASE_URI"]
+        url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+        driver = ASYNC_DRIVERS.get(url.get_backend_name())
+        if driver is None:
+            raise ValueError(f"No async driver for {url.get_backend_name()}; set ASYNC_DATABASE_URI.")
+        return url.set(drivername=driver).render_as_string(hide_password=False)
+
+    def get(self):
+        if self.engine is None:
+            uri = self.async_uri(app.config)
+            options = engines.engine_options(uri, app.config)
+            # Same pool settings, in a pool that hands connections to coroutines
+            if options.get("poolclass") is engines.TimedQueuePool:
+                options["poolclass"] = AsyncAdaptedQueuePool
+            self.engine = create_async_engine(uri, **options)
+            engines.configure_connections(self.engine.sync_engine, app.config)
+            engines.register_pool_gauges(self.engine.sync_engine, "async")
+        return self.engine
+
+    async def dispose(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+
+async_read_engine = AsyncReadEngine()
+
+
+# A response of the async read path: status code, headers and encoded body
+def reply(body, status=200, etag=None, last_modified=None):
+
+    headers = [("content-type", "application/json"), ("content-length", str(len(body)))]
+    if etag is not None:
+        headers.append(("etag", quote_etag(etag)))
+    if last_modified is not None:
+        headers.append(("last-modified", http_date(last_modified)))
+    return status, headers, body
+
+
+# Same body as jsonify
+def json_reply(obj, status=200, etag=None, last_modified=None):
+
+    return reply(app.json.dumps_bytes(obj) + b"\n", status, etag, last_modified)
+
+
+def error_reply(message, status):
+
+    return json_reply({"error": message}, status)
+
+
+# Reply for an exception a coroutine caught, counted and logged like telemetry.server_error
+def server_error_reply(error):
+
+    request_telemetry.record_error(error)
+    return error_reply(SERVER_ERROR_MESSAGE, 500)
+
+
+def not_modified_reply(etag, last_modified):
+
+    status, headers, _ = reply(b"", 304, etag, last_modified)
+    return status, [header for header in headers if header[0] != "content-type"], b""
+
+
+# Encode rows with a serializer, loading the features of all of them with one query per chunk
+async def documents(conn, serializer, rows):
+
+    features = {}
+    if serializer.features:
+        for statement in feature_names_statements([row[0] for row in rows]):
+            collect_feature_names(features, await conn.execute(statement))
+    return [serializer.encode(row, features) for row in rows]
+
+
+async def collection_versions(conn, *names):
+
+    return versions_from_rows((await conn.execute(collection_versions_statement(names))).all(), names)
+
+
+# The coroutines below mirror the sync handlers of trails.py and features.py for the plain JSON
+# case: same statements, cache keys, ETags and bodies. Streaming, NDJSON and facet requests are
+# left to the sync handlers (see asgi.py). conditional holds the parsed If-None-Match and
+# If-Modified-Since headers.
+
+async def read_all(conditional, limit=DEFAULT_PAGE_SIZE, after=None, difficulty=None, location=None, route_type=None,
+                   min_length=None, max_length=None, min_elevation=None, max_elevation=None, fields=None, include=None):
+
+    try:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        try:
+            serializer = fieldset_serializer(fields, include)
+        except FieldsetError as err:
+            return error_reply(str(err), 400)
+
+        filters = dict(
+            after=after, difficulty=difficulty, location=location, route_type=route_type,
+            min_length=min_length, max_length=max_length,
+            min_elevation=min_elevation, max_elevation=max_elevation
+        )
+        statement = listing_statement(serializer, **filters)
+        key = cache_key(TRAIL_LISTING_GROUP, limit=limit, fieldset=serializer.fieldset, **filters)
+
+        async with async_read_engine.get().connect() as conn:
+            etag, last_modified = validators(await collection_versions(conn, TRAILS), f"{key}|False|False")
+            if is_fresh(etag, last_modified, *conditional):
+                return not_modified_reply(etag, last_modified)
+
+            async def build_page():
+                rows = (await conn.execute(statement.limit(limit + 1))).all()
+
+                next_cursor = None
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    next_cursor = rows[-1].trail_id
+
+                trails = await documents(conn, serializer, rows)
+                return app.json.dumps_bytes({"trails": trails, "next_cursor": next_cursor})
+
+            body = await document_cache.get_or_build_async(versioned_key(key, etag), build_page)
+        return reply(body, etag=etag, last_modified=last_modified)
+    except Exception as e:
+        return server_error_reply(e)
+
+
+async def read_by_id(conditional, trail_id, fields=None, include=None):
+
+    try:
+        async with async_read_engine.get().connect() as conn:
+            row = (await conn.execute(trail_version_statement(trail_id))).first()
+            if row is None:
+                return error_reply(f"Trail with ID {trail_id} not found.", 404)
+
+            try:
+                serializer = fieldset_serializer(fields, include)
+            except FieldsetError as err:
+                return error_reply(str(err), 400)
+
+            key = cache_key(f"{TRAIL_GROUP}{trail_id}", fieldset=serializer.fieldset)
+            etag, last_modified = validators([(row.version, row.updated_at)], key)
+            if is_fresh(etag, last_modified, *conditional):
+                return not_modified_reply(etag, last_modified)
+
+            async def build_trail():
+                rows = (await conn.execute(serializer.statement().where(Trail.trail_id == trail_id))).all()
+                trails = await documents(conn, serializer, rows)
+                return app.json.dumps_bytes(trails[0]) if trails else None
+
+            body = await document_cache.get_or_build_async(versioned_key(key, etag), build_trail)
+        if body is None:
+            return error_reply(f"Trail with ID {trail_id} not found.", 404)
+        return reply(body, etag=etag, last_modified=last_modified)
+    except Exception as e:
+        return server_error_reply(e)
+
+
+async def search_feature_by_name(conditional, name, fields=None, include=None):
+
+    try:
+        if not name:
+            return error_reply("Feature name is required.", 400)
+
+        try:
+            serializer = search_serializer(fields, include)
+        except FieldsetError as err:
+            return error_reply(str(err), 400)
+
+        key = cache_key(FEATURE_SEARCH_GROUP, name=name, fieldset=serializer.fieldset)
+        async with async_read_engine.get().connect() as conn:
+            etag, last_modified = validators(await collection_versions(conn, TRAILS, FEATURES), f"{key}|False|False")
+            if is_fresh(etag, last_modified, *conditional):
+                return not_modified_reply(etag, last_modified)
+
+            async def build_result():
+                feature = (await conn.execute(feature_by_name_statement(name))).first()
+                if feature is None:
+                    return None
+                rows = (await conn.execute(linked_trails_statement(serializer, feature.feature_id))).all()
+                trails = await documents(conn, serializer, rows)
+                return app.json.dumps_bytes({"feature_name": feature.feature_name, "trails": trails})
+
+            body = await document_cache.get_or_build_async(versioned_key(key, etag), build_result)
+        if body is None:
+            return error_reply(f"Feature with name '{name}' not found.", 404)
+        return reply(body, etag=etag, last_modified=last_modified)
+    except Exception as e:
+        return server_error_reply(e)
+
+
+async def read_all_features(conditional, limit=DEFAULT_FEATURE_PAGE_SIZE, after=None, prefix=None):
+
+    try:
+        limit = max(1, min(limit, MAX_FEATURE_PAGE_SIZE))
+
+        key = cache_key("features", limit=limit, after=after, prefix=prefix)
+        async with async_read_engine.get().connect() as conn:
+            etag, last_modified = validators(await collection_versions(conn, FEATURES), key)
+            if is_fresh(etag, last_modified, *conditional):
+                return not_modified_reply(etag, last_modified)
+
+            rows = (await conn.execute(features_page_statement(limit, after, prefix))).all()
+        return json_reply(features_page(rows, limit), etag=etag, last_modified=last_modified)
+    except Exception as e:
+        return server_error_reply(e)
+
+
+# Coroutine for each operationId served by the async read path
+ASYNC_OPERATIONS = {
+    "trails.read_all": read_all,
+    "trails.read_by_id": read_by_id,
+    "features.search_feature_by_name": search_feature_by_name,
+    "features.read_all_features": read_all_features,
+}
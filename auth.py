@@ -1,13 +1,8 @@
 from flask import request, jsonify, make_response
-import requests
 from models import User
-from config import app, db
-import uuid
-
-# Dictionary to track logged-in users
-logged_in_users = {}
-
-AUTH_URL = "https://web.socem.plymouth.ac.uk/COMP2001/auth/api/users"
+from config import app
+from sessions import session_store
+from auth_client import AuthUnavailable, auth_client
 
 
 
@@ -16,31 +11,32 @@ AUTH_URL = "https://web.socem.plymouth.ac.uk/COMP2001/auth/api/users"
 def login():
 
     credentials = request.json
-    response = requests.post(AUTH_URL, json=credentials)
+    email = credentials.get("email")
+
+    # Verify the credentials with the upstream service, failing fast while it is unavailable
+    try:
+        verified = auth_client.verify(email, credentials.get("password"))
+    except AuthUnavailable as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
 
-    if response.status_code == 200:
-        user_data = response.json()
-        email = credentials["email"]
+    if verified:
 
         # Query the local database for user details
         user = User.query.filter_by(email=email).first()
         if not user:
             return jsonify({"error": "User not found."}), 404
 
-        # Generate a unique session ID
-        session_id = str(uuid.uuid4())
-
-        # Store the session
-        logged_in_users[email] = {
+        # Store the session under a new unique session ID
+        session_data = {
             "user_id": user.user_id,
             "email": user.email,
             "role": user.role,
-            "session_id": session_id
         }
+        session_id = session_store.create(session_data)
 
         # Set the session ID as a cookie in the response
         resp = make_response(
-            jsonify({"message": "Login successful", "user": logged_in_users[email]})
+            jsonify({"message": "Login successful", "user": dict(session_data, session_id=session_id)})
         )
         resp.set_cookie("session_id", session_id, httponly=True, secure=True)
 
@@ -57,18 +53,11 @@ def logout():
     if not session_id:
         return jsonify({"error": "Missing session ID."}), 400
 
-    # Find the user by session ID
-    email = None
-    for logged_in_email, user_data in logged_in_users.items():
-        if user_data["session_id"] == session_id:
-            email = logged_in_email
-            break
-
-    if not email:
+    # Remove the session
+    user_data = session_store.delete(session_id)
+    if not user_data:
         return jsonify({"error": "No active session found."}), 404
-
-    # Remove the user from logged_in_users
-    del logged_in_users[email]
+    email = user_data["email"]
 
     # Clear the session ID cookie
     resp = make_response(jsonify({"message": f"User {email} logged out successfully."}))
@@ -81,8 +70,8 @@ def logout():
 def auth_status():
 
     email = request.args.get("email")
-    if email in logged_in_users:
-        user_details = logged_in_users[email]
+    user_details = session_store.get_by_email(email)
+    if user_details:
         return jsonify({
             "status": "authenticated",
             "user": user_details
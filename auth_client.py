@@ -0,0 +1,206 @@
+# auth_client.py
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+# Circuit breaker states, published as the auth_breaker_state gauge
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+class AuthUnavailable(Exception):
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Fails fast while the upstream is down: after `threshold` consecutive failures the breaker opens and
+# calls are refused for `reset_timeout` seconds. Then one trial call is let through (half-open);
+# its success closes the breaker again and its failure re-opens it.
+class CircuitBreaker:
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return CLOSED
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return OPEN
+
+    # Raise AuthUnavailable unless a call may go ahead. Returns whether the call is the half-open trial.
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_timeout or self.trial_running:
+                metrics.inc("auth_breaker_rejections")
+                raise AuthUnavailable(
+                    "Authentication service unavailable.", retry_after=max(1, int(self.reset_timeout - waited))
+                )
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial_running:
+                    metrics.inc("auth_breaker_opened")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    # Called once a call has finished, however it ended: a trial that neither succeeded nor
+    # failed (an unexpected exception) must not leave the breaker refusing every call
+    def after_call(self, trial):
+        if trial:
+            with self.lock:
+                self.trial_running = False
+
+
+# Short-lived record of credentials the upstream has verified. Keys are salted hashes, so
+# neither passwords nor reusable hashes of them are kept; the salt is random per process.
+class CredentialCache:
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.salt = os.urandom(16)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, email, password):
+        return hmac.new(self.salt, f"{email}\0{password}".encode(), hashlib.sha256).digest()
+
+    def verified(self, email, password):
+        if self.ttl <= 0:
+            return False
+        key = self.key(email, password)
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.entries[key]
+                return False
+            return True
+
+    def add(self, email, password):
+        if self.ttl <= 0:
+            return
+        key = self.key(email, password)
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# Client for the upstream authentication service. One pooled requests.Session keeps
+# connections (and their TLS sessions) alive between logins; every call has connect and read
+# timeouts, idempotent failures are retried with backoff, and a circuit breaker fails fast
+# while the service is down.
+class AuthClient:
+
+    def __init__(self):
+        self.url = None
+        self.session = None
+        self.timeout = None
+        self.breaker = CircuitBreaker()
+        self.cache = CredentialCache()
+
+    def init_app(self, app):
+        config = app.config
+        self.url = config["AUTH_URL"]
+        self.timeout = (config["AUTH_CONNECT_TIMEOUT"], config["AUTH_READ_TIMEOUT"])
+        self.breaker = CircuitBreaker(config["AUTH_BREAKER_THRESHOLD"], config["AUTH_BREAKER_RESET"])
+        self.cache = CredentialCache(config["AUTH_CACHE_TTL"])
+
+        retry = Retry(
+            total=config["AUTH_RETRIES"],
+            connect=config["AUTH_RETRIES"],
+            read=0,
+            status=config["AUTH_RETRIES"],
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            backoff_factor=0.1,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config["AUTH_POOL_SIZE"], max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        metrics.register_gauge("auth_breaker_state", self.breaker.state)
+
+    # True if the upstream accepts the credentials, False if it rejects them.
+    # Raises AuthUnavailable when the service cannot be reached or the breaker is open.
+    def verify(self, email, password):
+        if self.cache.verified(email, password):
+            metrics.inc("auth_credential_cache_hits")
+            return True
+        metrics.inc("auth_credential_cache_misses")
+
+        trial = self.breaker.before_call()
+        try:
+            started = time.perf_counter()
+            try:
+                response = self.session.post(self.url, json={"email": email, "password": password}, timeout=self.timeout)
+            except requests.RequestException as err:
+                self.breaker.record_failure()
+                self.observe("error", started)
+                raise AuthUnavailable(f"Authentication service unavailable: {err.__class__.__name__}.") from err
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+                self.observe("error", started)
+                raise AuthUnavailable(f"Authentication service returned {response.status_code}.")
+
+            self.breaker.record_success()
+            verified = response.status_code == 200 and not self.rejected(response)
+            self.observe("verified" if verified else "rejected", started)
+            if verified:
+                self.cache.add(email, password)
+            return verified
+        finally:
+            self.breaker.after_call(trial)
+
+    # The service answers 200 with ["Verified", "False"] for a wrong password
+    @staticmethod
+    def rejected(response):
+        try:
+            body = response.json()
+        except ValueError:
+            return False
+        return isinstance(body, list) and len(body) > 1 and str(body[1]).lower() == "false"
+
+    def observe(self, outcome, started):
+        metrics.inc("auth_upstream_requests", outcome=outcome)
+        metrics.inc("auth_upstream_seconds", time.perf_counter() - started)
+
+
+auth_client = AuthClient()
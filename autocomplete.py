@@ -0,0 +1,138 @@
+# autocomplete.py
+
+import threading
+import time
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from sqlalchemy import func, select
+from background import start_thread
+from config import db
+from indexes import REFRESH_INTERVAL
+from models import Feature, TrailFeature
+from serializers import IN_CHUNK_SIZE
+from signals import features_changed
+from versions import FEATURES, collection_versions
+
+# Prefixes this short match many names; their results are kept until the next change
+MEMO_PREFIX_LENGTH = 2
+
+
+# In-memory prefix index over feature names, ranked by how many trails use each feature.
+# Names are kept in a sorted list of (lowercase name, feature_id) so the names sharing a prefix
+# are one contiguous slice found with bisect. Requests never read the database: features changed
+# in this process arrive through the features_changed signal, and a background thread rebuilds
+# the index when another worker moves the features change counter.
+class FeatureNameIndex:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.built = threading.Event()
+        self.keys = []
+        self.features = {}
+        self.memo = {}
+        self.synced_version = None
+
+    def init_app(self, app):
+        features_changed.connect(self.on_features_changed, weak=False)
+        if app.config.get("BUILD_INDEXES_AT_STARTUP", True):
+            start_thread(app, self.refresh_loop, (app,), "feature name index")
+
+    # Statement reading features with their usage counts
+    def statement(self):
+        return (
+            select(Feature.feature_id, Feature.feature_name, func.count(TrailFeature.trail_id).label("usage_count"))
+            .outerjoin(TrailFeature, TrailFeature.feature_id == Feature.feature_id)
+            .group_by(Feature.feature_id, Feature.feature_name)
+        )
+
+    def build(self):
+        version = collection_versions(FEATURES)[0][0]
+        rows = db.session.execute(self.statement()).all()
+        features = {row.feature_id: (row.feature_name, row.usage_count) for row in rows}
+        keys = sorted((name.lower(), feature_id) for feature_id, (name, _) in features.items())
+        with self.lock:
+            self.features = features
+            self.keys = keys
+            self.memo = {}
+            self.synced_version = version
+        self.built.set()
+
+    # Build the index unless it is already built; concurrent callers wait for a single build
+    def ensure_built(self):
+        with self.build_lock:
+            if not self.built.is_set():
+                self.build()
+
+    # Build at startup, then rebuild whenever another worker changes the features
+    def refresh_loop(self, app):
+        while True:
+            with app.app_context():
+                try:
+                    if not self.built.is_set():
+                        self.ensure_built()
+                    elif collection_versions(FEATURES)[0][0] != self.synced_version:
+                        with self.build_lock:
+                            self.build()
+                except Exception:
+                    app.logger.exception("Refreshing the feature name index failed")
+                finally:
+                    db.session.remove()
+            time.sleep(REFRESH_INTERVAL)
+
+    # Re-read the given features and their usage counts; features that no longer exist are removed
+    def update(self, feature_ids):
+        feature_ids = list(feature_ids)
+        rows = []
+        for start in range(0, len(feature_ids), IN_CHUNK_SIZE):
+            chunk = feature_ids[start:start + IN_CHUNK_SIZE]
+            rows.extend(db.session.execute(self.statement().where(Feature.feature_id.in_(chunk))).all())
+
+        with self.lock:
+            for feature_id in feature_ids:
+                entry = self.features.pop(feature_id, None)
+                if entry is not None:
+                    index = bisect_left(self.keys, (entry[0].lower(), feature_id))
+                    del self.keys[index]
+            for row in rows:
+                self.features[row.feature_id] = (row.feature_name, row.usage_count)
+                insort(self.keys, (row.feature_name.lower(), row.feature_id))
+            self.memo = {}
+
+    def on_features_changed(self, sender, feature_ids):
+        if self.built.is_set():
+            self.update(feature_ids)
+
+    # Up to limit (feature_name, usage_count) pairs whose name starts with prefix (case-insensitive),
+    # most used first, then alphabetically
+    def complete(self, prefix, limit):
+        prefix = prefix.lower()
+        with self.lock:
+            memo_key = (prefix, limit)
+            if len(prefix) <= MEMO_PREFIX_LENGTH and memo_key in self.memo:
+                return self.memo[memo_key]
+
+            matches = []
+            features = self.features
+            for index in range(bisect_left(self.keys, (prefix,)), len(self.keys)):
+                key, feature_id = self.keys[index]
+                if not key.startswith(prefix):
+                    break
+                name, usage_count = features[feature_id]
+                matches.append((-usage_count, key, name))
+
+            result = [(name, -negative_count) for negative_count, _, name in nsmallest(limit, matches)]
+            if len(prefix) <= MEMO_PREFIX_LENGTH:
+                self.memo[memo_key] = result
+            return result
+
+
+feature_name_index = FeatureNameIndex()
+
+
+# Feature name suggestions for a prefix, waiting for the startup build if it has not finished
+def autocomplete(prefix, limit):
+
+    if not feature_name_index.built.is_set():
+        feature_name_index.ensure_built()
+    return feature_name_index.complete(prefix, limit)
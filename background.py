@@ -0,0 +1,35 @@
+# background.py
+
+import asyncio
+import threading
+
+# Threads waiting to be started in each worker process (see gunicorn.conf.py)
+_deferred = []
+
+
+# Start a daemon thread for the app. When DEFER_BACKGROUND_THREADS is set, the app is being
+# loaded in a preforking server's master process: threads do not survive fork, and a lock one
+# of them held at fork time would stay held in the worker, so they are started by each worker
+# after the fork instead.
+def start_thread(app, target, args=(), name=None):
+
+    if app.config["DEFER_BACKGROUND_THREADS"]:
+        _deferred.append((target, args, name))
+    else:
+        threading.Thread(target=target, args=args, name=name, daemon=True).start()
+
+
+# Start the deferred threads; called in each worker after it is forked
+def start_deferred_threads():
+
+    for target, args, name in _deferred:
+        threading.Thread(target=target, args=args, name=name, daemon=True).start()
+
+
+# Call function(*args) from a coroutine. Calls that block (SQLite files, lock waits) run on the
+# event loop's default executor so other requests keep being served meanwhile; the rest run inline.
+async def run_blocking(blocking, function, *args):
+
+    if not blocking:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
@@ -0,0 +1,168 @@
+# bench_async.py
+#
+# Load test of the ASGI read path (asgi.py) against the sync Flask handlers, on a temporary SQLite
+# database with a simulated network round trip added to every statement. The sync handlers get a
+# fixed pool of threads, as in a gunicorn worker; the async path runs on one event loop. Both are
+# called in process, so only the handlers and the database access are measured.
+#
+# Both paths share one process, and a request costs about 3-4 ms of CPU either way (building and
+# compiling statements, encoding rows), so neither passes roughly 250-300 req/s (run with a
+# 0 ms round trip to see the ceiling). At the default 20 ms per statement, 16 threads already
+# come close to it: the async path measured 1.2-1.4x at 32 and 128 concurrent requests, and
+# 0.9-1.0x at 8 or fewer. With 100 ms per statement the threads are the limit, not the CPU,
+# and the async path measured 1.8x at 32 and 4x at 128. Results vary by a few tens of req/s
+# between runs.
+#
+#   python bench_async.py [round_trip_ms] [threads]
+
+import os
+import sys
+import tempfile
+
+# Settings read by config.py: a throwaway database, no cache and no rate limits, and a pool large
+# enough that connections are not what limits either side
+os.environ["DATABASE_URI"] = f"sqlite:///{tempfile.mkdtemp()}/bench_async.sqlite"
+os.environ.setdefault("TRAIL_CACHE_BACKEND", "none")
+os.environ.setdefault("RATE_LIMITS_ENABLED", "0")
+os.environ.setdefault("DB_POOL_SIZE", "150")
+
+import asyncio
+import contextlib
+import io
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event, insert
+with contextlib.redirect_stdout(io.StringIO()):
+    import databasebuild
+from asgi import application, flask_app
+from async_reads import async_read_engine
+from config import db
+from models import Trail, TrailFeature
+from sessions import session_store
+
+TRAIL_COUNT = 2000
+REQUESTS = 400
+CONCURRENCY = [1, 8, 32, 128]
+PATHS = [
+    ("/api/trails", "limit=20"),
+    ("/api/trails/42", ""),
+    ("/api/features", "limit=20"),
+]
+ROUND_TRIP = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.02
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+SESSION_ID = "bench-async"
+
+
+# A cursor that waits ROUND_TRIP before each statement, as if the database were across the
+# network. The wait happens in the thread running the driver: the request's own thread on the
+# sync side, aiosqlite's connection thread on the async side.
+class SlowCursor(sqlite3.Cursor):
+
+    def execute(self, *args):
+        time.sleep(ROUND_TRIP)
+        return super().execute(*args)
+
+
+class SlowConnection(sqlite3.Connection):
+
+    def cursor(self, factory=SlowCursor):
+        return super().cursor(factory)
+
+
+def slow_connections(engine):
+
+    @event.listens_for(engine, "do_connect")
+    def use_slow_connection(dialect, conn_rec, cargs, cparams):
+        cparams["factory"] = SlowConnection
+
+
+def add_trails(count):
+
+    with flask_app.app_context():
+        db.session.execute(insert(Trail), [
+            {
+                "trail_name": f"Bench Trail {i}", "difficulty": ("Easy", "Medium", "Hard")[i % 3],
+                "location": "Devon, UK", "length": i % 20 + 1.5, "elevation_gain": i % 700, "route_type": "Loop",
+                "user_id": 1 + i % 3, "pt1_lat": 50.1, "pt1_long": -4.1, "pt1_desc": "Start",
+            }
+            for i in range(count)
+        ])
+        db.session.execute(insert(TrailFeature), [
+            {"trail_id": trail_id, "feature_id": feature_id}
+            for trail_id in range(3, count + 3) for feature_id in range(1, 1 + trail_id % 3)
+        ])
+        db.session.commit()
+
+
+def run_sync(concurrency):
+
+    client = flask_app.test_client()
+    client.set_cookie("localhost", "session_id", SESSION_ID)
+
+    def get(i):
+        path, query = PATHS[i % len(PATHS)]
+        assert client.get(f"{path}?{query}").status_code == 200
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, THREADS)) as executor:
+        list(executor.map(get, range(REQUESTS)))
+
+
+async def get_async(i):
+
+    path, query = PATHS[i % len(PATHS)]
+    scope = {
+        "type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+        "headers": [(b"cookie", f"session_id={SESSION_ID}".encode())], "client": ("127.0.0.1", 0), "server": ("localhost", 8000),
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+    assert sent[0]["status"] == 200
+
+
+async def run_async(concurrency):
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def get(i):
+        async with slots:
+            await get_async(i)
+
+    await asyncio.gather(*(get(i) for i in range(REQUESTS)))
+
+
+async def main():
+
+    slow_connections(async_read_engine.get().sync_engine)
+    # Warm up both paths (connections, compiled statements)
+    run_sync(THREADS)
+    await run_async(THREADS)
+
+    print(f"{REQUESTS} reads per run, {ROUND_TRIP * 1000:.1f} ms per statement, {THREADS} sync threads")
+    print(f"{'concurrency':>11} {'sync req/s':>11} {'async req/s':>12} {'speed-up':>9}")
+    for concurrency in CONCURRENCY:
+        start = time.perf_counter()
+        run_sync(concurrency)
+        sync_rate = REQUESTS / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await run_async(concurrency)
+        async_rate = REQUESTS / (time.perf_counter() - start)
+        print(f"{concurrency:>11} {sync_rate:>11.0f} {async_rate:>12.0f} {async_rate / sync_rate:>8.1f}x")
+    await async_read_engine.dispose()
+
+
+if __name__ == "__main__":
+    add_trails(TRAIL_COUNT)
+    session_store.create({"user_id": 1, "email": "grace@plymouth.ac.uk", "role": "admin"}, session_id=SESSION_ID)
+    with flask_app.app_context():
+        slow_connections(db.engine)
+        db.engine.dispose()
+    asyncio.run(main())
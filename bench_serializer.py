@@ -0,0 +1,88 @@
+# bench_serializer.py
+#
+# Compares the compiled row serializer (serializers.py) with the previous
+# trail_schema.dump path on 10,000 in-memory trails. No database is needed.
+#
+#   python bench_serializer.py [number_of_trails]
+
+import sys
+import time
+from config import app
+from models import Trail, User, Feature, TrailFeature
+from schemas import trail_schema
+from serializers import trail_serializer
+
+WAYPOINT_KEYS = ["pt1_lat", "pt1_long", "pt1_desc", "pt2_lat", "pt2_long", "pt2_desc", "pt3_lat", "pt3_long", "pt3_desc"]
+
+
+# The serialization trails.py used before serializers.py
+def schema_dump(trail):
+
+    trail_data = trail_schema.dump(trail)
+    trail_data["waypoints"] = {
+        "pt1": {"lat": trail.pt1_lat, "long": trail.pt1_long, "desc": trail.pt1_desc},
+        "pt2": {"lat": trail.pt2_lat, "long": trail.pt2_long, "desc": trail.pt2_desc},
+        "pt3": {"lat": trail.pt3_lat, "long": trail.pt3_long, "desc": trail.pt3_desc},
+    }
+    for key in WAYPOINT_KEYS:
+        trail_data.pop(key, None)
+    trail_data["features"] = [{"feature_name": tf.feature.feature_name} for tf in trail.features]
+    return trail_data
+
+
+# Build matching ORM objects and column rows for the same trails
+def build_trails(count):
+
+    owner = User(user_id=1, username="Grace Hopper", email="grace@plymouth.ac.uk", role="admin")
+    features = [Feature(feature_id=i, feature_name=name) for i, name in enumerate(["Waterfall", "Viewpoint", "Historic Landmark"], 1)]
+    serializer = trail_serializer()
+
+    trails, rows, feature_names = [], [], {}
+    for i in range(1, count + 1):
+        values = {
+            "trail_id": i, "trail_name": f"Trail {i}", "trail_summary": "Scenic ocean view hike",
+            "trail_description": "A beautiful hike along the coast.", "difficulty": "Easy",
+            "location": "Cornwall, UK", "length": 5.5, "elevation_gain": 150.0, "route_type": "Loop", "user_id": 1,
+            "pt1_lat": 50.1234, "pt1_long": -5.6789, "pt1_desc": "Start of the trail",
+            "pt2_lat": 50.1240, "pt2_long": -5.6795, "pt2_desc": "Viewpoint overlooking the ocean",
+            "pt3_lat": 50.1250, "pt3_long": -5.6800, "pt3_desc": "End of the loop",
+        }
+        trail = Trail(**values)
+        trail.owner = owner
+        linked = features[:1 + i % 3]
+        trail.features = [TrailFeature(trail_id=i, feature_id=f.feature_id, feature=f) for f in linked]
+        trails.append(trail)
+
+        owner_values = {"user_id": 1, "username": owner.username, "email": owner.email, "role": owner.role}
+        row = []
+        for column in serializer.columns:
+            row.append(owner_values[column.key] if column.class_ is User else values[column.key])
+        rows.append(tuple(row))
+        feature_names[i] = [{"feature_name": f.feature_name} for f in linked]
+
+    return trails, rows, feature_names
+
+
+def timed(label, function, count):
+
+    start = time.perf_counter()
+    body = function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:9.1f} ms  {elapsed / count * 1e6:7.2f} us/trail  {len(body) / 1024:8.0f} KiB")
+    return elapsed
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+    with app.app_context():
+        trails, rows, feature_names = build_trails(count)
+        serializer = trail_serializer()
+
+        # Both paths must produce the same documents
+        assert [schema_dump(t) for t in trails[:50]] == [serializer.encode(r, feature_names) for r in rows[:50]]
+
+        print(f"Serializing {count} trails")
+        old = timed("trail_schema.dump + json (previous)", lambda: app.json.dumps([schema_dump(t) for t in trails]), count)
+        new = timed("compiled serializer + fast JSON", lambda: app.json.dumps_bytes([serializer.encode(r, feature_names) for r in rows]), count)
+        print(f"Speed-up: {old / new:.1f}x")
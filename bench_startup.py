@@ -0,0 +1,52 @@
+# bench_startup.py
+#
+# Start-to-first-request time of fresh processes, with the OpenAPI cache (spec_cache.py) cold and
+# warm. Each run imports the app in a new interpreter, sends one request and reads the
+# startup_ready_seconds and startup_first_request_seconds gauges. Background threads are not
+# started, so no database is needed.
+#
+#   python bench_startup.py [runs]
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = """
+import json
+import app
+client = app.app.app.test_client()
+stats = client.get("/stats").get_json()
+print(json.dumps({key: stats[key] for key in ("startup_ready_seconds", "startup_first_request_seconds")}))
+"""
+
+
+def run(cache_path):
+
+    env = dict(os.environ, SPEC_CACHE_PATH=cache_path, DEFER_BACKGROUND_THREADS="1")
+    env.setdefault("DATABASE_URI", "sqlite://")
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def report(label, results):
+
+    ready = statistics.median(result["startup_ready_seconds"] for result in results)
+    first = statistics.median(result["startup_first_request_seconds"] for result in results)
+    print(f"{label:<28} {ready * 1000:8.0f} ms {first * 1000:16.0f} ms")
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    cache_path = os.path.join(tempfile.mkdtemp(), "swagger.cache.json")
+
+    print(f"Median of {runs} fresh processes")
+    print(f"{'':<28} {'ready':>11} {'first request':>19}")
+    report("no spec cache", [run("") for _ in range(runs)])
+    run(cache_path)
+    report("spec cache", [run(cache_path) for _ in range(runs)])
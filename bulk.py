@@ -0,0 +1,176 @@
+# bulk.py
+
+import json
+from sqlalchemy import Float, insert, select
+from config import db
+from models import Trail
+from linking import FeatureNameError, feature_names_from, insert_links, resolve_features
+from serializers import IN_CHUNK_SIZE
+from validation import SchemaError, compile_schema
+
+# Rows validated and inserted together
+BULK_CHUNK_SIZE = 500
+
+# Waypoint keys of the request body and the columns they are stored in
+WAYPOINT_COLUMNS = {
+    point: {part: f"{point}_{part}" for part in ("lat", "long", "desc")}
+    for point in ("pt1", "pt2", "pt3")
+}
+
+# Columns a bulk row may set, with the value used when a row leaves them out. Every row is
+# completed with these so a chunk can be inserted with a single executemany.
+ROW_DEFAULTS = {
+    column.key: column.default.arg if column.default is not None and column.default.is_scalar else None
+    for column in Trail.__table__.columns
+    if column.key not in ("trail_id", "version", "updated_at")
+}
+
+# Numeric columns, stored as floats whether a row sent them as integers or not
+FLOAT_COLUMNS = {column.key for column in Trail.__table__.columns if isinstance(column.type, Float)}
+
+
+class RowError(ValueError):
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+# Rows are checked against NewTrail, the schema of create_trail's body, compiled once when the API is registered
+class RowValidator:
+
+    def __init__(self):
+        self.check = None
+
+    def init_app(self, api):
+        self.check = compile_schema(api.specification["components"]["schemas"]["NewTrail"])
+
+
+row_validator = RowValidator()
+
+
+# Rows of a JSON array or an NDJSON document, as an iterator of (index, row) pairs. A malformed
+# array fails the whole request; malformed NDJSON lines are yielded as RowError instances so the
+# other rows can still be imported.
+def parse_rows(data, ndjson):
+
+    if ndjson:
+        return iter_ndjson(data)
+    rows = json.loads(data) if data.strip() else []
+    if not isinstance(rows, list):
+        raise RowError("Expected a JSON array of trails.")
+    return enumerate(rows)
+
+
+def iter_ndjson(data):
+
+    index = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            yield index, json.loads(line)
+        except ValueError as err:
+            yield index, RowError({"_schema": [f"Invalid JSON: {err}"]})
+        index += 1
+
+
+# Split (index, row) pairs into lists of BULK_CHUNK_SIZE
+def chunked(rows, size=BULK_CHUNK_SIZE):
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Column values and feature names of one row of the request, checked against NewTrail
+def prepare_row(row, user_id):
+
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError({"_schema": ["Each trail must be a JSON object."]})
+    try:
+        row_validator.check(row)
+    except SchemaError as err:
+        raise RowError({err.path or "_schema": [str(err)]})
+
+    row = dict(row)
+    features = row.pop("features", None) or []
+    waypoints = row.pop("waypoints", None) or {}
+
+    for point, parts in WAYPOINT_COLUMNS.items():
+        for part, column in parts.items():
+            row[column] = (waypoints.get(point) or {}).get(part)
+    row["user_id"] = user_id
+
+    try:
+        feature_names = feature_names_from([feature.get("feature_name") for feature in features])
+    except FeatureNameError as err:
+        raise RowError({"features": [str(err)]})
+    return row, feature_names
+
+
+# Names among trail_names that are already taken, with one IN query per chunk
+def existing_trail_names(trail_names):
+
+    taken = set()
+    for start in range(0, len(trail_names), IN_CHUNK_SIZE):
+        taken.update(db.session.execute(
+            select(Trail.trail_name).where(Trail.trail_name.in_(trail_names[start:start + IN_CHUNK_SIZE]))
+        ).scalars())
+    return taken
+
+
+# Validate and insert one chunk of (index, row) pairs in the current transaction, without committing.
+# Returns the per-row results, and the IDs of the created trails and of the features linked to them.
+def import_chunk(chunk, user_id, seen_names):
+
+    results = {}
+    valid = []
+    for index, row in chunk:
+        try:
+            valid.append((index,) + prepare_row(row, user_id))
+        except RowError as err:
+            results[index] = {"index": index, "status": "error", "errors": err.errors}
+
+    # Trail names must be unique across the database and the whole import
+    taken = existing_trail_names([values["trail_name"] for _, values, _ in valid])
+    rows = []
+    for index, values, feature_names in valid:
+        name = values["trail_name"]
+        if name in taken or name in seen_names:
+            results[index] = {"index": index, "status": "error", "errors": {"trail_name": [f"A trail with the name '{name}' already exists."]}}
+            continue
+        seen_names.add(name)
+        row = {key: values.get(key, default) for key, default in ROW_DEFAULTS.items()}
+        for key in FLOAT_COLUMNS:
+            if row[key] is not None:
+                row[key] = float(row[key])
+        rows.append((index, row, feature_names))
+
+    trail_ids = []
+    feature_ids = set()
+    if rows:
+        trail_ids = db.session.execute(
+            insert(Trail).returning(Trail.trail_id, sort_by_parameter_order=True),
+            [values for _, values, _ in rows],
+        ).scalars().all()
+
+        # Link every feature of the chunk, resolving all names at once
+        resolved = resolve_features([name for _, _, feature_names in rows for name in feature_names])
+        links = []
+        for trail_id, (_, _, feature_names) in zip(trail_ids, rows):
+            links.extend((trail_id, resolved[name]) for name in feature_names)
+        insert_links(links)
+        feature_ids.update(feature_id for _, feature_id in links)
+
+        for trail_id, (index, _, _) in zip(trail_ids, rows):
+            results[index] = {"index": index, "status": "created", "trail_id": trail_id}
+
+    return [results[index] for index, _ in chunk], trail_ids, feature_ids
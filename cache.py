@@ -0,0 +1,281 @@
+# cache.py
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import Response
+import metrics
+from background import run_blocking
+from signals import trails_changed, features_changed
+
+# Keys are "<group>|<variant>". Invalidation drops whole groups: one group per trail
+# ("trail:<id>") holding every field selection of it, plus one group for all listings and one
+# for all feature searches, since those can change whenever any trail changes.
+TRAIL_GROUP = "trail:"
+TRAIL_LISTING_GROUP = "trails"
+FEATURE_SEARCH_GROUP = "feature-search"
+
+# Seconds a document's last-used time in the SQLite backend may lag behind its reads. Hits only
+# write the time when it is older than this, so reads of hot documents do not all take the
+# write lock; eviction order is approximate to within this interval.
+SQLITE_TOUCH_INTERVAL = 30
+
+
+# Group part of a cache key
+def key_group(key):
+
+    return key.partition("|")[0]
+
+
+# In-process backend: a bounded LRU dictionary with per-entry expiry
+class MemoryBackend:
+
+    # Whether calls can block the caller (see background.run_blocking)
+    blocking = False
+
+    def __init__(self, max_entries=1024, ttl=300, **options):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.generation_value = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation):
+        with self.lock:
+            # Skip documents built before an invalidation that happened while they were built
+            if generation != self.generation_value:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            self.groups.setdefault(key_group(key), set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                metrics.inc("trail_cache_evictions")
+
+    def delete_groups(self, groups):
+        with self.lock:
+            self.generation_value += 1
+            for group in groups:
+                for key in list(self.groups.get(group, ())):
+                    self.remove(key)
+
+    # Remove one entry; the caller holds the lock
+    def remove(self, key):
+        del self.entries[key]
+        group = self.groups[key_group(key)]
+        group.discard(key)
+        if not group:
+            del self.groups[key_group(key)]
+
+    def generation(self):
+        return self.generation_value
+
+    def size(self):
+        return len(self.entries)
+
+
+# Shared backend: an SQLite file every worker process on the host opens, so invalidations
+# made by one worker are seen by all of them
+class SQLiteBackend:
+
+    # File I/O, and waits of up to 5 seconds for the write lock
+    blocking = True
+
+    def __init__(self, path, max_entries=1024, ttl=300, **options):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        with self.connect() as conn:
+            # Files written before documents were grouped are dropped; they only hold cached copies
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(documents)")]
+            if columns and "grp" not in columns:
+                conn.execute("DROP TABLE documents")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, grp TEXT NOT NULL, "
+                "value BLOB NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS documents_grp ON documents (grp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS documents_used ON documents (used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO generation (id, value) VALUES (1, 0)")
+
+    # One connection per thread; SQLite connections cannot be shared between threads
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self.connect()
+        now = time.time()
+        row = conn.execute("SELECT value, expires, used FROM documents WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute("DELETE FROM documents WHERE key = ?", (key,))
+            return None
+        if now - row[2] > SQLITE_TOUCH_INTERVAL:
+            conn.execute("UPDATE documents SET used = ? WHERE key = ?", (now, key))
+        return bytes(row[0])
+
+    def set(self, key, value, generation):
+        conn = self.connect()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT value FROM generation WHERE id = 1").fetchone()[0] != generation:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO documents (key, grp, value, expires, used) VALUES (?, ?, ?, ?, ?)",
+                (key, key_group(key), value, now + self.ttl, now),
+            )
+            # Evict the least recently used documents beyond the size limit
+            evicted = conn.execute(
+                "DELETE FROM documents WHERE key IN "
+                "(SELECT key FROM documents ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        if evicted > 0:
+            metrics.inc("trail_cache_evictions", evicted)
+
+    def delete_groups(self, groups):
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE generation SET value = value + 1 WHERE id = 1")
+            conn.executemany("DELETE FROM documents WHERE grp = ?", [(group,) for group in groups])
+
+    def generation(self):
+        return self.connect().execute("SELECT value FROM generation WHERE id = 1").fetchone()[0]
+
+    def size(self):
+        return self.connect().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+# Backend names accepted by the TRAIL_CACHE_BACKEND setting. Other shared stores can be registered here.
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+# Read-through cache of encoded JSON documents for the trail read endpoints
+class DocumentCache:
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        backend_name = app.config["TRAIL_CACHE_BACKEND"]
+        if backend_name == "none":
+            self.backend = None
+            return
+        self.backend = BACKENDS[backend_name](
+            path=app.config["TRAIL_CACHE_PATH"],
+            max_entries=app.config["TRAIL_CACHE_MAX_ENTRIES"],
+            ttl=app.config["TRAIL_CACHE_TTL"],
+        )
+        metrics.register_gauge("trail_cache_entries", self.backend.size)
+
+    # Return the cached document for key, building and storing it on a miss.
+    # build returns the encoded bytes, or None for results that must not be cached.
+    def get_or_build(self, key, build):
+        if self.backend is None:
+            return build()
+
+        body = self.backend.get(key)
+        if body is not None:
+            metrics.inc("trail_cache_hits")
+            return body
+
+        metrics.inc("trail_cache_misses")
+        generation = self.backend.generation()
+        body = build()
+        if body is not None:
+            self.backend.set(key, body, generation)
+        return body
+
+    # get_or_build for the async read path (see async_reads.py): build is a coroutine function.
+    # The SQLite backend is called on the event loop's executor.
+    async def get_or_build_async(self, key, build):
+        if self.backend is None:
+            return await build()
+
+        blocking = self.backend.blocking
+        body = await run_blocking(blocking, self.backend.get, key)
+        if body is not None:
+            metrics.inc("trail_cache_hits")
+            return body
+
+        metrics.inc("trail_cache_misses")
+        generation = await run_blocking(blocking, self.backend.generation)
+        body = await build()
+        if body is not None:
+            await run_blocking(blocking, self.backend.set, key, body, generation)
+        return body
+
+    def invalidate_trails(self, trail_ids):
+        if self.backend is None:
+            return
+        groups = [f"{TRAIL_GROUP}{trail_id}" for trail_id in trail_ids]
+        self.backend.delete_groups(groups + [TRAIL_LISTING_GROUP, FEATURE_SEARCH_GROUP])
+        metrics.inc("trail_cache_invalidations")
+
+    def invalidate_feature_searches(self):
+        if self.backend is None:
+            return
+        self.backend.delete_groups([FEATURE_SEARCH_GROUP])
+        metrics.inc("trail_cache_invalidations")
+
+
+document_cache = DocumentCache()
+
+
+# Build a cache key from a group and the sorted parameters that select the representation
+def cache_key(group, **params):
+
+    return group + "|" + "&".join(f"{name}={value}" for name, value in sorted(params.items()) if value is not None)
+
+
+# Key a document is cached under: its representation key and the ETag it is served with. The ETag
+# carries the versions read for it, so once a change made anywhere (another worker, a write seen
+# late through a replica) bumps a version, the bodies cached under the old one are never served
+# again; they age out of the cache instead.
+def versioned_key(key, etag):
+
+    return f"{key}|{etag}"
+
+
+# Wrap an encoded JSON document in a response
+def json_bytes_response(body, status=200):
+
+    return Response(body, status=status, mimetype="application/json")
+
+
+@trails_changed.connect
+def on_trails_changed(sender, trail_ids):
+    document_cache.invalidate_trails(trail_ids)
+
+
+@features_changed.connect
+def on_features_changed(sender, feature_ids):
+    document_cache.invalidate_feature_searches()
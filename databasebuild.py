@@ -1,5 +1,5 @@
 from config import app, db
-from models import User, Trail, Feature, TrailFeature
+from models import User, Trail, Feature, TrailFeature, ResourceVersion
 
 # Sample user data
 USERS = [
@@ -144,4 +144,11 @@ with app.app_context():
 
     db.session.commit()
 
+    # Start the change counters used for ETags
+    print("Inserting resource versions...")
+    for name in ["trails", "features"]:
+        db.session.add(ResourceVersion(name=name, version=1))
+
+    db.session.commit()
+
     print("Database created and populated successfully!")
@@ -0,0 +1,237 @@
+# engines.py
+
+import threading
+import time
+from flask import g, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool, StaticPool
+import metrics
+from signals import trails_changed, features_changed
+
+# Schema the models live in on SQL Server; SQLite has no schemas, so it is translated away
+MODELS_SCHEMA = "CW2"
+
+# Bind key of the read replica in SQLALCHEMY_BINDS
+REPLICA = "replica"
+
+# Requests that only read, and the cookie keeping a client on the primary after it writes
+SAFE_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+STICKY_COOKIE = "read_primary_until"
+
+
+# Queue pool that reports how long callers wait for a connection
+class TimedQueuePool(QueuePool):
+    engine_name = "primary"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            metrics.inc("db_pool_timeouts", engine=self.engine_name)
+            raise
+        finally:
+            metrics.inc("db_pool_wait_seconds", time.perf_counter() - started, engine=self.engine_name)
+            metrics.inc("db_pool_checkouts", engine=self.engine_name)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.engine_name = self.engine_name
+        return pool
+
+
+# Engine options for a database URI from the DB_* settings of config.py. SQLite URIs get
+# their schema translated away, a busy timeout and a shared in-memory database.
+def engine_options(uri, settings):
+
+    url = make_url(uri)
+    options = {
+        "pool_pre_ping": settings["DB_POOL_PRE_PING"],
+        "pool_recycle": settings["DB_POOL_RECYCLE"],
+    }
+    connect_args = {}
+    statement_timeout = settings["DB_STATEMENT_TIMEOUT"]
+
+    if url.get_backend_name() == "sqlite":
+        options["execution_options"] = {"schema_translate_map": {MODELS_SCHEMA: None}}
+        connect_args["check_same_thread"] = False
+        if statement_timeout:
+            # SQLite runs in process; the nearest equivalent is how long to wait for a lock
+            connect_args["timeout"] = statement_timeout
+        if url.database in (None, "", ":memory:"):
+            # Every connection must see the same in-memory database
+            options["poolclass"] = StaticPool
+            options["connect_args"] = connect_args
+            return options
+    elif url.get_backend_name() == "postgresql" and statement_timeout:
+        connect_args["options"] = f"-c statement_timeout={int(statement_timeout * 1000)}"
+
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=settings["DB_POOL_SIZE"],
+        max_overflow=settings["DB_MAX_OVERFLOW"],
+        pool_timeout=settings["DB_POOL_TIMEOUT"],
+    )
+    options["connect_args"] = connect_args
+    return options
+
+
+# Per-connection settings the driver does not take as connect arguments
+def configure_connections(engine, settings):
+
+    statement_timeout = settings["DB_STATEMENT_TIMEOUT"]
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        if engine.dialect.name == "sqlite":
+            cursor = dbapi_connection.cursor()
+            if engine.url.database not in (None, "", ":memory:"):
+                # Readers do not block the writer, nor the writer the readers
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+        elif engine.dialect.name == "mssql" and statement_timeout:
+            # pyodbc query timeout, in whole seconds. Under aioodbc the pyodbc connection is
+            # wrapped by the aioodbc one.
+            pyodbc_connection = getattr(connection_record.driver_connection, "_conn", dbapi_connection)
+            pyodbc_connection.timeout = max(1, int(statement_timeout))
+
+
+# Publish live statistics of an engine's connection pool
+def register_pool_gauges(engine, engine_name):
+
+    pool = engine.pool
+    pool.engine_name = engine_name
+    if not isinstance(pool, QueuePool):
+        return
+    # Read through the engine: the pool is replaced when the engine is disposed
+    metrics.register_gauge(f"db_pool_checked_out{{engine={engine_name}}}", lambda: engine.pool.checkedout())
+    metrics.register_gauge(f"db_pool_overflow{{engine={engine_name}}}", lambda: max(0, engine.pool.overflow()))
+    metrics.register_gauge(f"db_pool_idle{{engine={engine_name}}}", lambda: engine.pool.checkedin())
+    metrics.register_gauge(f"db_pool_size{{engine={engine_name}}}", lambda: engine.pool.size())
+
+
+# Sends the reads of read-only requests to the replica and everything else to the primary.
+# A client that has just written is kept on the primary for REPLICA_STICKY_SECONDS by a cookie,
+# so it reads its own writes whichever worker serves it. After a write in this process, every
+# read stays on the primary for REPLICA_LAG_WINDOW seconds, so the document cache and indexes
+# are not refilled from a replica that has not caught up. While the replica is unreachable,
+# reads fall back to the primary; its health is re-checked every REPLICA_CHECK_INTERVAL seconds.
+class ReplicaRouter:
+
+    def __init__(self):
+        self.engine = None
+        self.healthy = True
+        self.checked_at = 0
+        self.last_write = 0
+        self.check_lock = threading.Lock()
+
+    def init_app(self, app, engine):
+        config = app.config
+        self.engine = engine
+        self.sticky_seconds = config["REPLICA_STICKY_SECONDS"]
+        self.lag_window = config["REPLICA_LAG_WINDOW"]
+        self.check_interval = config["REPLICA_CHECK_INTERVAL"]
+
+        event.listen(engine, "handle_error", self.on_error)
+        trails_changed.connect(self.on_write, weak=False)
+        features_changed.connect(self.on_write, weak=False)
+        app.before_request(self.route_request)
+        app.after_request(self.stick_after_write)
+        metrics.register_gauge("db_replica_healthy", lambda: int(self.healthy))
+
+    def route_request(self):
+        try:
+            primary_until = float(request.cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        g.read_replica = request.method in SAFE_METHODS and primary_until < time.time()
+
+    def stick_after_write(self, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                STICKY_COOKIE, str(int(time.time() + self.sticky_seconds) + 1),
+                max_age=int(self.sticky_seconds) + 1, httponly=True,
+            )
+        return response
+
+    def on_write(self, sender, **changes):
+        self.last_write = time.monotonic()
+
+    # Whether the current request may read from the replica
+    def use_replica(self):
+        if self.engine is None or not g.get("read_replica"):
+            return False
+        now = time.monotonic()
+        if now - self.last_write < self.lag_window:
+            return False
+        if now - self.checked_at >= self.check_interval and self.check_lock.acquire(blocking=False):
+            try:
+                self.check(now)
+            finally:
+                self.check_lock.release()
+        return self.healthy
+
+    def check(self, now):
+        self.checked_at = now
+        try:
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+            self.healthy = True
+        except DBAPIError:
+            self.healthy = False
+
+    # A replica that cannot be reached or used is skipped until the next health check
+    def on_error(self, context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+            self.healthy = False
+            self.checked_at = time.monotonic()
+            metrics.inc("db_replica_errors")
+
+    # Whether a read that failed with err should be retried on the primary: on_error has just
+    # found the replica unusable
+    def retry_on_primary(self, err):
+        return not self.healthy and (err.connection_invalidated or isinstance(err, OperationalError))
+
+
+replica_router = ReplicaRouter()
+
+
+# Flask-SQLAlchemy session that lets the replica router pick the engine for reads.
+# Flushes, and anything outside a read-only request, go to the primary. A read the replica
+# fails is rolled back and run again on the primary, so the request still gets its answer.
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and replica_router.use_replica():
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def execute(self, statement, *args, **kwargs):
+        if not replica_router.use_replica():
+            return super().execute(statement, *args, **kwargs)
+        try:
+            return super().execute(statement, *args, **kwargs)
+        except DBAPIError as err:
+            if not replica_router.retry_on_primary(err):
+                raise
+            metrics.inc("db_replica_fallbacks")
+            self.rollback()
+            return super().execute(statement, *args, **kwargs)
+
+
+# Finish setting up the engines of a Flask-SQLAlchemy extension: the primary and, when
+# REPLICA_DATABASE_URI is set, the read replica
+def init_app(app, db):
+
+    with app.app_context():
+        engines = db.engines
+    configure_connections(engines[None], app.config)
+    register_pool_gauges(engines[None], "primary")
+    if REPLICA in engines:
+        configure_connections(engines[REPLICA], app.config)
+        register_pool_gauges(engines[REPLICA], REPLICA)
+        replica_router.init_app(app, engines[REPLICA])
@@ -0,0 +1,153 @@
+# facets.py
+
+from sqlalchemy import select
+from config import db
+from indexes import TrailIndex
+from models import Trail, Feature, TrailFeature
+
+# Trail columns with an exact match filter that the facet index can answer
+VALUE_FIELDS = ("difficulty", "location", "route_type")
+
+
+# Number of set bits; int.bit_count needs Python 3.10
+def popcount(bits):
+
+    return bits.bit_count() if hasattr(bits, "bit_count") else bin(bits).count("1")
+
+
+# Bitset (an int with bit n set for trail n) of a collection of trail IDs
+def bitmap_of(trail_ids):
+
+    trail_ids = list(trail_ids)
+    if not trail_ids:
+        return 0
+    buffer = bytearray(max(trail_ids) // 8 + 1)
+    for trail_id in trail_ids:
+        buffer[trail_id >> 3] |= 1 << (trail_id & 7)
+    return int.from_bytes(buffer, "little")
+
+
+# Trail IDs set in a bitset, in ascending order, starting after a keyset cursor
+def iter_bitmap(bits, after=None):
+
+    offset = 0
+    if after is not None and after >= 0:
+        offset = after + 1
+        bits >>= offset
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for index, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield offset + index * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+# Bitmap index for faceted filtering: one bitset of trail IDs per feature and per difficulty,
+# location and route type. Sets of trail IDs are the source of truth so single trails can be
+# updated cheaply; the bitsets are built from them on first use after a change.
+class FacetIndex(TrailIndex):
+
+    name = "facet index"
+
+    def __init__(self):
+        super().__init__()
+        self.clear()
+
+    def statement(self):
+        return (
+            select(Trail.trail_id, Trail.difficulty, Trail.location, Trail.route_type, TrailFeature.feature_id)
+            .outerjoin(TrailFeature, TrailFeature.trail_id == Trail.trail_id)
+        )
+
+    def clear(self):
+        self.sets = {}
+        self.bitmaps = {}
+        self.trails = {}
+
+    # Add a trail ID to the set under key and drop the stale bitset
+    def link(self, key, trail_id):
+        self.sets.setdefault(key, set()).add(trail_id)
+        self.bitmaps.pop(key, None)
+
+    def unlink(self, key, trail_id):
+        members = self.sets.get(key)
+        if members is not None:
+            members.discard(trail_id)
+            if not members:
+                del self.sets[key]
+        self.bitmaps.pop(key, None)
+
+    # Rows hold one linked feature each (or None), so a trail may be added several times
+    def add(self, row):
+        keys = self.trails.get(row.trail_id)
+        if keys is None:
+            keys = self.trails[row.trail_id] = {("trail", None)}
+            keys.update((field, getattr(row, field)) for field in VALUE_FIELDS)
+        if row.feature_id is not None:
+            keys.add(("feature", row.feature_id))
+        for key in keys:
+            self.link(key, row.trail_id)
+
+    def remove(self, trail_id):
+        for key in self.trails.pop(trail_id, ()):
+            self.unlink(key, trail_id)
+
+    # Bitset of the trails under key; the caller holds the lock
+    def bitmap(self, key):
+        bits = self.bitmaps.get(key)
+        if bits is None:
+            bits = self.bitmaps[key] = bitmap_of(self.sets.get(key, ()))
+        return bits
+
+    # Bitset of the trails having every feature in feature_ids, none in exclude_ids,
+    # and the given difficulty, location and route type
+    def match(self, feature_ids=(), exclude_ids=(), **values):
+        with self.lock:
+            bits = self.bitmap(("trail", None))
+            for field in VALUE_FIELDS:
+                if values.get(field) is not None:
+                    bits &= self.bitmap((field, values[field]))
+            for feature_id in feature_ids:
+                bits &= self.bitmap(("feature", feature_id))
+            for feature_id in exclude_ids:
+                bits &= ~self.bitmap(("feature", feature_id))
+            return bits
+
+    # Number of trails in bits linked to each feature, for features with at least one
+    def feature_counts(self, bits):
+        with self.lock:
+            feature_ids = [key[1] for key in self.sets if key[0] == "feature"]
+            counts = {feature_id: popcount(bits & self.bitmap(("feature", feature_id))) for feature_id in feature_ids}
+        return {feature_id: count for feature_id, count in counts.items() if count}
+
+
+facet_index = FacetIndex()
+
+
+# Trails matching a faceted query, as a bitset, and the number of them linked to each feature.
+# Feature filters are given by name; requiring a feature that does not exist matches nothing.
+# Filters the index cannot answer (range filters) are passed as SQL conditions and applied
+# with one query reading trail IDs only.
+def faceted_search(features=(), exclude_features=(), difficulty=None, location=None, route_type=None, conditions=()):
+
+    facet_index.ensure_built()
+    facet_index.refresh()
+
+    names = dict(db.session.execute(select(Feature.feature_id, Feature.feature_name)).all())
+    ids = {name: feature_id for feature_id, name in names.items()}
+    if any(name not in ids for name in features):
+        bits = 0
+    else:
+        bits = facet_index.match(
+            [ids[name] for name in features],
+            [ids[name] for name in exclude_features if name in ids],
+            difficulty=difficulty, location=location, route_type=route_type,
+        )
+
+    if bits and conditions:
+        bits &= bitmap_of(db.session.execute(select(Trail.trail_id).where(*conditions)).scalars())
+
+    # Most common features first
+    counts = sorted(facet_index.feature_counts(bits).items(), key=lambda item: (-item[1], item[0]))
+    facets = {names[feature_id]: count for feature_id, count in counts if feature_id in names}
+    return bits, facets
@@ -1,88 +1,171 @@
  # feature.py
  
-from flask import jsonify, request
+from flask import current_app, jsonify, request
+from sqlalchemy import func, select
 from config import db
-from models import Feature, TrailFeature, feature_schema, features_schema
-from permissions import check_permission
+from models import Trail, Feature, TrailFeature
+from loading import query_budget
+from autocomplete import autocomplete
+from linking import FeatureNameError, existing_feature_ids, feature_names_from, insert_missing_features, resolve_features
+from serializers import FieldsetError, search_serializer
+from streaming import STREAM_BATCH_SIZE, stream_response, wants_ndjson, wants_stream
+from cache import document_cache, json_bytes_response, cache_key, versioned_key, FEATURE_SEARCH_GROUP
+from versions import TRAILS, FEATURES, collection_versions, commit_changes, validators, not_modified, with_validators
+from telemetry import server_error
 
 
-# Read all features
-def read_all_features():
+# Default and maximum number of features returned per page
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Maximum number of autocomplete suggestions
+MAX_SUGGESTIONS = 50
+
+# One query for a page of features and their usage counts, from a single GROUP BY.
+# One extra row is read to find out whether another page follows.
+def features_page_statement(limit, after=None, prefix=None):
+
+    statement = (
+        select(Feature.feature_id, Feature.feature_name, func.count(TrailFeature.trail_id).label("usage_count"))
+        .outerjoin(TrailFeature, TrailFeature.feature_id == Feature.feature_id)
+        .group_by(Feature.feature_id, Feature.feature_name)
+        .order_by(Feature.feature_id)
+        .limit(limit + 1)
+    )
+    if after is not None:
+        statement = statement.where(Feature.feature_id > after)
+    if prefix:
+        statement = statement.where(Feature.feature_name.startswith(prefix, autoescape=True))
+    return statement
+
+# The page document for the rows of features_page_statement
+def features_page(rows, limit):
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].feature_id
+
+    return {
+        "features": [
+            {"feature_id": row.feature_id, "feature_name": row.feature_name, "usage_count": row.usage_count}
+            for row in rows
+        ],
+        "next_cursor": next_cursor,
+    }
+
+# Read a page of features ordered by feature ID, with the number of trails using each.
+# ?prefix= keeps the features whose name starts with it; pass next_cursor as ?after= for the next page.
+def read_all_features(limit=DEFAULT_PAGE_SIZE, after=None, prefix=None):
 
-    # Check if the user has the required permission
-    user, error = check_permission("view_all_features")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
-    
     try:
-        features = Feature.query.all()
-        
-        # Serialize the data. Transforms the list of Feature objects into a JSON-serializable format.
-        result = [{"feature_id": feature.feature_id, "feature_name": feature.feature_name} for feature in features]
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
 
-        return jsonify(result), 200
+        # Answer conditional requests from the features change counter, before any feature is read.
+        # Linking and unlinking features bump it too, so usage counts are covered.
+        key = cache_key("features", limit=limit, after=after, prefix=prefix)
+        etag, last_modified = validators(collection_versions(FEATURES), key)
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        rows = db.session.execute(features_page_statement(limit, after, prefix)).all()
+        return with_validators(jsonify(features_page(rows, limit)), etag, last_modified)
 
     except Exception as e:
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
+
+# Suggest feature names starting with a prefix, most used first. Served from the in-memory
+# feature name index without reading the database.
+def autocomplete_features(prefix, limit=10):
 
-# Search for a feature by its name and return all trails associated with it
+    try:
+        suggestions = autocomplete(prefix, max(1, min(limit, MAX_SUGGESTIONS)))
+        return jsonify({"features": [
+            {"feature_name": feature_name, "usage_count": usage_count} for feature_name, usage_count in suggestions
+        ]})
+    except Exception as e:
+        return server_error(e)
+
+# Statement finding a feature by its exact name
+def feature_by_name_statement(feature_name):
+
+    return select(Feature.feature_id, Feature.feature_name).where(Feature.feature_name == feature_name)
+
+# Statement selecting the trails linked to a feature, in the columns the serializer reads
+def linked_trails_statement(serializer, feature_id):
+
+    return (
+        serializer.statement()
+        .join(TrailFeature, TrailFeature.trail_id == Trail.trail_id)
+        .where(TrailFeature.feature_id == feature_id)
+        .order_by(Trail.trail_id)
+    )
+
+# Search for a feature by its name and return all trails associated with it.
+# With ?stream=1 or an NDJSON Accept header the trails are streamed a batch at a time.
+# ?fields= and ?include= select the trail columns and related data that are read and returned.
 def search_feature_by_name():
 
-    user, error = check_permission("search_features")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
-    
     try:
         # Get the feature name from the query parameters
         feature_name = request.args.get('name')
         if not feature_name:
             return jsonify({"error": "Feature name is required."}), 400
 
-        # Query the feature by name and check it exists
-        feature = Feature.query.filter_by(feature_name=feature_name).first()
-        if not feature:
-            return jsonify({"error": f"Feature with name '{feature_name}' not found."}), 404
+        # Only read the trail columns and related data that were asked for
+        try:
+            serializer = search_serializer(request.args.get("fields"), request.args.get("include"))
+        except FieldsetError as err:
+            return jsonify({"error": str(err)}), 400
+
+        # Answer conditional requests from the trails and features change counters, before anything is read
+        streamed = wants_stream(request.args.get("stream", default=0, type=int))
+        key = cache_key(FEATURE_SEARCH_GROUP, name=feature_name, fieldset=serializer.fieldset)
+        etag, last_modified = validators(collection_versions(TRAILS, FEATURES), f"{key}|{streamed}|{wants_ndjson()}")
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        if streamed:
+            # Check the feature exists before the response starts
+            feature = Feature.query.filter_by(feature_name=feature_name).first()
+            if not feature:
+                return jsonify({"error": f"Feature with name '{feature_name}' not found."}), 404
+
+            documents = serializer.iter_documents(linked_trails_statement(serializer, feature.feature_id), STREAM_BATCH_SIZE)
+            response = stream_response(documents, "trails", {"feature_name": feature.feature_name})
+            return with_validators(response, etag, last_modified)
+
+        def build_result():
+            with query_budget("feature_documents"):
+                # Query the feature by name and check it exists
+                feature = Feature.query.filter_by(feature_name=feature_name).first()
+                if not feature:
+                    return None
 
-        # Constructs the response
-        result = {
-            "feature_name": feature.feature_name,
-            "trails": [
-                {
-                    "trail_name": tf.trail.trail_name,
-                    "difficulty": tf.trail.difficulty,
-                    "location": tf.trail.location,
-                    "length": tf.trail.length,
-                    "elevation_gain": tf.trail.elevation_gain,
-                    "route_type": tf.trail.route_type,
-                    "trail_summary": tf.trail.trail_summary,
-                    "trail_description": tf.trail.trail_description,
-                    "waypoints": {
-                        "pt1": {"lat": tf.trail.pt1_lat, "long": tf.trail.pt1_long, "desc": tf.trail.pt1_desc},
-                        "pt2": {"lat": tf.trail.pt2_lat, "long": tf.trail.pt2_long, "desc": tf.trail.pt2_desc},
-                        "pt3": {"lat": tf.trail.pt3_lat, "long": tf.trail.pt3_long, "desc": tf.trail.pt3_desc},
-                        },
-                    "features": [
-                        {
-                            "feature_name": linked_feature.feature_name
-                        }
-                        for linked_feature in [f.feature for f in tf.trail.features]
-                    ]
+                # Constructs the response
+                rows = db.session.execute(linked_trails_statement(serializer, feature.feature_id)).all()
+                result = {
+                    "feature_name": feature.feature_name,
+                    "trails": serializer.documents(rows)
                 }
-                for tf in feature.trails
-            ]
-        }
 
-        return jsonify(result), 200
+            return current_app.json.dumps_bytes(result)
+
+        # Serve the encoded result from the document cache, building it on a miss
+        body = document_cache.get_or_build(versioned_key(key, etag), build_result)
+        if body is None:
+            return jsonify({"error": f"Feature with name '{feature_name}' not found."}), 404
+
+        return with_validators(json_bytes_response(body), etag, last_modified)
 
     except Exception as e:
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
      
 # Add a new feature to the database.
 def add_feature():
 
-    user, error = check_permission("add_feature")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
     try:
         feature_data = request.json
         feature_name = feature_data.get("feature_name")
@@ -92,28 +175,50 @@ def add_feature():
             return {"error": "Feature name is required."}, 400
 
         # Check if the feature already exists
-        existing_feature = Feature.query.filter_by(feature_name=feature_name).first()
-        if existing_feature:
+        if existing_feature_ids([feature_name]):
             return {"error": f"Feature '{feature_name}' already exists."}, 400
 
-        # Create and add the new feature
-        new_feature = Feature(feature_name=feature_name)
-        db.session.add(new_feature)
-        db.session.commit()
+        # Create the feature; a concurrent insert of the same name is skipped rather than failing
+        insert_missing_features([feature_name])
+        feature_ids = list(existing_feature_ids([feature_name]).values())
+        commit_changes(feature_ids=feature_ids)
 
         return {"message": f"Feature '{feature_name}' successfully added.", "feature": {"feature_name": feature_name}}, 201
 
     except Exception as e:
         db.session.rollback()
-        return {"error": f"An error occurred: {str(e)}"}, 500
+        return server_error(e)
+
+# Add many features in one request. Names that already exist are left as they are.
+# Every name is reported with its feature ID and whether it was created.
+def bulk_add_features():
+
+    try:
+        try:
+            feature_names = feature_names_from(request.json.get("feature_name"))
+        except FeatureNameError as err:
+            return jsonify({"error": str(err)}), 400
+
+        # One IN query for the names that exist, one upsert statement per chunk for the rest
+        existing = existing_feature_ids(feature_names)
+        resolved = resolve_features(feature_names)
+        created_ids = [feature_id for name, feature_id in resolved.items() if name not in existing]
+        commit_changes(feature_ids=created_ids)
+
+        results = [
+            {"feature_name": name, "feature_id": resolved[name], "status": "existing" if name in existing else "created"}
+            for name in feature_names
+        ]
+        return jsonify({"created": len(created_ids), "features": results}), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return server_error(e)
         
         
 # Update the name of an existing feature
 def update_feature_by_name(current_feature_name):
 
-    user, error = check_permission("update_feature_by_name")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
     try:
         feature_data = request.json
         new_feature_name = feature_data.get("new_feature_name")
@@ -134,22 +239,21 @@ def update_feature_by_name(current_feature_name):
 
         # Update the feature name
         feature.feature_name = new_feature_name
-        db.session.commit()
+
+        # Trails listing this feature now carry the new name
+        trail_ids = [row.trail_id for row in db.session.query(TrailFeature.trail_id).filter_by(feature_id=feature.feature_id)]
+        commit_changes(trail_ids=trail_ids, feature_ids=[feature.feature_id])
 
         return jsonify({"message": f"Feature name successfully updated from '{current_feature_name}' to '{new_feature_name}'.",
                         "feature": {"feature_name": new_feature_name}}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
 
 # Delete a feature from the database
 def delete_feature(feature_name):
 
-    user, error = check_permission("delete_feature")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
-    
     try:
         feature = Feature.query.filter_by(feature_name=feature_name).first()
 
@@ -163,11 +267,12 @@ def delete_feature(feature_name):
             return jsonify({"error": f"Feature '{feature_name}' is associated with one or more trails and cannot be deleted."}), 400
 
         # If no association exists, delete the feature
+        feature_id = feature.feature_id
         db.session.delete(feature)
-        db.session.commit()
+        commit_changes(feature_ids=[feature_id])
 
         return jsonify({"message": f"Feature '{feature_name}' successfully deleted."}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
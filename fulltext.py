@@ -0,0 +1,186 @@
+# fulltext.py
+
+import math
+import re
+from collections import Counter
+from indexes import TrailIndex
+from models import Trail
+
+# Indexed text columns and the weight of a term found in each
+TEXT_FIELDS = (
+    (Trail.trail_name, 3.0),
+    (Trail.location, 2.0),
+    (Trail.trail_summary, 1.5),
+    (Trail.trail_description, 1.0),
+    (Trail.pt1_desc, 1.0),
+    (Trail.pt2_desc, 1.0),
+    (Trail.pt3_desc, 1.0),
+)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Score multiplier of a term matched with a typo, per edit
+FUZZY_PENALTY = 0.5
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+# Character trigrams of a term, padded so short terms and word edges still produce grams
+def trigrams(term):
+
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Number of typos tolerated in a query term of this length
+def max_edits(term):
+
+    if len(term) <= 3:
+        return 0
+    if len(term) <= 7:
+        return 1
+    return 2
+
+
+# Optimal string alignment distance (Levenshtein plus adjacent transpositions), or None beyond limit
+def edit_distance(a, b, limit):
+
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return None
+        previous2, previous = previous, current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+# Inverted index over the trail text with BM25 ranking.
+# Postings map each term to {trail_id: weighted term frequency}; a trigram index over the
+# vocabulary finds terms within a few edits of a misspelt query term.
+class SearchIndex(TrailIndex):
+
+    name = "search index"
+    columns = (Trail.trail_id,) + tuple(column for column, _ in TEXT_FIELDS)
+
+    def __init__(self):
+        super().__init__()
+        self.clear()
+
+    def clear(self):
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0.0
+        self.grams = {}
+
+    def add(self, row):
+        frequencies = Counter()
+        for (_, weight), text in zip(TEXT_FIELDS, row[1:]):
+            for term in tokenize(text):
+                frequencies[term] += weight
+        length = sum(frequencies.values())
+        self.lengths[row.trail_id] = (length, tuple(frequencies))
+        self.total_length += length
+        for term, frequency in frequencies.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                for gram in trigrams(term):
+                    self.grams.setdefault(gram, set()).add(term)
+            postings[row.trail_id] = frequency
+
+    def remove(self, trail_id):
+        length, terms = self.lengths.pop(trail_id, (0.0, ()))
+        self.total_length -= length
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(trail_id, None)
+            if not postings:
+                del self.postings[term]
+                for gram in trigrams(term):
+                    self.grams[gram].discard(term)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+
+    # Indexed terms matching a query term, with the number of edits needed to reach each
+    def expand(self, term):
+        matches = {term: 0} if term in self.postings else {}
+        limit = max_edits(term)
+        if limit == 0:
+            return matches
+
+        # Candidates share enough trigrams with the query term to be within the edit limit
+        # (one edit changes at most four of them)
+        grams = trigrams(term)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+        needed = len(grams) - 4 * limit
+        for candidate, count in shared.items():
+            if candidate in matches or count < needed:
+                continue
+            distance = edit_distance(term, candidate, limit)
+            if distance is not None:
+                matches[candidate] = distance
+        return matches
+
+    # (score, trail_id) of the best matching trails, best first. Every query term must match
+    # (exactly or with a typo) somewhere in the trail.
+    def search(self, query, limit):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self.lock:
+            count = len(self.lengths)
+            if count == 0:
+                return []
+            average_length = self.total_length / count
+
+            scores = None
+            for term in terms:
+                term_scores = {}
+                for match, edits in self.expand(term).items():
+                    postings = self.postings[match]
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    boost = FUZZY_PENALTY ** edits
+                    for trail_id, frequency in postings.items():
+                        norm = K1 * (1 - B + B * self.lengths[trail_id][0] / average_length)
+                        score = boost * idf * frequency * (K1 + 1) / (frequency + norm)
+                        if score > term_scores.get(trail_id, 0.0):
+                            term_scores[trail_id] = score
+
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {trail_id: score + term_scores[trail_id] for trail_id, score in scores.items() if trail_id in term_scores}
+                if not scores:
+                    return []
+
+        ranked = sorted(((-score, trail_id) for trail_id, score in scores.items()))[:limit]
+        return [(-score, trail_id) for score, trail_id in ranked]
+
+
+search_index = SearchIndex()
+
+
+# (score, trail_id) of the trails best matching a free-text query, best first
+def search_trails(query, limit):
+
+    search_index.ensure_built()
+    search_index.refresh()
+    return search_index.search(query, limit)
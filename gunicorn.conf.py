@@ -0,0 +1,58 @@
+# gunicorn.conf.py
+#
+# Production server settings, read from the environment:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#
+# The app (imports, OpenAPI spec, engine setup) is loaded once in the master and shared by the
+# forked workers. Each worker serves THREADS requests at a time and is replaced after about
+# MAX_REQUESTS requests. Signals to the master:
+#
+#   HUP   re-read this file and replace the workers gracefully. The preloaded app is kept, so
+#         this does not pick up new code.
+#   USR2  start a new master with the new code next to the old one; once it serves, send
+#         TERM to the old master (its pid is in the .oldbin pid file) for a zero-downtime deploy.
+
+import os
+
+# Tell the app it is loaded before fork, so it leaves its background threads to the workers
+os.environ.setdefault("DEFER_BACKGROUND_THREADS", "1")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 4))
+preload_app = True
+
+# Sessions, rate limit buckets and cached documents are shared by the workers through SQLite files
+# unless set otherwise. Per-process sessions cannot work with several workers: a session created
+# by one worker would be unknown to the others, and its requests would get 401 at random.
+if workers > 1:
+    for setting in ("SESSION_BACKEND", "RATE_LIMIT_BACKEND", "TRAIL_CACHE_BACKEND"):
+        os.environ.setdefault(setting, "sqlite")
+    if os.environ["SESSION_BACKEND"] == "memory":
+        raise RuntimeError(f"SESSION_BACKEND=memory cannot be used with {workers} workers; use sqlite.")
+
+max_requests = int(os.environ.get("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", 1000))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+
+accesslog = os.environ.get("ACCESS_LOG", "-")
+pidfile = os.environ.get("PIDFILE")
+
+
+# A worker must not use the database connections of the master: drop the inherited pool without
+# closing its connections (the master still owns them), then start the background threads.
+# The worker's start-up time is measured from the fork.
+def post_fork(server, worker):
+    from config import app, db
+    from background import start_deferred_threads
+    from startup import startup_timer
+
+    startup_timer.restart()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    start_deferred_threads()
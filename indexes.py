@@ -0,0 +1,129 @@
+# indexes.py
+
+import threading
+import time
+from datetime import timedelta
+from sqlalchemy import select
+from background import start_thread
+from config import db
+from models import Trail, utc_now
+from serializers import IN_CHUNK_SIZE
+from signals import trails_changed
+from versions import TRAILS, collection_versions
+
+# Seconds between checks of the trails change counter for writes made by other worker processes
+REFRESH_INTERVAL = 2.0
+
+# Margin applied to updated_at when catching up, to allow for clock differences between workers
+CLOCK_SKEW = timedelta(seconds=5)
+
+
+# Base class for in-memory indexes over trails.
+# The index is built in a background thread at startup and kept current incrementally: trails changed
+# in this process arrive through the trails_changed signal, and trails changed by other workers are
+# picked up from their updated_at column when the trails change counter moves. The IDs of the
+# indexed trails are kept too, so trails deleted by other workers are dropped on refresh.
+# Subclasses define `columns` (trail_id first), `add(row)`, `remove(trail_id)` and `clear()`.
+class TrailIndex:
+
+    name = "trail index"
+    columns = (Trail.trail_id,)
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.ready = False
+        self.synced_version = None
+        self.synced_at = None
+        self.checked_at = 0.0
+        self.indexed_ids = set()
+
+    def init_app(self, app):
+        trails_changed.connect(self.on_trails_changed, weak=False)
+        if app.config.get("BUILD_INDEXES_AT_STARTUP", True):
+            start_thread(app, self.build_in_context, (app,), self.name)
+
+    def build_in_context(self, app):
+        with app.app_context():
+            try:
+                self.ensure_built()
+            except Exception:
+                app.logger.exception(f"Building the {self.name} failed; falling back to SQL until it is built")
+            finally:
+                db.session.remove()
+
+    # Statement loading index rows; subclasses override it to join related tables
+    def statement(self):
+        return select(*self.columns)
+
+    def build(self):
+        version = collection_versions(TRAILS)[0][0]
+        started_at = utc_now()
+        rows = db.session.execute(self.statement()).all()
+        with self.lock:
+            self.clear()
+            for row in rows:
+                self.add(row)
+            self.indexed_ids = {row.trail_id for row in rows}
+            self.synced_version = version
+            self.synced_at = started_at
+            self.ready = True
+
+    # Build the index unless it is already built; concurrent callers wait for a single build
+    def ensure_built(self):
+        with self.build_lock:
+            if not self.ready:
+                self.build()
+
+    # Re-read the given trails; trails that no longer exist are removed
+    def reindex(self, trail_ids):
+        trail_ids = list(trail_ids)
+        rows = []
+        for start in range(0, len(trail_ids), IN_CHUNK_SIZE):
+            chunk = trail_ids[start:start + IN_CHUNK_SIZE]
+            rows.extend(db.session.execute(self.statement().where(Trail.trail_id.in_(chunk))).all())
+        with self.lock:
+            for trail_id in trail_ids:
+                self.remove(trail_id)
+            self.indexed_ids.difference_update(trail_ids)
+            for row in rows:
+                self.add(row)
+            self.indexed_ids.update(row.trail_id for row in rows)
+
+    def on_trails_changed(self, sender, trail_ids):
+        if self.ready:
+            self.reindex(trail_ids)
+
+    # Catch up with writes made by other workers. Cheap when nothing changed: at most one
+    # counter lookup every REFRESH_INTERVAL seconds. When it moved, the trails updated since the
+    # last sync are re-read, and the indexed IDs are reconciled with the IDs in the table (one
+    # query reading trail IDs only): deleted trails are removed, and trails the updated_at window
+    # missed are added.
+    def refresh(self):
+        if not self.ready or time.monotonic() - self.checked_at < REFRESH_INTERVAL:
+            return
+        self.checked_at = time.monotonic()
+
+        version = collection_versions(TRAILS)[0][0]
+        if version == self.synced_version:
+            return
+
+        started_at = utc_now()
+        changed = set(db.session.execute(
+            select(Trail.trail_id).where(Trail.updated_at >= self.synced_at - CLOCK_SKEW)
+        ).scalars())
+        present = set(db.session.execute(select(Trail.trail_id)).scalars())
+        with self.lock:
+            changed |= self.indexed_ids ^ present
+        self.reindex(changed)
+        self.synced_version = version
+        self.synced_at = started_at
+
+    def clear(self):
+        raise NotImplementedError
+
+    def add(self, row):
+        raise NotImplementedError
+
+    def remove(self, trail_id):
+        raise NotImplementedError
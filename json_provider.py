@@ -0,0 +1,39 @@
+# json_provider.py
+
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is optional; without it the provider falls back to the standard library encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Flask JSON provider that encodes and decodes with orjson when it is installed.
+# Keys are written in the order they were built rather than sorted.
+class FastJSONProvider(DefaultJSONProvider):
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    # Encode straight to bytes, skipping the str round trip for response bodies and cached documents
+    def dumps_bytes(self, obj):
+        if orjson is None:
+            return super().dumps(obj).encode()
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
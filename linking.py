@@ -0,0 +1,163 @@
+# linking.py
+
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from config import db
+from models import Feature, TrailFeature
+from serializers import IN_CHUNK_SIZE
+
+# Longest feature name the features table accepts
+MAX_FEATURE_NAME_LENGTH = Feature.__table__.c.feature_name.type.length
+
+
+class FeatureNameError(ValueError):
+    pass
+
+
+# Normalise the feature_name value of a request body (a name or a list of names) into a list of
+# unique names in request order. Raises FeatureNameError for anything that is not a usable name.
+def feature_names_from(value):
+
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise FeatureNameError("Feature name or list of feature names is required.")
+
+    names = []
+    for name in value:
+        if not isinstance(name, str) or not name.strip():
+            raise FeatureNameError("Feature names must be non-empty strings.")
+        if len(name) > MAX_FEATURE_NAME_LENGTH:
+            raise FeatureNameError(f"Feature names must be at most {MAX_FEATURE_NAME_LENGTH} characters.")
+        names.append(name)
+    return list(dict.fromkeys(names))
+
+
+# Feature IDs of the names that exist, with one IN query per chunk of names
+def existing_feature_ids(names):
+
+    found = {}
+    for start in range(0, len(names), IN_CHUNK_SIZE):
+        rows = db.session.execute(
+            select(Feature.feature_name, Feature.feature_id)
+            .where(Feature.feature_name.in_(names[start:start + IN_CHUNK_SIZE]))
+        )
+        found.update(rows.all())
+    return found
+
+
+# Insert the features that do not exist yet with a single statement per chunk. Names inserted
+# concurrently by another request are skipped instead of violating the unique constraint.
+def insert_missing_features(names):
+
+    dialect = db.session.get_bind().dialect.name
+    for start in range(0, len(names), IN_CHUNK_SIZE):
+        chunk = names[start:start + IN_CHUNK_SIZE]
+        rows = [{"feature_name": name} for name in chunk]
+
+        if dialect == "sqlite":
+            db.session.execute(sqlite.insert(Feature).values(rows).on_conflict_do_nothing())
+        elif dialect == "postgresql":
+            db.session.execute(postgresql.insert(Feature).values(rows).on_conflict_do_nothing())
+        elif dialect == "mssql":
+            # MERGE with HOLDLOCK keeps the range locked between the match and the insert
+            values = ", ".join(f"(:name_{index})" for index in range(len(chunk)))
+            db.session.execute(
+                text(
+                    f"MERGE INTO {Feature.__table__.fullname} WITH (HOLDLOCK) AS target "
+                    f"USING (VALUES {values}) AS source (feature_name) "
+                    "ON target.feature_name = source.feature_name "
+                    "WHEN NOT MATCHED THEN INSERT (feature_name) VALUES (source.feature_name);"
+                ),
+                {f"name_{index}": name for index, name in enumerate(chunk)},
+            )
+        else:
+            # Other databases: insert the chunk, falling back to one name at a time on a conflict
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(Feature), rows)
+            except IntegrityError:
+                for row in rows:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.execute(insert(Feature), [row])
+                    except IntegrityError:
+                        pass
+
+
+# Map feature names to IDs, creating the missing features when create is set.
+# Returns {name: feature_id} for every name that exists afterwards.
+def resolve_features(names, create=True):
+
+    names = list(dict.fromkeys(names))
+    found = existing_feature_ids(names)
+    missing = [name for name in names if name not in found]
+    if missing and create:
+        insert_missing_features(missing)
+        found.update(existing_feature_ids(missing))
+    return found
+
+
+# Feature IDs currently linked to a trail
+def linked_feature_ids(trail_id):
+
+    return set(db.session.execute(
+        select(TrailFeature.feature_id).where(TrailFeature.trail_id == trail_id)
+    ).scalars())
+
+
+# Insert links between trails and features with one executemany per chunk.
+# links is a list of (trail_id, feature_id) pairs that do not exist yet.
+def insert_links(links):
+
+    for start in range(0, len(links), IN_CHUNK_SIZE):
+        db.session.execute(
+            insert(TrailFeature),
+            [{"trail_id": trail_id, "feature_id": feature_id} for trail_id, feature_id in links[start:start + IN_CHUNK_SIZE]],
+        )
+
+
+def delete_links(trail_id, feature_ids):
+
+    feature_ids = list(feature_ids)
+    for start in range(0, len(feature_ids), IN_CHUNK_SIZE):
+        db.session.execute(
+            delete(TrailFeature)
+            .where(TrailFeature.trail_id == trail_id)
+            .where(TrailFeature.feature_id.in_(feature_ids[start:start + IN_CHUNK_SIZE]))
+        )
+
+
+# The linking functions below work inside the caller's transaction and do not commit.
+# Each returns the IDs of the features whose links changed, for the change notifications.
+
+# Link a trail to features by name, creating features that do not exist yet
+def link_features(trail_id, names):
+
+    wanted = resolve_features(names).values()
+    linked = linked_feature_ids(trail_id)
+    added = [feature_id for feature_id in dict.fromkeys(wanted) if feature_id not in linked]
+    insert_links([(trail_id, feature_id) for feature_id in added])
+    return added
+
+
+# Unlink features from a trail by name; names that do not exist or are not linked are ignored
+def unlink_features(trail_id, names):
+
+    linked = linked_feature_ids(trail_id)
+    removed = [feature_id for feature_id in resolve_features(names, create=False).values() if feature_id in linked]
+    delete_links(trail_id, removed)
+    return removed
+
+
+# Make the trail's features exactly the given names, adding and removing only the differences
+def replace_features(trail_id, names):
+
+    wanted = set(resolve_features(names).values())
+    linked = linked_feature_ids(trail_id)
+    added = sorted(wanted - linked)
+    removed = sorted(linked - wanted)
+    insert_links([(trail_id, feature_id) for feature_id in added])
+    delete_links(trail_id, removed)
+    return added + removed
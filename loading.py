@@ -0,0 +1,68 @@
+# loading.py
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload
+from models import Trail, TrailFeature
+
+# Named eager-loading profiles. Each endpoint applies the profile for the data it serializes,
+# so a listing runs a fixed number of queries no matter how many rows it returns.
+LOADING_PROFILES = {
+    # Trails with feature names only (home page)
+    "trail_features": (
+        selectinload(Trail.features).joinedload(TrailFeature.feature),
+    ),
+}
+
+# Maximum number of SQL statements each endpoint may issue while loading and serializing.
+# Trail listings are read as column rows (see serializers.py): one query for the rows, one for their features.
+QUERY_BUDGETS = {
+    "trail_features": 2,
+    "trail_documents": 2,
+    "feature_documents": 3,
+}
+
+# Statement counter for the active query budget, if any
+_query_counter = ContextVar("query_counter", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# Apply a named loading profile to a query
+def apply_profile(query, profile):
+
+    return query.options(*LOADING_PROFILES[profile])
+
+
+# Count every statement sent to the database while a query budget is active
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+# Check that the block stays within its query budget.
+# Raises QueryBudgetExceeded when ENFORCE_QUERY_BUDGETS is set, otherwise logs a warning.
+@contextmanager
+def query_budget(name):
+
+    counter = [0]
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+    budget = QUERY_BUDGETS[name]
+    if counter[0] > budget:
+        message = f"'{name}' issued {counter[0]} queries (budget {budget})."
+        if current_app.config.get("ENFORCE_QUERY_BUDGETS"):
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
@@ -0,0 +1,150 @@
+# metrics.py
+
+import bisect
+import threading
+from collections import defaultdict
+
+# Process-wide counters, keyed by metric name and a sorted tuple of label pairs
+_counters = defaultdict(float)
+_counters_lock = threading.Lock()
+
+# Gauges are read on demand from callables registered by the modules that own the value
+_gauges = {}
+
+# Histograms, keyed like the counters: a count per bucket (the last one past every bound), sum and count
+_histograms = {}
+_histogram_buckets = {}
+
+# Upper bounds of a histogram registered without its own, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Add to a counter
+def inc(name, amount=1, **labels):
+
+    key = (name, tuple(sorted(labels.items())))
+    with _counters_lock:
+        _counters[key] += amount
+
+
+# Register a callable returning the current value of a gauge
+def register_gauge(name, read):
+
+    _gauges[name] = read
+
+
+# Set the bucket upper bounds of a histogram
+def register_histogram(name, buckets=DEFAULT_BUCKETS):
+
+    _histogram_buckets[name] = tuple(sorted(buckets))
+
+
+# Record a value in a histogram
+def observe(name, value, **labels):
+
+    buckets = _histogram_buckets.get(name, DEFAULT_BUCKETS)
+    index = bisect.bisect_left(buckets, value)
+    key = (name, tuple(sorted(labels.items())))
+    with _counters_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def _read_gauges():
+
+    result = {}
+    for name, read in _gauges.items():
+        try:
+            result[name] = read()
+        except Exception:
+            result[name] = None
+    return result
+
+
+def _copy_series():
+
+    with _counters_lock:
+        counters = dict(_counters)
+        histograms = {key: (list(counts), total, count) for key, (counts, total, count) in _histograms.items()}
+    return counters, histograms
+
+
+# Current value of every counter and gauge, and the count and sum of every histogram
+def snapshot():
+
+    counters, histograms = _copy_series()
+
+    result = {}
+    for (name, labels), value in counters.items():
+        label_text = ",".join(f"{key}={value}" for key, value in labels)
+        result[f"{name}{{{label_text}}}" if label_text else name] = value
+
+    for (name, labels), (_, total, count) in histograms.items():
+        label_text = ",".join(f"{key}={value}" for key, value in labels)
+        label_text = f"{{{label_text}}}" if label_text else ""
+        result[f"{name}_count{label_text}"] = count
+        result[f"{name}_sum{label_text}"] = total
+
+    result.update(_read_gauges())
+    return result
+
+
+def _label_value(value):
+
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _sample(name, labels, value):
+
+    label_text = ",".join(f'{key}="{_label_value(value)}"' for key, value in labels)
+    return f"{name}{{{label_text}}} {value!r}" if label_text else f"{name} {value!r}"
+
+
+# Name and labels of a gauge registered as name{key=value,...}
+def _split_gauge_name(name):
+
+    if not name.endswith("}") or "{" not in name:
+        return name, ()
+    name, label_text = name[:-1].split("{", 1)
+    return name, tuple(tuple(pair.split("=", 1)) for pair in label_text.split(",") if "=" in pair)
+
+
+# Every metric in the Prometheus text exposition format (version 0.0.4), served at /metrics.
+# Gauges reading None are left out; a gauge reading a string (a state) is exported as
+# name{state="value"} 1.
+def prometheus():
+
+    counters, histograms = _copy_series()
+    families = defaultdict(list)
+
+    for (name, labels), value in counters.items():
+        families[(name, "counter")].append(_sample(name, labels, float(value)))
+
+    for name, value in _read_gauges().items():
+        name, labels = _split_gauge_name(name)
+        if value is None:
+            continue
+        if isinstance(value, str):
+            labels, value = labels + (("state", value),), 1
+        families[(name, "gauge")].append(_sample(name, labels, float(value)))
+
+    for (name, labels), (counts, total, count) in histograms.items():
+        buckets = _histogram_buckets.get(name, DEFAULT_BUCKETS)
+        samples = families[(name, "histogram")]
+        cumulative = 0
+        for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            samples.append(_sample(f"{name}_bucket", labels + (("le", le),), float(cumulative)))
+        samples.append(_sample(f"{name}_sum", labels, float(total)))
+        samples.append(_sample(f"{name}_count", labels, float(count)))
+
+    lines = []
+    for (name, kind), samples in sorted(families.items()):
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(sorted(samples) if kind != "histogram" else samples)
+    return "\n".join(lines) + "\n"
@@ -1,7 +1,11 @@
 import pytz
-from config import db, ma
-from marshmallow.fields import Method, Integer
-from marshmallow_sqlalchemy import fields
+from datetime import datetime
+from config import db
+
+
+# Current UTC time, stored without a timezone
+def utc_now():
+    return datetime.now(pytz.utc).replace(tzinfo=None)
 
 
 # User Model
@@ -14,13 +18,14 @@ class User(db.Model):
     email = db.Column(db.String(150), nullable=False, unique=True)
     role = db.Column(db.String(50), nullable=False)
 
-    # Defines a one-to-many relationship between the User model and the Trail
+    # Defines a one-to-many relationship between the User model and the Trail.
+    # Loaded on demand; endpoints that need it apply a profile from loading.py.
     trails = db.relationship(
         'Trail',
         backref='owner',
         cascade="all, delete, delete-orphan",
         single_parent=True,
-        lazy='joined'
+        lazy='select'
     )
 
 
@@ -33,11 +38,11 @@ class Trail(db.Model):
     trail_name = db.Column(db.String(100), nullable=False, unique=True)
     trail_summary = db.Column(db.String(255), default="No summary provided.")
     trail_description = db.Column(db.String(255), default="No description provided.")
-    difficulty = db.Column(db.String(50), default="Unknown")
-    location = db.Column(db.String(150), default="Unknown")
+    difficulty = db.Column(db.String(50), default="Unknown", index=True)
+    location = db.Column(db.String(150), default="Unknown", index=True)
     length = db.Column(db.Float, default=0.0)
     elevation_gain = db.Column(db.Float, default=0.0)
-    route_type = db.Column(db.String(50), default="Unknown")
+    route_type = db.Column(db.String(50), default="Unknown", index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("CW2.users.user_id"), nullable=False)
 
     # Waypoints
@@ -53,6 +58,10 @@ class Trail(db.Model):
     pt3_long = db.Column(db.Float, nullable=True)
     pt3_desc = db.Column(db.String(255), nullable=True)
 
+    # Bumped on every change to the trail or its features; used for ETags (see versions.py)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+
     # Relationship to TrailFeature
     features = db.relationship(
         'TrailFeature',
@@ -83,69 +92,19 @@ class TrailFeature(db.Model):
     __table_args__ = {'schema': 'CW2'}
 
     trail_id = db.Column(db.Integer, db.ForeignKey("CW2.trails.trail_id"), primary_key=True)
-    feature_id = db.Column(db.Integer, db.ForeignKey("CW2.features.feature_id"), primary_key=True)
+    # Indexed on its own for usage counts and feature lookups (the primary key leads with trail_id)
+    feature_id = db.Column(db.Integer, db.ForeignKey("CW2.features.feature_id"), primary_key=True, index=True)
 
     # Define relationships
     trail = db.relationship('Trail', back_populates='features')
     feature = db.relationship('Feature', back_populates='trails')
 
 
-# User Schema
-class UserSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = User
-        load_instance = True
-        include_relationships = True
-
-    # Serializes the trails relationship
-    trails = fields.Nested("TrailSchema", exclude=("owner",), many=True)
-
-
-# Trail Schema
-class TrailSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = Trail
-        load_instance = True
-
-    waypoints = Method("get_waypoints")
-
-    def get_waypoints(self, obj):
-        return {
-            "pt1": {"lat": obj.pt1_lat, "long": obj.pt1_long, "desc": obj.pt1_desc},
-            "pt2": {"lat": obj.pt2_lat, "long": obj.pt2_long, "desc": obj.pt2_desc},
-            "pt3": {"lat": obj.pt3_lat, "long": obj.pt3_long, "desc": obj.pt3_desc},
-        }
-        
-    user_id = Integer(required=True)
-    owner = fields.Nested("UserSchema", exclude=("trails",))
-    features = fields.Nested("TrailFeatureSchema", many=True)
-
-
-# Feature Schema
-class FeatureSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = Feature
-        load_instance = True
-
-    trails = fields.Nested("TrailFeatureSchema", exclude=("feature",), many=True)
-
-
-# TrailFeature Schema
-class TrailFeatureSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = TrailFeature
-        load_instance = True
-
-    feature = fields.Nested("FeatureSchema", exclude=("trails",))
-    trail = fields.Nested("TrailSchema", exclude=("features", "owner", "waypoints"))
-
+# Change counter per resource collection ("trails", "features"), used for ETags (see versions.py)
+class ResourceVersion(db.Model):
+    __tablename__ = "resource_versions"
+    __table_args__ = {'schema': 'CW2'}
 
-# Create schema instances
-user_schema = UserSchema()
-users_schema = UserSchema(many=True)
-trail_schema = TrailSchema()
-trails_schema = TrailSchema(many=True)
-feature_schema = FeatureSchema()
-features_schema = FeatureSchema(many=True)
-trail_feature_schema = TrailFeatureSchema()
-trail_features_schema = TrailFeatureSchema(many=True)
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utc_now)
@@ -1,6 +1,9 @@
-from flask import request, jsonify
-from models import User
-from auth import logged_in_users
+from flask import g, request, jsonify
+from connexion.apis.flask_utils import flaskify_endpoint
+from sessions import session_store
+
+# HTTP methods an OpenAPI path item can declare operations for
+HTTP_METHODS = ("get", "put", "post", "delete", "options", "head", "patch", "trace")
 
 # Shared permissions
 SHARED_PERMISSIONS = [
@@ -26,6 +29,13 @@ ROLE_PERMISSIONS = {
     "user": SHARED_PERMISSIONS 
 }
 
+# Roles compiled to frozensets, so a permission check is one hash lookup
+ROLE_PERMISSION_SETS = {role: frozenset(permissions) for role, permissions in ROLE_PERMISSIONS.items()}
+
+# Roles allowed to call each protected operation, keyed by Flask endpoint name and by operationId (see init_app)
+ENDPOINT_ROLES = {}
+OPERATION_ROLES = {}
+
 # Retrieve the permissions associated with a given role.
 def get_permissions_for_role(role):
 
@@ -38,23 +48,63 @@ def get_user_from_request():
     if not session_id:
         return None, "User is not logged in."
 
-    # Match session ID to logged-in user
-    for email, user_data in logged_in_users.items():
-        if user_data["session_id"] == session_id:
-            return user_data, None
+    # Look up the session by its ID
+    user_data = session_store.get(session_id)
+    if user_data:
+        return user_data, None
 
     return None, "User is not logged in."
 
-# Check if the logged-in user has the required permission.
-def check_permission(required_permission):
+# The logged-in user's session data, or None. Resolved once per request and kept in flask.g.
+def current_user():
+
+    if "user" not in g:
+        g.user, _ = get_user_from_request()
+    return g.user
+
+# (Flask endpoint name, operation) pairs of every operation of an API added with connex_app.add_api
+def api_operations(api):
+
+    for path_item in api.specification.raw.get("paths", {}).values():
+        for method, operation in path_item.items():
+            if method in HTTP_METHODS:
+                yield f"{api.blueprint.name}.{flaskify_endpoint(operation['operationId'])}", operation
+
+# Register the permission hook for the operations of an API added with connex_app.add_api.
+# Each operation may declare the permission it needs with an x-permission extension; the
+# declarations are compiled once into the set of roles allowed for each endpoint.
+def init_app(app, api):
+
+    for endpoint, operation in api_operations(api):
+        if "x-permission" not in operation:
+            continue
+        permission = operation["x-permission"]
+        roles = frozenset(role for role, permissions in ROLE_PERMISSION_SETS.items() if permission in permissions)
+        if not roles:
+            raise ValueError(f"{operation['operationId']}: no role has the permission '{permission}'.")
+        ENDPOINT_ROLES[endpoint] = roles
+        OPERATION_ROLES[operation["operationId"]] = roles
+
+    app.before_request(authorize)
+
+# Reject the request unless the logged-in user's role may call the endpoint.
+# Runs before connexion validates the request and calls the handler.
+def authorize():
+
+    roles = ENDPOINT_ROLES.get(request.endpoint)
+    if roles is None:
+        return None
 
-    user, error = get_user_from_request()
+    error = role_error(roles, current_user())
     if error:
-        return None, {"error": error, "status_code": 401}
+        return jsonify({"error": error[0]}), error[1]
+    return None
 
-    # Get the user's permissions
-    user_permissions = ROLE_PERMISSIONS.get(user["role"], [])
-    if required_permission not in user_permissions:
-        return None, {"error": "Forbidden. You do not have permission to access this resource.", "status_code": 403}
+# (message, status code) if a user (session data or None) may not call an operation open to roles, otherwise None
+def role_error(roles, user):
 
-    return user, None
+    if user is None:
+        return "User is not logged in.", 401
+    if user["role"] not in roles:
+        return "Forbidden. You do not have permission to access this resource.", 403
+    return None
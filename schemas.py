@@ -0,0 +1,75 @@
+# schemas.py
+#
+# Marshmallow schemas of the models, kept for bench_serializer.py's comparison. Request bodies,
+# bulk rows included, are validated against swagger.yml (see validation.py). marshmallow-sqlalchemy
+# and the auto-schemas are slow to import and build, so nothing imports this module at startup.
+
+from flask_marshmallow import Marshmallow
+from marshmallow.fields import Method, Integer
+from marshmallow_sqlalchemy import fields
+from config import app
+from models import User, Trail, Feature, TrailFeature
+
+ma = Marshmallow(app)
+
+
+# User Schema
+class UserSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = User
+        load_instance = True
+        include_relationships = True
+
+    # Serializes the trails relationship
+    trails = fields.Nested("TrailSchema", exclude=("owner",), many=True)
+
+
+# Trail Schema
+class TrailSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Trail
+        load_instance = True
+        exclude = ("version", "updated_at")
+
+    waypoints = Method("get_waypoints")
+
+    def get_waypoints(self, obj):
+        return {
+            "pt1": {"lat": obj.pt1_lat, "long": obj.pt1_long, "desc": obj.pt1_desc},
+            "pt2": {"lat": obj.pt2_lat, "long": obj.pt2_long, "desc": obj.pt2_desc},
+            "pt3": {"lat": obj.pt3_lat, "long": obj.pt3_long, "desc": obj.pt3_desc},
+        }
+        
+    user_id = Integer(required=True)
+    owner = fields.Nested("UserSchema", exclude=("trails",))
+    features = fields.Nested("TrailFeatureSchema", many=True)
+
+
+# Feature Schema
+class FeatureSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Feature
+        load_instance = True
+
+    trails = fields.Nested("TrailFeatureSchema", exclude=("feature",), many=True)
+
+
+# TrailFeature Schema
+class TrailFeatureSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = TrailFeature
+        load_instance = True
+
+    feature = fields.Nested("FeatureSchema", exclude=("trails",))
+    trail = fields.Nested("TrailSchema", exclude=("features", "owner", "waypoints"))
+
+
+# Create schema instances
+user_schema = UserSchema()
+users_schema = UserSchema(many=True)
+trail_schema = TrailSchema()
+trails_schema = TrailSchema(many=True)
+feature_schema = FeatureSchema()
+features_schema = FeatureSchema(many=True)
+trail_feature_schema = TrailFeatureSchema()
+trail_features_schema = TrailFeatureSchema(many=True)
@@ -0,0 +1,206 @@
+# serializers.py
+
+from functools import lru_cache
+from sqlalchemy import select
+from config import db
+from models import Trail, User, Feature, TrailFeature
+
+# Public wire format of a trail: output field -> source column
+TRAIL_FIELDS = {
+    "trail_id": Trail.trail_id,
+    "trail_name": Trail.trail_name,
+    "trail_summary": Trail.trail_summary,
+    "trail_description": Trail.trail_description,
+    "difficulty": Trail.difficulty,
+    "location": Trail.location,
+    "length": Trail.length,
+    "elevation_gain": Trail.elevation_gain,
+    "route_type": Trail.route_type,
+    "user_id": Trail.user_id,
+}
+
+# Waypoints are stored as flat columns and published as nested objects
+WAYPOINT_FIELDS = {
+    "pt1": {"lat": Trail.pt1_lat, "long": Trail.pt1_long, "desc": Trail.pt1_desc},
+    "pt2": {"lat": Trail.pt2_lat, "long": Trail.pt2_long, "desc": Trail.pt2_desc},
+    "pt3": {"lat": Trail.pt3_lat, "long": Trail.pt3_long, "desc": Trail.pt3_desc},
+}
+
+# Owner of the trail
+OWNER_FIELDS = {
+    "user_id": User.user_id,
+    "username": User.username,
+    "email": User.email,
+    "role": User.role,
+}
+
+# Trail fields returned by the feature search
+SEARCH_FIELDS = (
+    "trail_name", "difficulty", "location", "length", "elevation_gain",
+    "route_type", "trail_summary", "trail_description",
+)
+
+# Related data that can be requested with ?include=
+INCLUDES = ("waypoints", "owner", "features")
+
+# Upper bound on IN list sizes (MSSQL allows about 2100 parameters per statement)
+IN_CHUNK_SIZE = 1000
+
+
+# Statements reading the feature names of trails, one per chunk of trail IDs
+def feature_names_statements(trail_ids):
+
+    for start in range(0, len(trail_ids), IN_CHUNK_SIZE):
+        yield (
+            select(TrailFeature.trail_id, Feature.feature_name)
+            .join(Feature, Feature.feature_id == TrailFeature.feature_id)
+            .where(TrailFeature.trail_id.in_(trail_ids[start:start + IN_CHUNK_SIZE]))
+        )
+
+
+# Add (trail_id, feature_name) rows to a dictionary of feature names by trail
+def collect_feature_names(names, rows):
+
+    for trail_id, feature_name in rows:
+        names.setdefault(trail_id, []).append({"feature_name": feature_name})
+    return names
+
+
+# Feature names linked to each trail, loaded with one query per chunk of trail IDs
+def feature_names_by_trail(trail_ids):
+
+    names = {}
+    for statement in feature_names_statements(trail_ids):
+        collect_feature_names(names, db.session.execute(statement))
+    return names
+
+
+# Serializes trails straight from column-tuple rows into the public wire format.
+# The row layout and the encoding function are generated once per field selection.
+class TrailSerializer:
+
+    def __init__(self, fields, waypoints=True, owner=True, features=True):
+        self.owner = owner
+        self.features = features
+
+        # Canonical description of the selection, used in cache keys and ETags
+        includes = [name for name, wanted in zip(INCLUDES, (waypoints, owner, features)) if wanted]
+        self.fieldset = ",".join(fields) + ";" + ",".join(includes)
+
+        # trail_id is always selected first so features can be matched to their trail
+        self.columns = [Trail.trail_id]
+        members = []
+
+        def column_index(column):
+            for index, selected in enumerate(self.columns):
+                if selected is column:
+                    return index
+            self.columns.append(column)
+            return len(self.columns) - 1
+
+        for field in fields:
+            members.append(f"{field!r}: row[{column_index(TRAIL_FIELDS[field])}]")
+
+        if waypoints:
+            points = []
+            for point, parts in WAYPOINT_FIELDS.items():
+                inner = ", ".join(f"{part!r}: row[{column_index(column)}]" for part, column in parts.items())
+                points.append(f"{point!r}: {{{inner}}}")
+            members.append(f"'waypoints': {{{', '.join(points)}}}")
+
+        if owner:
+            inner = ", ".join(f"{field!r}: row[{column_index(column)}]" for field, column in OWNER_FIELDS.items())
+            members.append(f"'owner': {{{inner}}}")
+
+        if features:
+            members.append("'features': features.get(row[0], [])")
+
+        # Generate a function building the document with a single dict display
+        source = f"def encode(row, features):\n    return {{{', '.join(members)}}}\n"
+        namespace = {}
+        exec(compile(source, "<trail serializer>", "exec"), namespace)
+        self.encode = namespace["encode"]
+
+    # SELECT statement for the columns this serializer reads
+    def statement(self):
+        statement = select(*self.columns).select_from(Trail)
+        if self.owner:
+            statement = statement.join(User, User.user_id == Trail.user_id)
+        return statement
+
+    # Encode a batch of rows, loading the features of the whole batch in one query
+    def documents(self, rows):
+        features = feature_names_by_trail([row[0] for row in rows]) if self.features else {}
+        encode = self.encode
+        return [encode(row, features) for row in rows]
+
+    # Encode the trails of a statement ordered by trail_id, batch_size rows at a time. Each batch is
+    # a keyset page read in full before its features are loaded, so no result set is left open
+    # while the next statement runs (SQL Server connections without MARS allow only one).
+    def iter_documents(self, statement, batch_size):
+        after = None
+        while True:
+            page = statement if after is None else statement.where(Trail.trail_id > after)
+            rows = db.session.execute(page.limit(batch_size)).all()
+            yield from self.documents(rows)
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+
+# Serializer for a field selection, compiled on first use
+@lru_cache(maxsize=64)
+def trail_serializer(fields=tuple(TRAIL_FIELDS), waypoints=True, owner=True, features=True):
+
+    return TrailSerializer(fields, waypoints=waypoints, owner=owner, features=features)
+
+
+class FieldsetError(ValueError):
+    pass
+
+
+# Split a comma separated query parameter into names
+def split_names(value):
+
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+# Serializer for the sparse fieldset requested with ?fields= and ?include=.
+# Without either parameter the default fields and related data are returned. Once either is given,
+# only what was asked for is selected: relationships not requested are not read at all.
+# Related data can also be named in ?fields= (e.g. fields=trail_name,features).
+def fieldset_serializer(fields=None, include=None, default_fields=tuple(TRAIL_FIELDS), default_include=INCLUDES):
+
+    fields = split_names(fields)
+    include = split_names(include)
+    if fields is None and include is None:
+        fields, include = default_fields, default_include
+
+    selected = set()
+    included = set()
+    for name in fields if fields is not None else default_fields:
+        if name in INCLUDES:
+            included.add(name)
+        elif name in TRAIL_FIELDS:
+            selected.add(name)
+        else:
+            raise FieldsetError(f"Unknown field '{name}'.")
+    for name in include or ():
+        if name not in INCLUDES:
+            raise FieldsetError(f"Unknown include '{name}'. Expected one of: {', '.join(INCLUDES)}.")
+        included.add(name)
+
+    return trail_serializer(
+        tuple(field for field in TRAIL_FIELDS if field in selected),
+        waypoints="waypoints" in included,
+        owner="owner" in included,
+        features="features" in included,
+    )
+
+
+# Serializer for the trails returned by the feature search
+def search_serializer(fields=None, include=None):
+
+    return fieldset_serializer(fields, include, default_fields=SEARCH_FIELDS, default_include=("waypoints", "features"))
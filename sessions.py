@@ -0,0 +1,207 @@
+# sessions.py
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import metrics
+from background import start_thread
+
+# A session's expiry is pushed back on use, but at most once per this many seconds, so the
+# shared backend is not written on every request
+TOUCH_INTERVAL = 60
+
+
+# In-process backend: sessions keyed by session_id, with an email index for re-login and status checks
+class MemoryBackend:
+
+    blocking = False
+
+    def __init__(self, ttl=3600, **options):
+        self.ttl = ttl
+        self.sessions = {}
+        self.by_email = {}
+        self.lock = threading.Lock()
+
+    def create(self, session_id, data):
+        with self.lock:
+            previous = self.by_email.pop(data["email"], None)
+            if previous is not None:
+                self.sessions.pop(previous, None)
+            self.sessions[session_id] = [data, time.monotonic() + self.ttl]
+            self.by_email[data["email"]] = session_id
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return None
+            now = time.monotonic()
+            if entry[1] < now:
+                self.remove(session_id)
+                return None
+            entry[1] = now + self.ttl
+            return entry[0]
+
+    def get_by_email(self, email):
+        with self.lock:
+            session_id = self.by_email.get(email)
+        return self.get(session_id) if session_id is not None else None
+
+    def delete(self, session_id):
+        with self.lock:
+            return self.remove(session_id)
+
+    # Remove one session and return its data; the caller holds the lock
+    def remove(self, session_id):
+        entry = self.sessions.pop(session_id, None)
+        if entry is None:
+            return None
+        if self.by_email.get(entry[0]["email"]) == session_id:
+            del self.by_email[entry[0]["email"]]
+        return entry[0]
+
+    def sweep(self):
+        with self.lock:
+            now = time.monotonic()
+            expired = [session_id for session_id, (_, expires) in self.sessions.items() if expires < now]
+            for session_id in expired:
+                self.remove(session_id)
+        return len(expired)
+
+    def size(self):
+        return len(self.sessions)
+
+
+# Shared backend: an SQLite file every worker process on the host opens, so a session created by
+# one worker is valid in all of them
+class SQLiteBackend:
+
+    blocking = True
+
+    def __init__(self, path, ttl=3600, **options):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, email TEXT NOT NULL, "
+            "data TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_email ON sessions (email)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    # One connection per thread; SQLite connections cannot be shared between threads
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def create(self, session_id, data):
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM sessions WHERE email = ?", (data["email"],))
+            conn.execute(
+                "INSERT INTO sessions (session_id, email, data, expires) VALUES (?, ?, ?, ?)",
+                (session_id, data["email"], json.dumps(data), time.time() + self.ttl),
+            )
+
+    def get(self, session_id):
+        conn = self.connect()
+        row = conn.execute("SELECT data, expires FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return self.live(conn, session_id, row)
+
+    def get_by_email(self, email):
+        conn = self.connect()
+        row = conn.execute("SELECT session_id, data, expires FROM sessions WHERE email = ?", (email,)).fetchone()
+        return self.live(conn, row[0], row[1:]) if row else None
+
+    # Data of a looked-up session row if it has not expired, sliding its expiry
+    def live(self, conn, session_id, row):
+        if row is None:
+            return None
+        data, expires = row
+        now = time.time()
+        if expires < now:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            return None
+        if expires - now < self.ttl - TOUCH_INTERVAL:
+            conn.execute("UPDATE sessions SET expires = ? WHERE session_id = ?", (now + self.ttl, session_id))
+        return json.loads(data)
+
+    def delete(self, session_id):
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return json.loads(row[0]) if row else None
+
+    def sweep(self):
+        return self.connect().execute("DELETE FROM sessions WHERE expires < ?", (time.time(),)).rowcount
+
+    def size(self):
+        return self.connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+# Backend names accepted by the SESSION_BACKEND setting
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+# Logged-in users by session ID. Lookups cost the same however many users are logged in.
+# Sessions expire after SESSION_TTL seconds without use; a background thread sweeps expired ones.
+# A user has one session at a time: logging in again replaces the previous session.
+class SessionStore:
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        self.backend = BACKENDS[app.config["SESSION_BACKEND"]](
+            path=app.config["SESSION_PATH"],
+            ttl=app.config["SESSION_TTL"],
+        )
+        metrics.register_gauge("sessions_active", self.backend.size)
+        start_thread(app, self.sweep_loop, (app, app.config["SESSION_SWEEP_INTERVAL"]), "session sweep")
+
+    def sweep_loop(self, app, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                metrics.inc("sessions_expired", self.backend.sweep())
+            except Exception:
+                app.logger.exception("Sweeping expired sessions failed")
+
+    # Store a session for a user and return its ID. data holds user_id, email and role.
+    def create(self, data, session_id=None):
+        session_id = session_id or str(uuid.uuid4())
+        self.backend.create(session_id, dict(data, session_id=session_id))
+        return session_id
+
+    # Session data for a session ID, or None if it is unknown or expired
+    def get(self, session_id):
+        if not session_id:
+            return None
+        return self.backend.get(session_id)
+
+    # Session data of a user's current session, or None
+    def get_by_email(self, email):
+        if not email:
+            return None
+        return self.backend.get_by_email(email)
+
+    # Remove a session and return its data, or None if there was none
+    def delete(self, session_id):
+        return self.backend.delete(session_id)
+
+
+session_store = SessionStore()
@@ -0,0 +1,31 @@
+# signals.py
+
+from blinker import Namespace
+from flask import current_app
+
+# Change notifications sent by the write paths once their transaction has committed (see
+# versions.commit_changes, which bumps the change counters inside that transaction).
+# Caches and in-memory indexes subscribe to these instead of being called from every handler.
+change_signals = Namespace()
+
+# Sent with trail_ids: trails created, updated, deleted or relinked to features
+trails_changed = change_signals.signal("trails-changed")
+
+# Sent with feature_ids: features created, renamed, deleted or linked to / unlinked from trails
+features_changed = change_signals.signal("features-changed")
+
+
+# Announce that the given trails have changed
+def notify_trails_changed(trail_ids):
+
+    trail_ids = [trail_id for trail_id in trail_ids if trail_id is not None]
+    if trail_ids:
+        trails_changed.send(current_app._get_current_object(), trail_ids=trail_ids)
+
+
+# Announce that the given features have changed
+def notify_features_changed(feature_ids):
+
+    feature_ids = [feature_id for feature_id in feature_ids if feature_id is not None]
+    if feature_ids:
+        features_changed.send(current_app._get_current_object(), feature_ids=feature_ids)
@@ -0,0 +1,163 @@
+# spatial.py
+
+import math
+from sqlalchemy import and_, or_, select
+from config import db
+from indexes import TrailIndex
+from models import Trail
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+# Size of a grid cell in degrees (about 28 km north-south)
+CELL_SIZE = 0.25
+
+# Waypoint coordinate columns, in the order they are selected
+WAYPOINT_COLUMNS = (
+    (Trail.pt1_lat, Trail.pt1_long),
+    (Trail.pt2_lat, Trail.pt2_long),
+    (Trail.pt3_lat, Trail.pt3_long),
+)
+
+
+# Great-circle distance between two points in kilometres
+def haversine_km(lat1, long1, lat2, long2):
+
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Bounding box (min_lat, min_long, max_lat, max_long) enclosing a circle
+def bounding_box(lat, long, radius_km):
+
+    lat_delta = radius_km / KM_PER_DEGREE_LAT
+    cos_lat = math.cos(math.radians(lat))
+    long_delta = 180.0 if cos_lat < 1e-6 else min(180.0, radius_km / (KM_PER_DEGREE_LAT * cos_lat))
+    return (max(-90.0, lat - lat_delta), long - long_delta, min(90.0, lat + lat_delta), long + long_delta)
+
+
+# Waypoints of a row selected with WAYPOINT_COLUMNS after the trail_id
+def row_points(row):
+
+    points = []
+    for index in range(len(WAYPOINT_COLUMNS)):
+        lat, long = row[1 + 2 * index], row[2 + 2 * index]
+        if lat is not None and long is not None:
+            points.append((lat, long))
+    return points
+
+
+def cell_of(lat, long):
+
+    return int(math.floor(lat / CELL_SIZE)), int(math.floor(long / CELL_SIZE))
+
+
+# Grid index over every trail waypoint: each cell holds the trail IDs with a waypoint inside it
+class SpatialIndex(TrailIndex):
+
+    name = "spatial index"
+    columns = (Trail.trail_id,) + tuple(column for pair in WAYPOINT_COLUMNS for column in pair)
+
+    def __init__(self):
+        super().__init__()
+        self.cells = {}
+        self.points = {}
+
+    def clear(self):
+        self.cells = {}
+        self.points = {}
+
+    def add(self, row):
+        points = row_points(row)
+        if not points:
+            return
+        self.points[row.trail_id] = points
+        for lat, long in points:
+            self.cells.setdefault(cell_of(lat, long), set()).add(row.trail_id)
+
+    def remove(self, trail_id):
+        for lat, long in self.points.pop(trail_id, ()):
+            cell = self.cells.get(cell_of(lat, long))
+            if cell is not None:
+                cell.discard(trail_id)
+                if not cell:
+                    del self.cells[cell_of(lat, long)]
+
+    # Trail IDs with a waypoint in the cells overlapping a box, and their waypoints
+    def candidates(self, min_lat, min_long, max_lat, max_long):
+        (low_y, low_x), (high_y, high_x) = cell_of(min_lat, min_long), cell_of(max_lat, max_long)
+        with self.lock:
+            found = set()
+            # Scan whichever is smaller: the cells covering the box or the occupied cells
+            if (high_y - low_y + 1) * (high_x - low_x + 1) <= len(self.cells):
+                for y in range(low_y, high_y + 1):
+                    for x in range(low_x, high_x + 1):
+                        found.update(self.cells.get((y, x), ()))
+            else:
+                for (y, x), trail_ids in self.cells.items():
+                    if low_y <= y <= high_y and low_x <= x <= high_x:
+                        found.update(trail_ids)
+            return {trail_id: self.points[trail_id] for trail_id in found}
+
+
+spatial_index = SpatialIndex()
+
+
+# Waypoints of trails with a waypoint inside a box, read with an SQL bounding-box filter
+def sql_candidates(min_lat, min_long, max_lat, max_long):
+
+    inside = [
+        and_(lat.between(min_lat, max_lat), long.between(min_long, max_long))
+        for lat, long in WAYPOINT_COLUMNS
+    ]
+    rows = db.session.execute(select(*SpatialIndex.columns).where(or_(*inside))).all()
+    return {row.trail_id: row_points(row) for row in rows}
+
+
+# Split a box crossing the antimeridian into boxes within -180..180 degrees of longitude
+def split_box(min_lat, min_long, max_lat, max_long):
+
+    if max_long - min_long >= 360:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    if min_long < -180:
+        return [(min_lat, min_long + 360, max_lat, 180.0), (min_lat, -180.0, max_lat, max_long)]
+    if max_long > 180:
+        return [(min_lat, min_long, max_lat, 180.0), (min_lat, -180.0, max_lat, max_long - 360)]
+    return [(min_lat, min_long, max_lat, max_long)]
+
+
+# Waypoints of trails near a box, from the index when it is built and from SQL while it is cold
+def box_candidates(min_lat, min_long, max_lat, max_long):
+
+    spatial_index.refresh()
+    found = {}
+    for box in split_box(min_lat, min_long, max_lat, max_long):
+        if spatial_index.ready:
+            found.update(spatial_index.candidates(*box))
+        else:
+            found.update(sql_candidates(*box))
+    return found
+
+
+# (distance_km, trail_id) of the nearest trails with a waypoint within radius_km, nearest first
+def trails_near(lat, long, radius_km, limit):
+
+    nearest = []
+    for trail_id, points in box_candidates(*bounding_box(lat, long, radius_km)).items():
+        distance = min(haversine_km(lat, long, point_lat, point_long) for point_lat, point_long in points)
+        if distance <= radius_km:
+            nearest.append((distance, trail_id))
+    nearest.sort()
+    return nearest[:limit]
+
+
+# IDs of trails with a waypoint inside a box, in trail ID order
+def trails_within(min_lat, min_long, max_lat, max_long):
+
+    found = []
+    for trail_id, points in box_candidates(min_lat, min_long, max_lat, max_long).items():
+        if any(min_lat <= point_lat <= max_lat and min_long <= point_long <= max_long for point_lat, point_long in points):
+            found.append(trail_id)
+    found.sort()
+    return found
@@ -0,0 +1,158 @@
+# spec_cache.py
+#
+# Cache of the parsed and validated OpenAPI document. Parsing swagger.yml and validating it against
+# the OpenAPI schema is most of the time connexion's add_api takes; the cache file holds the
+# rendered document as JSON under a hash of swagger.yml and the connexion version, and while the
+# hash matches the document is loaded from it without being parsed or validated again. Any change
+# to swagger.yml or an upgrade of connexion misses the cache, and the next start rebuilds it.
+#
+# Build the cache ahead of time (the Dockerfile does) with:
+#
+#   python spec_cache.py [swagger.yml] [cache file]
+
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import connexion
+import jinja2
+import yaml
+from connexion.apis.flask_api import FlaskApi
+from connexion.options import ConnexionOptions
+from connexion.resolver import Resolver
+from connexion.spec import OpenAPISpecification, Specification
+import metrics
+
+# Bump when the cache file layout changes
+CACHE_FORMAT = 1
+
+# libyaml's loader when PyYAML was built with it, at a tenth of the pure Python loader's time
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def spec_digest(contents):
+
+    digest = hashlib.sha256(contents)
+    digest.update(f"|{connexion.__version__}|{CACHE_FORMAT}".encode())
+    return digest.hexdigest()
+
+
+# Render and parse the document the way connexion does for a file
+def parse_spec(contents):
+
+    return yaml.load(jinja2.Template(contents.decode("utf-8", "replace")).render(), Loader=YAML_LOADER)
+
+
+# The document for swagger_path and whether it is known to be valid (read from a current cache)
+def load_spec(swagger_path, cache_path):
+
+    contents = pathlib.Path(swagger_path).read_bytes()
+    digest = spec_digest(contents)
+    if cache_path:
+        try:
+            cached = json.loads(pathlib.Path(cache_path).read_bytes())
+            if cached["digest"] == digest:
+                metrics.inc("spec_cache", outcome="hit")
+                return cached["spec"], digest, True
+        except (OSError, ValueError, KeyError):
+            pass
+    metrics.inc("spec_cache", outcome="miss")
+    return parse_spec(contents), digest, False
+
+
+# Write the cache file atomically, so a worker starting at the same time never reads half of it
+def write_cache(cache_path, spec, digest):
+
+    cache_path = pathlib.Path(cache_path)
+    fd, temp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f".{cache_path.name}.")
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            json.dump({"digest": digest, "spec": spec}, temp_file)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+# The document of a current cache. It was validated when the cache was written, so it is not
+# validated again, neither at start-up nor when /openapi.json clones it.
+class PrevalidatedSpecification(OpenAPISpecification):
+
+    @classmethod
+    def _validate_spec(cls, spec):
+        pass
+
+
+# FlaskApi registering a PrevalidatedSpecification. AbstractAPI.__init__ always loads the
+# document through Specification.load, which validates it, so the first step of that __init__
+# is redone here and the rest is the same (connexion 2.14).
+class PrevalidatedApi(FlaskApi):
+
+    def __init__(self, specification, base_path=None, arguments=None, validate_responses=False,
+                 strict_validation=False, resolver=None, auth_all_paths=False, debug=False,
+                 resolver_error_handler=None, validator_map=None, pythonic_params=False,
+                 pass_context_arg_name=None, options=None):
+        self.debug = debug
+        self.validator_map = validator_map
+        self.resolver_error_handler = resolver_error_handler
+        self.specification = PrevalidatedSpecification(specification)
+        self.options = ConnexionOptions(options, oas_version=self.specification.version)
+        self._set_base_path(base_path)
+        self.resolver = resolver or Resolver()
+        self.validate_responses = validate_responses
+        self.strict_validation = strict_validation
+        self.pythonic_params = pythonic_params
+        self.pass_context_arg_name = pass_context_arg_name
+        self.security_handler_factory = self.make_security_handler_factory(pass_context_arg_name)
+
+        if self.options.openapi_spec_available:
+            self.add_openapi_json()
+            self.add_openapi_yaml()
+        if self.options.openapi_console_ui_available:
+            self.add_swagger_ui()
+        self.add_paths()
+        if auth_all_paths:
+            self.add_auth_on_not_found(self.specification.security, self.specification.security_definitions)
+
+
+# connex_app.add_api for swagger_path, through the cache at cache_path (None to parse every time).
+# Only the document is cached: the operations, their validators and routes are still built from
+# it on every start.
+def add_api(connex_app, swagger_path, cache_path, **options):
+
+    spec, digest, valid = load_spec(swagger_path, cache_path)
+    if valid and spec.get("openapi", "").startswith("3."):
+        api_cls = connex_app.api_cls
+        connex_app.api_cls = PrevalidatedApi
+        try:
+            return connex_app.add_api(spec, **options)
+        finally:
+            connex_app.api_cls = api_cls
+
+    api = connex_app.add_api(spec, **options)
+    if cache_path:
+        try:
+            write_cache(cache_path, spec, digest)
+        except OSError as err:
+            connex_app.app.logger.warning(f"Could not write the OpenAPI cache {cache_path}: {err}")
+    return api
+
+
+if __name__ == "__main__":
+    basedir = pathlib.Path(__file__).parent.resolve()
+    swagger_path = sys.argv[1] if len(sys.argv) > 1 else basedir / "swagger.yml"
+    cache_path = sys.argv[2] if len(sys.argv) > 2 else os.environ.get("SPEC_CACHE_PATH", basedir / "swagger.cache.json")
+
+    spec, digest, valid = load_spec(swagger_path, cache_path)
+    if valid:
+        print(f"{cache_path} is current ({digest[:12]})")
+    else:
+        # Validates the document; raises InvalidSpecification with the first error
+        Specification.from_dict(spec)
+        write_cache(cache_path, spec, digest)
+        print(f"Wrote {cache_path} ({digest[:12]})")
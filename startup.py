@@ -0,0 +1,62 @@
+# startup.py
+
+import os
+import threading
+import time
+import metrics
+
+
+# Wall-clock time the process started. Linux records it in /proc; elsewhere the import of this
+# module, early in app.py, is the nearest point available.
+def process_start_time():
+
+    try:
+        with open("/proc/self/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return time.time() - uptime + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+# Seconds from process start to the app being ready to serve (imports, spec, indexes set up) and
+# to the first request reaching it, served at /stats as startup_ready_seconds and
+# startup_first_request_seconds. In a worker forked from a preloaded app both are measured from
+# the fork (see gunicorn.conf.py).
+class StartupTimer:
+
+    def __init__(self):
+        self.started = process_start_time()
+        self.ready = None
+        self.first_request = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        metrics.register_gauge("startup_ready_seconds", lambda: self.elapsed(self.ready))
+        metrics.register_gauge("startup_first_request_seconds", lambda: self.elapsed(self.first_request))
+        app.before_request(self.request_started)
+
+    def elapsed(self, moment):
+        return None if moment is None else round(moment - self.started, 3)
+
+    def mark_ready(self):
+        self.ready = time.time()
+
+    def request_started(self):
+        if self.first_request is None:
+            with self.lock:
+                if self.first_request is None:
+                    self.first_request = time.time()
+                    self.app.logger.info(f"First request {self.elapsed(self.first_request)}s after start")
+
+    # Called in a freshly forked worker: it starts now, with the app ready if it was preloaded
+    def restart(self):
+        self.started = time.time()
+        if self.ready is not None:
+            self.ready = self.started
+        self.first_request = None
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,74 @@
+# streaming.py
+
+from flask import Response, current_app, request, stream_with_context
+from telemetry import request_telemetry
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Last line of an NDJSON stream cut short by an error, so that clients can tell it is incomplete
+STREAM_ERROR = {"error": "The response was cut short by a server error."}
+
+# Number of rows pulled from the database cursor at a time when streaming
+STREAM_BATCH_SIZE = 500
+
+
+# Check whether the client asked for a streamed response, via ?stream=1 or an NDJSON Accept header
+def wants_stream(stream=0):
+
+    return bool(stream) or wants_ndjson()
+
+
+# Check whether the client explicitly accepts NDJSON
+def wants_ndjson():
+
+    return any(mimetype == NDJSON_MIMETYPE for mimetype, quality in request.accept_mimetypes if quality > 0)
+
+
+# Stream documents as newline-delimited JSON, one encoded object per line.
+# An error after the response has started ends the stream with a STREAM_ERROR line.
+def ndjson_response(documents):
+
+    def generate():
+        dumps = current_app.json.dumps_bytes
+        try:
+            for document in documents:
+                yield dumps(document) + b"\n"
+        except Exception as e:
+            request_telemetry.record_error(e)
+            yield dumps(STREAM_ERROR) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+# Stream a JSON object whose list field is written item by item as documents are encoded.
+# `envelope` holds the other fields of the object; `field` names the streamed list. An error after
+# the response has started leaves the object unclosed, so the truncated body does not parse.
+def json_stream_response(documents, field, envelope=None):
+
+    def generate():
+        dumps = current_app.json.dumps_bytes
+        members = [dumps(key) + b":" + dumps(value) for key, value in (envelope or {}).items()]
+        members.append(dumps(field) + b":[")
+        opening = b"{" + b",".join(members)
+        closing = b"]}"
+
+        yield opening
+        try:
+            first = True
+            for document in documents:
+                yield (b"" if first else b",") + dumps(document)
+                first = False
+        except Exception as e:
+            request_telemetry.record_error(e)
+            return
+        yield closing
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+# Stream documents in the format the client asked for
+def stream_response(documents, field, envelope=None):
+
+    if wants_ndjson():
+        return ndjson_response(documents)
+    return json_stream_response(documents, field, envelope)
@@ -0,0 +1,61 @@
+# stub_auth_server.py
+#
+# Stand-in for the university authentication service, so logins can be load-tested offline.
+# Answers POSTs of {"email", "password"} the way the real service does: ["Verified", "True"]
+# or ["Verified", "False"]. Any email is accepted with the configured password. Latency and
+# failures can be injected to exercise the timeouts and the circuit breaker in auth_client.py.
+#
+#   python stub_auth_server.py [--port 8001] [--password secret] [--delay 0.05] [--fail-rate 0.1]
+#   AUTH_URL=http://127.0.0.1:8001/users python app.py
+
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubAuthHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.options.delay:
+            time.sleep(self.options.delay)
+        if random.random() < self.options.fail_rate:
+            return self.reply(503, {"error": "Injected failure"})
+
+        try:
+            credentials = json.loads(body)
+        except ValueError:
+            return self.reply(400, {"error": "Invalid JSON"})
+        verified = bool(credentials.get("email")) and credentials.get("password") == self.options.password
+        self.reply(200, ["Verified", "True" if verified else "False"])
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            super().log_message(format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub authentication service for offline load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--password", default="password", help="password accepted for every email")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--quiet", action="store_true", help="do not log each request")
+    StubAuthHandler.options = parser.parse_args()
+
+    server = ThreadingHTTPServer((StubAuthHandler.options.host, StubAuthHandler.options.port), StubAuthHandler)
+    print(f"Stub auth server on http://{server.server_address[0]}:{server.server_address[1]}/")
+    server.serve_forever()
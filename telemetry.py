@@ -0,0 +1,158 @@
+# telemetry.py
+#
+# Per-request latency, SQL accounting and error counts, exported with the other metrics at
+# /metrics. Every request is timed under the operationId it resolved to; every statement sent to
+# a database is timed through the engine events and charged to the request running it (the
+# ContextVar follows a request through its thread, or its task in ASGI mode). Statement time is
+# the time spent in cursor.execute: rows fetched afterwards are not included. Statements slower
+# than SLOW_QUERY_THRESHOLD are logged with the operation that issued them.
+#
+# The cost is two clock reads per statement and a few counter updates per request, so it stays
+# on in production.
+
+import time
+from contextvars import ContextVar
+from connexion.exceptions import ProblemException
+from flask import got_request_exception, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+import metrics
+import permissions
+
+# Upper bounds of the statements-per-request histogram
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Longest part of a slow statement written to the log
+SLOW_QUERY_LOG_LENGTH = 1000
+
+# Body of a 500 for an exception a handler caught. The exception itself is only logged: its text
+# can hold SQL statements and their parameters.
+SERVER_ERROR_MESSAGE = "An internal error occurred."
+
+# Operation label of requests that matched no route, and of work done outside a request
+UNMATCHED = "unmatched"
+BACKGROUND = "background"
+
+# The request being served, if any
+_current_request = ContextVar("current_request", default=None)
+
+
+def current_operation():
+
+    state = _current_request.get()
+    return state.operation if state is not None else BACKGROUND
+
+
+class RequestState:
+
+    __slots__ = ("operation", "started", "statements", "db_seconds", "status")
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.status = 500
+
+
+class RequestTelemetry:
+
+    def __init__(self):
+        self.logger = None
+        self.slow_query_threshold = None
+        self.operations = {}
+
+    def init_app(self, app, api):
+        self.logger = app.logger
+        self.slow_query_threshold = app.config["SLOW_QUERY_THRESHOLD"] or None
+        self.operations = {endpoint: operation["operationId"] for endpoint, operation in permissions.api_operations(api)}
+
+        metrics.register_histogram("http_request_duration_seconds")
+        metrics.register_histogram("http_request_db_seconds")
+        metrics.register_histogram("http_request_db_statements", STATEMENT_BUCKETS)
+
+        # Registered before the other request hooks, so requests they answer early are counted too
+        app.before_request(self.request_started)
+        app.after_request(self.request_answered)
+        app.teardown_request(self.request_finished)
+        got_request_exception.connect(self.uncaught_exception, app)
+
+        event.listen(Engine, "before_cursor_execute", self.statement_started)
+        event.listen(Engine, "after_cursor_execute", self.statement_finished)
+
+    # Start accounting for a request to operation, until finish
+    def start(self, operation):
+        state = RequestState(operation)
+        _current_request.set(state)
+        return state
+
+    def finish(self, state, status):
+        elapsed = time.perf_counter() - state.started
+        _current_request.set(None)
+        metrics.inc("http_requests", operation=state.operation, status=status)
+        metrics.observe("http_request_duration_seconds", elapsed, operation=state.operation)
+        metrics.observe("http_request_db_statements", state.statements, operation=state.operation)
+        metrics.observe("http_request_db_seconds", state.db_seconds, operation=state.operation)
+
+    # Count an exception turned into an error response, and log it with its traceback
+    def record_error(self, error):
+        operation = current_operation()
+        metrics.inc("errors", type=type(error).__name__, operation=operation)
+        if self.logger is not None:
+            self.logger.error(f"{operation} failed: {error}", exc_info=error)
+
+    def request_started(self):
+        self.start(self.operations.get(request.endpoint, request.endpoint or UNMATCHED))
+
+    def request_answered(self, response):
+        state = _current_request.get()
+        if state is not None:
+            state.status = response.status_code
+        return response
+
+    # Runs once the response has been sent, streamed responses included
+    def request_finished(self, exc):
+        state = _current_request.get()
+        if state is not None:
+            self.finish(state, state.status)
+
+    # Flask logs exceptions no handler caught; they are only counted here. Client errors
+    # raised as HTTP exceptions (404, 405, ...) or connexion problems (a request failing
+    # validation, ...) are not errors of the service.
+    def uncaught_exception(self, sender, exception, **extra):
+        if isinstance(exception, HTTPException) and exception.code < 500:
+            return
+        if isinstance(exception, ProblemException) and exception.status < 500:
+            return
+        metrics.inc("errors", type=type(exception).__name__, operation=current_operation())
+
+    def statement_started(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["statement_started"] = time.perf_counter()
+
+    def statement_finished(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_started"]
+        engine = getattr(conn.engine.pool, "engine_name", "primary")
+        metrics.inc("db_statements", engine=engine)
+        metrics.inc("db_seconds", elapsed, engine=engine)
+
+        state = _current_request.get()
+        if state is not None:
+            state.statements += 1
+            state.db_seconds += elapsed
+
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            metrics.inc("db_slow_statements", engine=engine)
+            operation = state.operation if state is not None else BACKGROUND
+            text = " ".join(statement.split())[:SLOW_QUERY_LOG_LENGTH]
+            self.logger.warning(f"Slow statement ({elapsed * 1000:.0f} ms, {operation}, {engine}): {text}")
+
+
+request_telemetry = RequestTelemetry()
+
+
+# Error response of a handler for an exception it caught: counted in errors{type,operation} and logged
+def server_error(error):
+
+    request_telemetry.record_error(error)
+    return jsonify({"error": SERVER_ERROR_MESSAGE}), 500
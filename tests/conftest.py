@@ -0,0 +1,52 @@
+# conftest.py
+#
+# The app runs against a shared in-memory SQLite database seeded by databasebuild.py, with query
+# budgets enforced and the document cache, rate limits, spec cache and background threads off.
+
+import contextlib
+import io
+import os
+import pathlib
+import sys
+import uuid
+import pytest
+
+os.environ.update(
+    DATABASE_URI="sqlite://",
+    ENFORCE_QUERY_BUDGETS="1",
+    TRAIL_CACHE_BACKEND="none",
+    RATE_LIMITS_ENABLED="0",
+    SPEC_CACHE_PATH="",
+    SESSION_BACKEND="memory",
+    DEFER_BACKGROUND_THREADS="1",
+)
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import databasebuild  # noqa: F401  (builds and seeds the database on import)
+import app as app_module
+from config import db
+from sessions import session_store
+from models import User
+
+
+@pytest.fixture(scope="session")
+def flask_app():
+    return app_module.app.app
+
+
+@pytest.fixture(scope="session")
+def database(flask_app):
+    with flask_app.app_context():
+        yield db
+
+
+# A test client logged in as the admin of the sample data
+@pytest.fixture
+def admin_client(flask_app, database):
+    user = User.query.filter_by(role="admin").first()
+    session_id = str(uuid.uuid4())
+    session_store.create({"user_id": user.user_id, "email": user.email, "role": user.role}, session_id=session_id)
+    client = flask_app.test_client()
+    client.set_cookie("localhost", "session_id", session_id)
+    return client
@@ -0,0 +1,51 @@
+# test_admission.py
+#
+# Anonymous callers get a session bucket per client address, read through the trusted proxies
+# (PROXY_HOPS). Token buckets hold burst tokens, refill at rate tokens per second, and take a
+# token from every bucket of a request or from none.
+
+import pytest
+import admission
+from admission import caller_key, client_address
+
+
+@pytest.mark.parametrize("forwarded_for, hops, address", [
+    (None, 0, "10.0.0.1"),
+    ("203.0.113.7", 0, "10.0.0.1"),
+    ("203.0.113.7", 1, "203.0.113.7"),
+    ("198.51.100.2, 203.0.113.7", 1, "203.0.113.7"),
+    ("198.51.100.2, 203.0.113.7", 2, "198.51.100.2"),
+    ("203.0.113.7", 2, "10.0.0.1"),
+])
+def test_client_address_behind_trusted_proxies(forwarded_for, hops, address):
+    assert client_address("10.0.0.1", forwarded_for, hops) == address
+
+
+def test_anonymous_callers_behind_a_proxy_get_their_own_buckets():
+    first = caller_key(None, client_address("10.0.0.1", "203.0.113.7", 1))
+    second = caller_key(None, client_address("10.0.0.1", "203.0.113.8", 1))
+    assert first != second
+    assert caller_key({"user_id": 4}, "10.0.0.1") == "user:4"
+
+
+@pytest.fixture(params=sorted(admission.BACKENDS))
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return admission.SQLiteBackend(str(tmp_path / "buckets.sqlite"))
+    return admission.MemoryBackend()
+
+
+def test_bucket_allows_its_burst_then_waits(backend):
+    buckets = [("op|session|addr:203.0.113.7", 0.5, 2)]
+    assert backend.take(buckets) == [0]
+    assert backend.take(buckets) == [0]
+    assert backend.take(buckets)[0] == pytest.approx(2, abs=0.1)
+
+
+def test_tokens_are_taken_from_all_buckets_or_none(backend):
+    session = ("op|session|addr:203.0.113.7", 0.001, 1)
+    route = ("op|route", 0.001, 2)
+    assert backend.take([session, route]) == [0, 0]
+    assert backend.take([session, route])[0] > 0
+    # The route bucket kept the token the rejected request did not use
+    assert backend.take([route]) == [0]
@@ -0,0 +1,83 @@
+# test_asgi_bridge.py
+#
+# The WSGI bridge of asgi.py passes a streamed body on chunk by chunk. A client that goes away
+# mid-body must not leave the worker thread blocked on the queue: it stops and closes the response.
+
+import asyncio
+import threading
+import pytest
+from asgi import WSGIBridge
+
+CHUNKS = 1000
+
+
+class StreamedBody:
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for number in range(CHUNKS):
+            yield f"{number}\n".encode()
+
+    def close(self):
+        self.closed.set()
+
+
+def scope():
+
+    return {
+        "type": "http", "method": "GET", "path": "/stream", "query_string": b"", "headers": [],
+        "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+    }
+
+
+async def receive():
+
+    return {"type": "http.request", "body": b""}
+
+
+def test_full_body_is_passed_on():
+    body = StreamedBody()
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+        return body
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(WSGIBridge(wsgi_app, 1)(scope(), receive, send))
+
+    assert sent[0]["status"] == 200
+    assert b"".join(message.get("body", b"") for message in sent[1:]).count(b"\n") == CHUNKS
+    assert body.closed.is_set()
+
+
+def test_disconnect_stops_the_worker_thread():
+    body = StreamedBody()
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+        return body
+
+    bridge = WSGIBridge(wsgi_app, 1)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+        if len(sent) > 3:
+            raise OSError("client disconnected")
+
+    # The event loop keeps running, as in a server, while the thread is expected to stop
+    async def serve():
+        with pytest.raises(OSError):
+            await bridge(scope(), receive, send)
+        closed = await asyncio.get_running_loop().run_in_executor(None, body.closed.wait, 5)
+        free = await asyncio.wrap_future(bridge.executor.submit(lambda: "free"))
+        return closed, free
+
+    # The thread closes the response and the executor can serve the next request
+    assert asyncio.run(asyncio.wait_for(serve(), 10)) == (True, "free")
@@ -0,0 +1,61 @@
+# test_conditional_reads.py
+#
+# Trail reads carry an ETag built from the change counters. A request whose If-None-Match still
+# matches is answered 304; once the trail changes, here or in another worker, the body and ETag
+# are the new ones, also when the encoded document is served from the document cache.
+
+import pytest
+from sqlalchemy import update
+from cache import MemoryBackend, document_cache
+from models import Trail
+
+
+@pytest.fixture
+def memory_cache():
+    backend = document_cache.backend
+    document_cache.backend = MemoryBackend()
+    yield document_cache.backend
+    document_cache.backend = backend
+
+
+@pytest.fixture
+def trail_id(database):
+    return Trail.query.order_by(Trail.trail_id).first().trail_id
+
+
+def test_matching_etag_is_answered_not_modified(admin_client, trail_id):
+    response = admin_client.get(f"/api/trails/{trail_id}")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = admin_client.get(f"/api/trails/{trail_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_update_changes_body_and_etag(admin_client, memory_cache, trail_id):
+    first = admin_client.get(f"/api/trails/{trail_id}")
+    response = admin_client.put(f"/api/trails/{trail_id}", json={"difficulty": "Changed here"})
+    assert response.status_code == 200
+
+    response = admin_client.get(f"/api/trails/{trail_id}", headers={"If-None-Match": first.headers["ETag"]})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != first.headers["ETag"]
+    assert response.get_json()["difficulty"] == "Changed here"
+
+
+# A write by another worker reaches this one only through the trail's version column: no signal
+# invalidates the cache here, so the cached document must be keyed on the version as well
+def test_cached_document_follows_an_update_made_elsewhere(admin_client, database, memory_cache, trail_id):
+    first = admin_client.get(f"/api/trails/{trail_id}")
+    assert memory_cache.size() == 1
+
+    database.session.execute(
+        update(Trail).where(Trail.trail_id == trail_id)
+        .values(difficulty="Changed elsewhere", version=Trail.version + 1)
+    )
+    database.session.commit()
+
+    response = admin_client.get(f"/api/trails/{trail_id}")
+    assert response.headers["ETag"] != first.headers["ETag"]
+    assert response.get_json()["difficulty"] == "Changed elsewhere"
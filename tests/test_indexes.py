@@ -0,0 +1,73 @@
+# test_indexes.py
+#
+# The in-memory trail indexes follow writes made by other workers when they refresh: those writes
+# arrive without the trails_changed signal, only as a move of the trails change counter.
+
+from datetime import timedelta
+import pytest
+from sqlalchemy import delete, insert
+from facets import facet_index
+from fulltext import search_index
+from models import Trail, TrailFeature, User, utc_now
+from spatial import spatial_index
+from versions import TRAILS, bump_collections, commit_changes
+
+INDEXES = (facet_index, search_index, spatial_index)
+
+
+@pytest.fixture
+def built_indexes(database):
+    for index in INDEXES:
+        index.ensure_built()
+    return INDEXES
+
+
+# Commit a write the way another worker would: the change counter moves, no signal is sent here
+def commit_elsewhere(database, *statements):
+    for statement in statements:
+        database.session.execute(statement)
+    bump_collections([TRAILS], utc_now())
+    database.session.commit()
+
+
+def refresh(indexes):
+    for index in indexes:
+        index.checked_at = 0.0
+        index.refresh()
+
+
+def test_trail_deleted_by_another_worker_is_dropped(database, built_indexes):
+    owner = User.query.first()
+    trail = Trail(trail_name="Deleted elsewhere", difficulty="Index test", user_id=owner.user_id)
+    database.session.add(trail)
+    database.session.flush()
+    trail_id = trail.trail_id
+    commit_changes([trail_id])
+    assert all(trail_id in index.indexed_ids for index in built_indexes)
+    assert trail_id in facet_index.sets[("difficulty", "Index test")]
+
+    commit_elsewhere(
+        database,
+        delete(TrailFeature).where(TrailFeature.trail_id == trail_id),
+        delete(Trail).where(Trail.trail_id == trail_id),
+    )
+    refresh(built_indexes)
+
+    assert not any(trail_id in index.indexed_ids for index in built_indexes)
+    assert trail_id not in facet_index.trails
+    assert trail_id not in facet_index.sets.get(("difficulty", "Index test"), ())
+    assert trail_id not in search_index.lengths
+
+
+def test_trail_outside_the_updated_at_window_is_added(database, built_indexes):
+    owner = User.query.first()
+    # Stamped well before the last sync, as by a worker whose clock runs behind
+    stamped_at = utc_now() - timedelta(days=1)
+    commit_elsewhere(database, insert(Trail).values(
+        trail_name="Added elsewhere", user_id=owner.user_id, updated_at=stamped_at,
+    ))
+    trail_id = Trail.query.filter_by(trail_name="Added elsewhere").one().trail_id
+    refresh(built_indexes)
+
+    assert all(trail_id in index.indexed_ids for index in built_indexes)
+    assert trail_id in facet_index.trails
@@ -0,0 +1,72 @@
+# test_query_budgets.py
+#
+# The listing endpoints issue a fixed number of statements however many rows they return. With
+# ENFORCE_QUERY_BUDGETS on, a block over its budget raises and the endpoint answers 500; the
+# statements of each request are also counted here and checked against the budget.
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from loading import QUERY_BUDGETS, QueryBudgetExceeded, query_budget
+from models import Feature, Trail, TrailFeature, User
+
+# Statements a listing may issue outside its budget: the change counter lookup of conditional GETs
+VERSION_LOOKUPS = 1
+
+# Extra trails seeded so that a per-row query would show as a count well over the budget
+EXTRA_TRAILS = 25
+
+
+@pytest.fixture(scope="module")
+def many_trails(database):
+    owner = User.query.first()
+    features = Feature.query.all()
+    for number in range(EXTRA_TRAILS):
+        trail = Trail(trail_name=f"Budget trail {number}", user_id=owner.user_id)
+        database.session.add(trail)
+        database.session.flush()
+        for feature in features[:2]:
+            database.session.add(TrailFeature(trail_id=trail.trail_id, feature_id=feature.feature_id))
+    database.session.commit()
+    return Trail.query.order_by(Trail.trail_id).first().trail_id
+
+
+# Number of statements sent to the database while a request is served
+@pytest.fixture
+def statements():
+    counter = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter[0] += 1
+
+    event.listen(Engine, "before_cursor_execute", count)
+    yield counter
+    event.remove(Engine, "before_cursor_execute", count)
+
+
+def test_enforcement_is_on(flask_app):
+    assert flask_app.config["ENFORCE_QUERY_BUDGETS"]
+
+
+def test_over_budget_raises(database):
+    budget = QUERY_BUDGETS["trail_documents"]
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget("trail_documents"):
+            for _ in range(budget + 1):
+                database.session.query(Trail.trail_id).first()
+
+
+@pytest.mark.parametrize(
+    "url, budget",
+    [
+        ("/api/trails?limit=500", "trail_documents"),
+        ("/api/trails/{trail_id}", "trail_documents"),
+        ("/api/features/search?name=Viewpoint", "feature_documents"),
+        ("/", "trail_features"),
+    ],
+)
+def test_listing_within_budget(admin_client, many_trails, statements, url, budget):
+    response = admin_client.get(url.format(trail_id=many_trails))
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert statements[0] <= QUERY_BUDGETS[budget] + VERSION_LOOKUPS
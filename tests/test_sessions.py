@@ -0,0 +1,51 @@
+# test_sessions.py
+#
+# Both session backends keep one session per user, forget expired sessions, and answer lookups by
+# session ID and by email. The SQLite backend is shared by every worker opening the same file.
+
+import pytest
+import sessions
+
+DATA = {"user_id": 1, "email": "grace@plymouth.ac.uk", "role": "admin"}
+
+
+@pytest.fixture(params=sorted(sessions.BACKENDS))
+def backend_factory(request, tmp_path):
+    if request.param == "sqlite":
+        return lambda **options: sessions.SQLiteBackend(str(tmp_path / "sessions.sqlite"), **options)
+    return sessions.MemoryBackend
+
+
+def test_session_is_found_by_id_and_email(backend_factory):
+    backend = backend_factory()
+    backend.create("first", DATA)
+    assert backend.get("first") == DATA
+    assert backend.get_by_email(DATA["email"]) == DATA
+    assert backend.get("unknown") is None
+
+
+def test_new_login_replaces_the_previous_session(backend_factory):
+    backend = backend_factory()
+    backend.create("first", DATA)
+    backend.create("second", DATA)
+    assert backend.get("first") is None
+    assert backend.get("second") == DATA
+    assert backend.size() == 1
+
+
+def test_deleted_and_expired_sessions_are_gone(backend_factory):
+    backend = backend_factory()
+    backend.create("first", DATA)
+    assert backend.delete("first") == DATA
+    assert backend.get("first") is None
+
+    expired = backend_factory(ttl=-1)
+    expired.create("second", DATA)
+    assert expired.get("second") is None
+    assert expired.get_by_email(DATA["email"]) is None
+
+
+def test_sqlite_sessions_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    sessions.SQLiteBackend(path).create("first", DATA)
+    assert sessions.SQLiteBackend(path).get("first") == DATA
@@ -0,0 +1,63 @@
+# test_validation.py
+#
+# Response validation checks JSON bodies against the operation's schema. Streamed responses are
+# passed on without being read, and NDJSON bodies are not checked against the JSON schema.
+
+import json
+import pytest
+from connexion.apis.flask_api import FlaskApi
+from connexion.exceptions import NonConformingResponseBody
+from flask import Response
+from validation import SampledResponseValidator
+
+SCHEMA = {"type": "object", "properties": {"length": {"type": "number"}}}
+
+
+class Operation:
+
+    operation_id = "trails.read_all"
+    api = FlaskApi
+
+    # The specification documents the NDJSON lines with the same schema
+    def response_schema(self, status_code, content_type):
+        return SCHEMA
+
+    def response_definition(self, status_code, content_type):
+        return {}
+
+    def json_loads(self, data):
+        return json.loads(data)
+
+
+class Request:
+
+    url = "http://localhost/api/trails"
+
+
+def validated(response):
+
+    validator = SampledResponseValidator(Operation(), "application/json")
+    return validator(lambda request: response)(Request())
+
+
+def test_nonconforming_json_body_is_rejected():
+    with pytest.raises(NonConformingResponseBody):
+        validated(Response(b'{"length": "long"}', mimetype="application/json"))
+
+
+def test_ndjson_body_is_not_checked_against_the_json_schema():
+    response = Response(b'{"length": 1}\n{"length": 2}\n', mimetype="application/x-ndjson")
+    assert validated(response) is response
+
+
+def test_streamed_body_is_not_read():
+    pulled = []
+
+    def generate():
+        for line in (b'{"length": 1}\n', b'{"length": 2}\n'):
+            pulled.append(line)
+            yield line
+
+    response = validated(Response(generate(), mimetype="application/x-ndjson"))
+    assert pulled == []
+    assert b"".join(response.response) == b'{"length": 1}\n{"length": 2}\n'
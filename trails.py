@@ -1,106 +1,332 @@
 # trails.py
 
-from models import Trail, trail_schema, trails_schema, TrailFeature, Feature, User
-from flask import request, jsonify, abort
+from itertools import islice
+from models import Trail, TrailFeature, User
+from flask import request, jsonify
+from sqlalchemy.exc import IntegrityError
 from config import db, connex_app
-from marshmallow import ValidationError
-from features import add_feature
-from permissions import check_permission
-from auth import logged_in_users
+from permissions import current_user
+from loading import query_budget
+from serializers import IN_CHUNK_SIZE, FieldsetError, fieldset_serializer, split_names, trail_serializer
+from spatial import trails_near, trails_within
+from fulltext import search_trails
+from bulk import chunked, import_chunk, parse_rows
+from linking import FeatureNameError, feature_names_from, link_features, unlink_features, replace_features
+from facets import faceted_search, iter_bitmap
+from streaming import NDJSON_MIMETYPE, STREAM_BATCH_SIZE, stream_response, wants_ndjson, wants_stream
+from cache import document_cache, json_bytes_response, cache_key, versioned_key, TRAIL_GROUP, TRAIL_LISTING_GROUP
+from versions import TRAILS, collection_versions, commit_changes, trail_version, validators, not_modified, with_validators
+from telemetry import SERVER_ERROR_MESSAGE, request_telemetry, server_error
 
 
 app = connex_app.app
 
-# Fetch all trails and their associated features, including waypoints.
-def read_all():
+# Default and maximum number of trails returned per page
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Default search radius of the nearby trails search
+DEFAULT_RADIUS_KM = 10.0
+
+# Columns a PUT may set directly (the UpdateTrail schema). Waypoints and features are handled
+# apart, and version and updated_at are only ever bumped by commit_changes.
+EDITABLE_COLUMNS = {
+    "trail_name", "trail_summary", "trail_description", "difficulty", "location", "length", "elevation_gain", "route_type",
+}
+
+# Build the filters of a trail listing. They are pushed into SQL so only one page is read.
+def trail_filters(after=None, difficulty=None, location=None, route_type=None,
+                  min_length=None, max_length=None, min_elevation=None, max_elevation=None):
+
+    filters = []
+
+    # Keyset cursor: only trails after the last trail_id the client has seen
+    if after is not None:
+        filters.append(Trail.trail_id > after)
+
+    # Exact match filters
+    if difficulty is not None:
+        filters.append(Trail.difficulty == difficulty)
+    if location is not None:
+        filters.append(Trail.location == location)
+    if route_type is not None:
+        filters.append(Trail.route_type == route_type)
+
+    # Range filters
+    if min_length is not None:
+        filters.append(Trail.length >= min_length)
+    if max_length is not None:
+        filters.append(Trail.length <= max_length)
+    if min_elevation is not None:
+        filters.append(Trail.elevation_gain >= min_elevation)
+    if max_elevation is not None:
+        filters.append(Trail.elevation_gain <= max_elevation)
+
+    return filters
+
+# Statement for a trail listing in trail ID order, in the columns the serializer reads
+def listing_statement(serializer, **filters):
+
+    return serializer.statement().where(*trail_filters(**filters)).order_by(Trail.trail_id)
+
+# Read a single trail in its API representation, or None if it does not exist
+def read_trail_document(trail_id, serializer=None):
+
+    serializer = serializer or trail_serializer()
+    rows = db.session.execute(serializer.statement().where(Trail.trail_id == trail_id)).all()
+    documents = serializer.documents(rows)
+    return documents[0] if documents else None
+
+# Fetch a page of trails and their associated features, including waypoints.
+# With ?stream=1 or an NDJSON Accept header every matching trail is streamed instead of one page.
+# ?fields= and ?include= select the columns and related data that are read and returned.
+# ?features=, ?exclude_features= or ?facets=1 filter through the facet index and add facet counts.
+def read_all(limit=DEFAULT_PAGE_SIZE, after=None, difficulty=None, location=None, route_type=None,
+             min_length=None, max_length=None, min_elevation=None, max_elevation=None, stream=0,
+             fields=None, include=None, features=None, exclude_features=None, facets=0):
         
     try:
-        # Fetch all trails from the database
-        trails = Trail.query.all()
-
-        # Iterate through each trail and merges the way the waypoints and features are displayed
-        response = []
-        for trail in trails:
-            trail_data = trail_schema.dump(trail)
-            # Groups the individual waypoint attributes (pt1_lat, pt1_long, etc.) into nested dictionaries.
-            trail_data["waypoints"] = {
-                "pt1": {"lat": trail.pt1_lat, "long": trail.pt1_long, "desc": trail.pt1_desc},
-                "pt2": {"lat": trail.pt2_lat, "long": trail.pt2_long, "desc": trail.pt2_desc},
-                "pt3": {"lat": trail.pt3_lat, "long": trail.pt3_long, "desc": trail.pt3_desc},
-            }
-            # Removes the original individual waypoint fields (pt1_lat, pt2_long, etc.) from the trail data.
-            for key in ["pt1_lat", "pt1_long", "pt1_desc", "pt2_lat", "pt2_long", "pt2_desc", "pt3_lat", "pt3_long", "pt3_desc"]:
-                trail_data.pop(key, None)
-
-            # Add Features to Trail Data
-            trail_data["features"] = [
-                {"feature_name": trail_feature.feature.feature_name} 
-                for trail_feature in trail.features
-            ]
-            response.append(trail_data)
-
-        return jsonify(response), 200
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        try:
+            serializer = fieldset_serializer(fields, include)
+        except FieldsetError as err:
+            return jsonify({"error": str(err)}), 400
+
+        if features is not None or exclude_features is not None or facets:
+            return read_faceted(
+                serializer, limit=limit, after=after, difficulty=difficulty, location=location,
+                route_type=route_type, min_length=min_length, max_length=max_length,
+                min_elevation=min_elevation, max_elevation=max_elevation, stream=stream,
+                features=features, exclude_features=exclude_features
+            )
+
+        filters = dict(
+            after=after, difficulty=difficulty, location=location, route_type=route_type,
+            min_length=min_length, max_length=max_length,
+            min_elevation=min_elevation, max_elevation=max_elevation
+        )
+        statement = listing_statement(serializer, **filters)
+        key = cache_key(TRAIL_LISTING_GROUP, limit=limit, fieldset=serializer.fieldset, **filters)
+
+        # Answer conditional requests from the trails change counter, before any trail is read
+        streamed = wants_stream(stream)
+        etag, last_modified = validators(collection_versions(TRAILS), f"{key}|{streamed}|{wants_ndjson()}")
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        # Stream trails a batch at a time, so memory stays flat however many rows match
+        if streamed:
+            documents = serializer.iter_documents(statement, STREAM_BATCH_SIZE)
+            response = stream_response(documents, "trails", {"next_cursor": None})
+            return with_validators(response, etag, last_modified)
+
+        def build_page():
+            with query_budget("trail_documents"):
+                # Fetch one extra row to find out whether another page follows
+                rows = db.session.execute(statement.limit(limit + 1)).all()
+
+                next_cursor = None
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    next_cursor = rows[-1].trail_id
+
+                trails = serializer.documents(rows)
+
+            return app.json.dumps_bytes({"trails": trails, "next_cursor": next_cursor})
+
+        # Serve the encoded page from the document cache, building it on a miss
+        response = json_bytes_response(document_cache.get_or_build(versioned_key(key, etag), build_page))
+        return with_validators(response, etag, last_modified)
     except Exception as e:
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
+
+# Trail listing filtered by the facet index: trails linked to every feature in ?features= and to
+# none in ?exclude_features=, combined with the other listing filters. The page carries the number
+# of matching trails linked to each feature, so clients can show counts next to every filter.
+def read_faceted(serializer, limit, after=None, difficulty=None, location=None, route_type=None,
+                 min_length=None, max_length=None, min_elevation=None, max_elevation=None, stream=0,
+                 features=None, exclude_features=None):
+
+    key = cache_key(
+        TRAIL_LISTING_GROUP, limit=limit, after=after, difficulty=difficulty, location=location,
+        route_type=route_type, min_length=min_length, max_length=max_length,
+        min_elevation=min_elevation, max_elevation=max_elevation, fieldset=serializer.fieldset,
+        features=features, exclude_features=exclude_features, facets=1
+    )
+
+    # Answer conditional requests from the trails change counter, before the index is queried
+    streamed = wants_stream(stream)
+    etag, last_modified = validators(collection_versions(TRAILS), f"{key}|{streamed}|{wants_ndjson()}")
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
+    # Range filters are not indexed and are applied in SQL
+    conditions = trail_filters(
+        min_length=min_length, max_length=max_length, min_elevation=min_elevation, max_elevation=max_elevation
+    )
+
+    def search():
+        return faceted_search(
+            split_names(features) or (), split_names(exclude_features) or (),
+            difficulty=difficulty, location=location, route_type=route_type, conditions=conditions
+        )
+
+    # Stream the matching trails a batch of IDs at a time
+    if streamed:
+        bits, facet_counts = search()
+
+        def documents():
+            batch = []
+            for trail_id in iter_bitmap(bits, after):
+                batch.append(trail_id)
+                if len(batch) == STREAM_BATCH_SIZE:
+                    yield from (trail_data for _, trail_data in read_trail_documents(batch, serializer))
+                    batch = []
+            yield from (trail_data for _, trail_data in read_trail_documents(batch, serializer))
+
+        response = stream_response(documents(), "trails", {"facets": facet_counts, "next_cursor": None})
+        return with_validators(response, etag, last_modified)
+
+    def build_page():
+        bits, facet_counts = search()
+
+        # Take one extra ID to find out whether another page follows
+        trail_ids = list(islice(iter_bitmap(bits, after), limit + 1))
+        next_cursor = None
+        if len(trail_ids) > limit:
+            trail_ids = trail_ids[:limit]
+            next_cursor = trail_ids[-1]
+
+        with query_budget("trail_documents"):
+            trails = [trail_data for _, trail_data in read_trail_documents(trail_ids, serializer)]
+
+        return app.json.dumps_bytes({"trails": trails, "next_cursor": next_cursor, "facets": facet_counts})
+
+    # Serve the encoded page from the document cache, building it on a miss
+    response = json_bytes_response(document_cache.get_or_build(versioned_key(key, etag), build_page))
+    return with_validators(response, etag, last_modified)
+
+# Read trails in their API representation, in the order of the given IDs.
+# Trails deleted since their ID was looked up are left out.
+def read_trail_documents(trail_ids, serializer):
+
+    rows = []
+    for start in range(0, len(trail_ids), IN_CHUNK_SIZE):
+        chunk = trail_ids[start:start + IN_CHUNK_SIZE]
+        rows.extend(db.session.execute(serializer.statement().where(Trail.trail_id.in_(chunk))).all())
+    documents = dict(zip([row[0] for row in rows], serializer.documents(rows)))
+    return [(trail_id, documents[trail_id]) for trail_id in trail_ids if trail_id in documents]
+
+# Answer a search served by an in-memory index: from the trails change counter for conditional
+# requests, otherwise by reading the trails search() matched. search returns (trail_id, extra fields) pairs.
+def index_search_response(key, fields, include, search):
 
-# Retrieve a trail by its ID, restricted to users with the appropriate role.
-def read_by_id(trail_id):
+    try:
+        serializer = fieldset_serializer(fields, include)
+    except FieldsetError as err:
+        return jsonify({"error": str(err)}), 400
+
+    etag, last_modified = validators(collection_versions(TRAILS), cache_key(key, fieldset=serializer.fieldset))
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
+    matches = search()
+    extras = dict(matches)
+    with query_budget("trail_documents"):
+        documents = read_trail_documents([trail_id for trail_id, _ in matches], serializer)
+    trails = [dict(trail_data, **extras[trail_id]) for trail_id, trail_data in documents]
+    return with_validators(json_bytes_response(app.json.dumps_bytes({"trails": trails})), etag, last_modified)
+
+# Full-text search over trail names, summaries, descriptions, locations and waypoint descriptions.
+# Trails are ranked by BM25 relevance; query terms may contain a typo or two. Each trail carries its score.
+def read_search(q, limit=DEFAULT_PAGE_SIZE, fields=None, include=None):
+
+    try:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
 
-    # Check if the user has the required permission
-    user, error = check_permission("view_id_trails")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
+        def search():
+            return [(trail_id, {"score": round(score, 4)}) for score, trail_id in search_trails(q, limit)]
+
+        return index_search_response(cache_key("search", q=q, limit=limit), fields, include, search)
+    except Exception as e:
+        return server_error(e)
+
+# Find the trails with a waypoint within radius_km of a point, nearest first.
+# Each trail carries distance_km, the great-circle distance to its nearest waypoint.
+def read_near(lat, long, radius_km=DEFAULT_RADIUS_KM, limit=DEFAULT_PAGE_SIZE, fields=None, include=None):
 
     try:
-        # Fetch the trail by ID
-        trail = Trail.query.get(trail_id)
-        if not trail:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        def search():
+            return [(trail_id, {"distance_km": round(distance, 3)}) for distance, trail_id in trails_near(lat, long, radius_km, limit)]
+
+        key = cache_key("near", lat=lat, long=long, radius_km=radius_km, limit=limit)
+        return index_search_response(key, fields, include, search)
+    except Exception as e:
+        return server_error(e)
+
+# Find the trails with a waypoint inside a bounding box, in trail ID order
+def read_within(min_lat, min_long, max_lat, max_long, limit=DEFAULT_PAGE_SIZE, fields=None, include=None):
+
+    try:
+        if min_lat > max_lat or min_long > max_long:
+            return jsonify({"error": "min_lat and min_long must not be greater than max_lat and max_long."}), 400
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        def search():
+            return [(trail_id, {}) for trail_id in trails_within(min_lat, min_long, max_lat, max_long)[:limit]]
+
+        key = cache_key("within", min_lat=min_lat, min_long=min_long, max_lat=max_lat, max_long=max_long, limit=limit)
+        return index_search_response(key, fields, include, search)
+    except Exception as e:
+        return server_error(e)
+
+# Retrieve a trail by its ID, restricted to users with the appropriate role.
+# ?fields= and ?include= select the columns and related data that are read and returned.
+def read_by_id(trail_id, fields=None, include=None):
+
+    try:
+        # Answer conditional requests from the trail's version, before the trail is read
+        version = trail_version(trail_id)
+        if version is None:
+            return jsonify({"error": f"Trail with ID {trail_id} not found."}), 404
+
+        try:
+            serializer = fieldset_serializer(fields, include)
+        except FieldsetError as err:
+            return jsonify({"error": str(err)}), 400
+
+        key = cache_key(f"{TRAIL_GROUP}{trail_id}", fieldset=serializer.fieldset)
+        etag, last_modified = validators([version], key)
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        def build_trail():
+            with query_budget("trail_documents"):
+                trail_data = read_trail_document(trail_id, serializer)
+            return app.json.dumps_bytes(trail_data) if trail_data else None
+
+        # Serve the encoded trail from the document cache, building it on a miss
+        body = document_cache.get_or_build(versioned_key(key, etag), build_trail)
+        if body is None:
             return jsonify({"error": f"Trail with ID {trail_id} not found."}), 404
 
-        # Merges the way the waypoints and features are displayed
-        trail_data = trail_schema.dump(trail)
-        trail_data["waypoints"] = {
-            "pt1": {"lat": trail.pt1_lat, "long": trail.pt1_long, "desc": trail.pt1_desc},
-            "pt2": {"lat": trail.pt2_lat, "long": trail.pt2_long, "desc": trail.pt2_desc},
-            "pt3": {"lat": trail.pt3_lat, "long": trail.pt3_long, "desc": trail.pt3_desc},
-        }
-        # Removes the original individual waypoint fields (pt1_lat, pt2_long, etc.) from the trail data.
-        for key in ["pt1_lat", "pt1_long", "pt1_desc", "pt2_lat", "pt2_long", "pt2_desc", "pt3_lat", "pt3_long", "pt3_desc"]:
-            trail_data.pop(key, None)
-
-        # Add Features to Trail Data
-        trail_data["features"] = [
-            {"feature_name": trail_feature.feature.feature_name} 
-            for trail_feature in trail.features
-        ]
-
-        return jsonify(trail_data), 200
+        return with_validators(json_bytes_response(body), etag, last_modified)
     except Exception as e:
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
 
 # Create a trail using the logged-in user's email to link to their user ID
 def create_trail():
 
-    user, error = check_permission("create_trails")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
-
     try:
-        # Retrieve the logged-in user's email from the session cookies
-        session_id = request.cookies.get("session_id")
-        if not session_id:
-            return jsonify({"error": "User is not logged in."}), 401
-
-        # Matches the session_id to a logged-in user in logged_in_users and returns error
-        logged_in_user = None
-        for email, user_data in logged_in_users.items():
-            if user_data["session_id"] == session_id:
-                logged_in_user = user_data
-                break
-
-        if not logged_in_user:
-            return jsonify({"error": "Invalid session. Please log in again."}), 403
-        email = logged_in_user["email"]
+        # The logged-in user's email, from the session the permission hook resolved
+        email = current_user()["email"]
 
         # Extracts trail details, features, and waypoints from the request body.
         trail_data = request.json
@@ -126,61 +352,86 @@ def create_trail():
         trail_data["pt3_long"] = waypoints.get("pt3", {}).get("long")
         trail_data["pt3_desc"] = waypoints.get("pt3", {}).get("desc")
 
-        # Deserialize and converts the trail_data dictionary into a Trail model object.
-        new_trail = trail_schema.load(trail_data, session=db.session)
+        # The body was validated against NewTrail (see validation.py) before the handler ran
+        new_trail = Trail(**trail_data)
         db.session.add(new_trail)
-        db.session.commit()
+        db.session.flush()
+
+        # Link the features in the same transaction, creating the ones that do not exist
+        feature_names = feature_names_from([feature.get("feature_name") for feature in features])
+        linked_feature_ids = link_features(new_trail.trail_id, feature_names) if feature_names else []
+
+        commit_changes(trail_ids=[new_trail.trail_id], feature_ids=linked_feature_ids)
+
+        return jsonify(read_trail_document(new_trail.trail_id)), 201
 
-        # Add features to the trail and avoid duplicates
-        added_features = set()
-        for feature in features:
-            feature_name = feature["feature_name"]
-            if feature_name in added_features:
+    except FeatureNameError as err:
+        db.session.rollback()
+        return jsonify({"error": str(err)}), 400
+    except IntegrityError:
+        # trail_name is the only unique column the body sets
+        db.session.rollback()
+        return jsonify({"error": f"A trail with the name '{trail_data.get('trail_name')}' already exists."}), 400
+    except Exception as e:
+        db.session.rollback()
+        return server_error(e)
+
+# Import many trails in one request, owned by the logged-in user. The body is a JSON array of
+# trails in the create_trail format, or NDJSON with one trail per line. Rows are validated and
+# inserted BULK_CHUNK_SIZE at a time and every row gets a result. With ?atomic=1 (the default)
+# nothing is kept unless every row is valid; with ?atomic=0 each chunk commits its valid rows.
+def bulk_create_trails(atomic=1):
+
+    try:
+        try:
+            rows = parse_rows(request.get_data(), ndjson=request.mimetype == NDJSON_MIMETYPE)
+        except ValueError as err:
+            return jsonify({"error": f"Invalid request body: {err}"}), 400
+
+        user_id = current_user()["user_id"]
+        results = []
+        seen_names = set()
+        created_ids = []
+        feature_ids = set()
+        for chunk in chunked(rows):
+            try:
+                chunk_results, trail_ids, chunk_feature_ids = import_chunk(chunk, user_id, seen_names)
+            except Exception as e:
+                db.session.rollback()
+                if atomic:
+                    raise
+                # Only this chunk is lost; earlier chunks are already committed
+                request_telemetry.record_error(e)
+                results.extend({"index": index, "status": "error", "errors": {"_schema": [SERVER_ERROR_MESSAGE]}} for index, _ in chunk)
                 continue
-            added_features.add(feature_name)
-
-            # Check if the feature exists in the database
-            existing_feature = Feature.query.filter_by(feature_name=feature_name).first()
-            if not existing_feature:
-                # Create the feature if it doesn't exist
-                new_feature = Feature(feature_name=feature_name)
-                db.session.add(new_feature)
-                db.session.commit()
-                existing_feature = new_feature
-
-            # Link the feature to the trail
-            trail_feature = TrailFeature(trail_id=new_trail.trail_id, feature_id=existing_feature.feature_id)
-            db.session.add(trail_feature)
-
-        # Commit the trail-feature links
-        db.session.commit()
-
-        # Converts object into dictionary to formant response
-        trail_with_features = trail_schema.dump(new_trail)
-        trail_with_features["features"] = [
-            {"feature_name": tf.feature.feature_name} for tf in new_trail.features
-        ]
-        trail_with_features["waypoints"] = {
-            "pt1": {"lat": trail_data["pt1_lat"], "long": trail_data["pt1_long"], "desc": trail_data["pt1_desc"]},
-            "pt2": {"lat": trail_data["pt2_lat"], "long": trail_data["pt2_long"], "desc": trail_data["pt2_desc"]},
-            "pt3": {"lat": trail_data["pt3_lat"], "long": trail_data["pt3_long"], "desc": trail_data["pt3_desc"]}
-        }
-
-        return jsonify(trail_with_features), 201
-
-    except ValidationError as err:
-        return jsonify({"error": err.messages}), 400
+
+            results.extend(chunk_results)
+            if not atomic:
+                commit_changes(trail_ids=trail_ids, feature_ids=chunk_feature_ids)
+            created_ids.extend(trail_ids)
+            feature_ids.update(chunk_feature_ids)
+
+        failed = sum(1 for result in results if result["status"] == "error")
+        if atomic and failed:
+            db.session.rollback()
+            for result in results:
+                if result["status"] == "created":
+                    result["status"] = "rolled_back"
+                    del result["trail_id"]
+            created_ids = []
+        elif atomic:
+            commit_changes(trail_ids=created_ids, feature_ids=feature_ids)
+
+        body = {"created": len(created_ids), "failed": failed, "results": results}
+        return jsonify(body), 400 if atomic and failed else 200
+
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
 
 # Update a trail's details using its ID
 def update_trail(trail_id):
 
-    user, error = check_permission("edit_trails")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]
-
     try:
         # Fetch the trail by ID from the input parameter 
         trail = Trail.query.get(trail_id)
@@ -198,7 +449,7 @@ def update_trail(trail_id):
 
         # Update trail details
         for key, value in trail_data.items():
-            if key not in ["features", "waypoints"] and hasattr(trail, key):
+            if key in EDITABLE_COLUMNS:
                 setattr(trail, key, value)
 
         # Update waypoints
@@ -216,137 +467,127 @@ def update_trail(trail_id):
             trail.pt3_long = waypoints.get("pt3", {}).get("long", trail.pt3_long)
             trail.pt3_desc = waypoints.get("pt3", {}).get("desc", trail.pt3_desc)
 
-        # Handle feature updates
+        # Handle feature updates in the same transaction
         features = trail_data.pop("features", None)
+        changed_feature_ids = []
         if features:
-            # Add new features
-            if "add" in features:
-                feature_request_data = {"feature_name": features["add"]}
-                with app.test_request_context(json=feature_request_data):
-                    add_feature_to_trail(trail_id)
-
-            # Remove features
-            if "remove" in features:
-                feature_request_data = {"feature_name": features["remove"]}
-                with app.test_request_context(json=feature_request_data):
-                    remove_feature_from_trail(trail_id)
+            try:
+                if "add" in features:
+                    changed_feature_ids += link_features(trail_id, feature_names_from(features["add"]))
+                if "remove" in features:
+                    changed_feature_ids += unlink_features(trail_id, feature_names_from(features["remove"]))
+            except FeatureNameError as err:
+                db.session.rollback()
+                return jsonify({"error": str(err)}), 400
 
         # Commit changes
-        db.session.commit()
-
-        # Api trail response
-        updated_trail = trail_schema.dump(trail)
-        updated_trail["features"] = [
-            {"feature_name": tf.feature.feature_name} for tf in trail.features
-        ]
+        commit_changes(trail_ids=[trail_id], feature_ids=changed_feature_ids)
 
-        return jsonify(updated_trail), 200
+        return jsonify(read_trail_document(trail_id)), 200
 
+    except IntegrityError:
+        # Another request took the new name after it was checked above
+        db.session.rollback()
+        return jsonify({"error": f"A trail with the name '{new_name}' already exists."}), 400
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
 
 # Delete an existing trail by ID, including removing links to features
 def delete_trail(trail_id):
 
-    user, error = check_permission("delete_trails")
-    if error:
-        return jsonify({"error": error["error"]}), error["status_code"]    
-    
     try:
         # Fetch the trail to delete
         trail = Trail.query.get(trail_id)
         if not trail:
             return jsonify({"error": f"Trail with ID {trail_id} not found."}), 404
 
+        # Remember the linked features so their change can be announced
+        feature_ids = [row.feature_id for row in db.session.query(TrailFeature.feature_id).filter_by(trail_id=trail_id)]
+
         # Delete all links to features in the TrailFeature table
         TrailFeature.query.filter_by(trail_id=trail_id).delete(synchronize_session=False)
 
         # Delete the trail itself
         db.session.delete(trail)
-        db.session.commit()
+        commit_changes(trail_ids=[trail_id], feature_ids=feature_ids)
 
         return jsonify({"message": f"Trail with ID {trail_id} and its feature links successfully deleted."}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
 
 # Add features to a trail
 def add_feature_to_trail(trail_id):
 
     try:
-        # Get the feature name(s) from the request
-        feature_data = request.json
-        feature_names = feature_data.get("feature_name")
-
-        # Ensure feature_names is a list for consistency incase only 1 is added
-        if isinstance(feature_names, str):
-            feature_names = [feature_names]
+        # Get the feature name(s) from the request; a single name or a list of names
+        try:
+            feature_names = feature_names_from(request.json.get("feature_name"))
+        except FeatureNameError as err:
+            return jsonify({"error": str(err)}), 400
         if not feature_names:
             return jsonify({"error": "Feature name or list of feature names is required."}), 400
 
-
-        # Iterate through feature names and link them
-        for feature_name in feature_names:
-            # Check if the feature exists
-            feature = Feature.query.filter_by(feature_name=feature_name).first()
-            if not feature:
-                # Create the feature if it doesn't exist
-                feature = Feature(feature_name=feature_name)
-                db.session.add(feature)
-                db.session.commit()
-
-            # Check if the feature is already linked to the trail
-            existing_link = TrailFeature.query.filter_by(trail_id=trail_id, feature_id=feature.feature_id).first()
-            if existing_link:
-                continue
-
-            # Link the feature to the trail
-            new_link = TrailFeature(trail_id=trail_id, feature_id=feature.feature_id)
-            db.session.add(new_link)
+        # Resolve every name at once and link only the features not linked yet
+        linked_feature_ids = link_features(trail_id, feature_names)
 
         # Commit all changes
-        db.session.commit()
+        commit_changes(trail_ids=[trail_id] if linked_feature_ids else [], feature_ids=linked_feature_ids)
 
         return jsonify({"message": f"Features successfully added to trail ID {trail_id}."}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
 
 # Remove features from a trail
 def remove_feature_from_trail(trail_id):
 
     try:
-        # Get the feature name(s) from the request
-        feature_data = request.json
-        feature_names = feature_data.get("feature_name")
-
+        # Get the feature name(s) from the request; a single name or a list of names
+        try:
+            feature_names = feature_names_from(request.json.get("feature_name"))
+        except FeatureNameError as err:
+            return jsonify({"error": str(err)}), 400
         if not feature_names:
             return jsonify({"error": "Feature name or list of feature names is required."}), 400
 
-        # Ensure feature_names is a list for consistency incase only 1 is added
-        if isinstance(feature_names, str):
-            feature_names = [feature_names]
-
-        # Iterate through feature names and unlink them
-        for feature_name in feature_names:
-            # Check if the feature exists
-            feature = Feature.query.filter_by(feature_name=feature_name).first()
-            if not feature:
-                continue
-
-            # Check if the feature is linked to the trail
-            trail_feature = TrailFeature.query.filter_by(trail_id=trail_id, feature_id=feature.feature_id).first()
-            if trail_feature:
-                db.session.delete(trail_feature)
+        # Unlink the named features that are linked; other names are ignored
+        unlinked_feature_ids = unlink_features(trail_id, feature_names)
 
         # Commit changes
-        db.session.commit()
+        commit_changes(trail_ids=[trail_id] if unlinked_feature_ids else [], feature_ids=unlinked_feature_ids)
 
         return jsonify({"message": f"Features successfully removed from trail ID {trail_id}."}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return server_error(e)
+
+# Replace all features of a trail in one transaction. An empty list removes every feature.
+def replace_trail_features(trail_id):
+
+    try:
+        try:
+            feature_names = feature_names_from(request.json.get("feature_name"))
+        except FeatureNameError as err:
+            return jsonify({"error": str(err)}), 400
+
+        if db.session.get(Trail, trail_id) is None:
+            return jsonify({"error": f"Trail with ID {trail_id} not found."}), 404
+
+        # Only the differences between the current and the requested features are written
+        changed_feature_ids = replace_features(trail_id, feature_names)
+
+        commit_changes(trail_ids=[trail_id] if changed_feature_ids else [], feature_ids=changed_feature_ids)
+
+        return jsonify({
+            "message": f"Features of trail ID {trail_id} successfully replaced.",
+            "features": [{"feature_name": feature_name} for feature_name in feature_names],
+        }), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return server_error(e)
@@ -0,0 +1,238 @@
+# validation.py
+#
+# Request and response validators for connexion, compiled once per operation when the API is
+# registered. connexion's own parameter validator builds a jsonschema validator for every
+# parameter of every request, and its response validator one for every response; these compile
+# each schema once, with fastjsonschema (which generates a Python function per schema) when it
+# is installed and a reused jsonschema validator otherwise.
+
+import functools
+import random
+from connexion.decorators.response import ResponseValidator
+from connexion.decorators.validation import ParameterValidator, RequestBodyValidator, TypeValidationError, coerce_type
+from connexion.exceptions import BadRequestProblem, NonConformingResponseBody, NonConformingResponseHeaders
+from connexion.json_schema import Draft4RequestValidator
+from connexion.utils import all_json, is_null, is_nullable
+from flask import current_app
+from werkzeug.wrappers import Response
+from jsonschema import ValidationError, draft4_format_checker
+import metrics
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# Values of the RESPONSE_VALIDATION setting
+RESPONSE_VALIDATION_MODES = ("off", "sampled", "full")
+
+# OpenAPI keywords that are not JSON Schema, or only document the value. default is dropped too:
+# fastjsonschema would write defaults into the validated data, which connexion never did.
+ANNOTATIONS = {
+    "example", "examples", "description", "deprecated", "readOnly", "writeOnly", "xml", "externalDocs",
+    "discriminator", "default",
+}
+
+# OpenAPI 3.0 schemas follow JSON Schema draft 4 (boolean exclusiveMinimum, ...)
+DRAFT4 = "http://json-schema.org/draft-04/schema#"
+
+# String formats fastjsonschema checks; OpenAPI's numeric formats (float, double, int32, ...) only document the value
+CHECKED_FORMATS = {"date", "date-time", "email", "hostname", "ipv4", "ipv6", "uri", "regex"}
+
+
+# A validation error. path is the dotted location of the offending value ("" for the whole document).
+class SchemaError(Exception):
+
+    def __init__(self, message, path=""):
+        super().__init__(message)
+        self.path = path
+
+
+# JSON Schema for an OpenAPI 3 schema: nullable becomes a null type and annotations are dropped
+def json_schema(schema):
+
+    if isinstance(schema, list):
+        return [json_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+
+    result = {}
+    for key, value in schema.items():
+        if key in ANNOTATIONS or key.startswith("x-") or key == "nullable":
+            continue
+        if key == "format" and value not in CHECKED_FORMATS:
+            continue
+        if key in ("properties", "patternProperties", "definitions"):
+            result[key] = {name: json_schema(item) for name, item in value.items()}
+        else:
+            result[key] = json_schema(value)
+
+    if schema.get("nullable") and "type" in result:
+        types = result["type"] if isinstance(result["type"], list) else [result["type"]]
+        result["type"] = types + ["null"]
+        if "enum" in result:
+            result["enum"] = result["enum"] + [None]
+    return result
+
+
+# A function validating data against schema, raising SchemaError with the first error found
+def compile_schema(schema):
+
+    if fastjsonschema is not None:
+        validate = fastjsonschema.compile(dict(json_schema(schema), **{"$schema": DRAFT4}))
+
+        def check(data):
+            try:
+                validate(data)
+            except fastjsonschema.JsonSchemaValueException as err:
+                raise SchemaError(err.message, ".".join(str(item) for item in err.path[1:])) from None
+
+        return check
+
+    validator = Draft4RequestValidator(schema, format_checker=draft4_format_checker)
+
+    def check(data):
+        try:
+            validator.validate(data)
+        except ValidationError as err:
+            path = ".".join(str(item) for item in err.path)
+            raise SchemaError(f"{err.message} - '{path}'" if path else err.message, path) from None
+
+    return check
+
+
+# Query, path, header and cookie parameters, each checked by its compiled schema
+class CompiledParameterValidator(ParameterValidator):
+
+    def __init__(self, parameters, api, strict_validation=False):
+        super().__init__(parameters, api, strict_validation)
+        self.compiled = {}
+        for location, location_parameters in self.parameters.items():
+            for param in location_parameters:
+                schema = dict(param.get("schema", param))
+                schema.pop("required", None)
+                if schema.get("type") != "file":
+                    self.compiled[(location, param["name"])] = compile_schema(schema)
+
+    def validate_parameter(self, parameter_type, value, param, param_name=None):
+        check = self.compiled.get((param["in"], param["name"]))
+        if check is None:
+            return super().validate_parameter(parameter_type, value, param, param_name)
+
+        if value is None:
+            return f"Missing {parameter_type} parameter '{param['name']}'" if param.get("required") else None
+        if is_nullable(param) and is_null(value):
+            return None
+        try:
+            check(coerce_type(param, value, parameter_type, param_name))
+        except TypeValidationError as err:
+            return str(err)
+        except SchemaError as err:
+            return str(err)
+        return None
+
+
+# JSON request bodies, checked by the operation's compiled schema. This is the only validation
+# pass a body goes through: handlers can build models from request.json directly.
+class CompiledRequestBodyValidator(RequestBodyValidator):
+
+    def __init__(self, schema, consumes, api, is_null_value_valid=False, validator=None, strict_validation=False):
+        super().__init__(schema, consumes, api, is_null_value_valid, validator, strict_validation)
+        self.check = compile_schema(schema)
+
+    def validate_schema(self, data, url):
+        if self.is_null_value_valid and is_null(data):
+            return None
+        try:
+            self.check(data)
+        except SchemaError as err:
+            raise BadRequestProblem(detail=str(err))
+        return None
+
+
+# Response bodies, checked against the compiled schema of their status code and content type.
+# Only a sample_rate share of responses is checked. A nonconforming response is counted
+# (response_validation_failures), then answered 500 when strict or logged otherwise. Streamed
+# responses are passed on unread, and bodies that are not JSON (NDJSON) are not checked.
+class SampledResponseValidator(ResponseValidator):
+
+    def __init__(self, operation, mimetype, validator=None, sample_rate=1.0, strict=True):
+        super().__init__(operation, mimetype, validator)
+        self.sample_rate = sample_rate
+        self.strict = strict
+        self.compiled = {}
+
+    def response_check(self, status_code, content_type):
+        key = (status_code, content_type)
+        if key not in self.compiled:
+            schema = self.operation.response_schema(status_code, content_type)
+            self.compiled[key] = compile_schema(schema) if self.is_json_schema_compatible(schema) else None
+        return self.compiled[key]
+
+    # connexion's wrapper reads a streamed body into memory before it skips validating it
+    def __call__(self, function):
+
+        @functools.wraps(function)
+        def wrapper(request):
+            response = function(request)
+            if isinstance(response, Response) and (response.is_streamed or response.direct_passthrough):
+                return response
+            connexion_response = self.operation.api.get_connexion_response(response, self.mimetype)
+            self.validate_response(
+                connexion_response.body, connexion_response.status_code, connexion_response.headers, request.url
+            )
+            return response
+
+        return wrapper
+
+    def validate_response(self, data, status_code, headers, url):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return True
+        content_type = headers.get("Content-Type", self.mimetype).rsplit(";", 1)[0]
+        if not all_json([content_type]):
+            return True
+
+        status_code = str(status_code)
+        check = self.response_check(status_code, content_type)
+        error = None
+        if check is not None and data:
+            try:
+                check(self.operation.json_loads(data))
+            except SchemaError as err:
+                error = NonConformingResponseBody(message=str(err))
+
+        definition = self.operation.response_definition(status_code, content_type) or {}
+        required = {name for name, header in definition.get("headers", {}).items() if header.get("required")}
+        missing = required - set(headers.keys())
+        if missing and error is None:
+            error = NonConformingResponseHeaders(message=f"Missing response headers: {', '.join(sorted(missing))}")
+
+        if error is not None:
+            metrics.inc("response_validation_failures", operation=self.operation.operation_id)
+            if self.strict:
+                raise error
+            current_app.logger.warning(f"{url}: response does not match the specification: {error.detail}")
+        return True
+
+
+# add_api options for the RESPONSE_VALIDATION and RESPONSE_VALIDATION_SAMPLE_RATE settings
+def api_options(config):
+
+    mode = config["RESPONSE_VALIDATION"]
+    if mode not in RESPONSE_VALIDATION_MODES:
+        raise ValueError(f"RESPONSE_VALIDATION must be one of {', '.join(RESPONSE_VALIDATION_MODES)}, not '{mode}'.")
+
+    if mode == "sampled":
+        response_validator = functools.partial(
+            SampledResponseValidator, sample_rate=config["RESPONSE_VALIDATION_SAMPLE_RATE"], strict=False
+        )
+    else:
+        response_validator = SampledResponseValidator
+    return {
+        "validate_responses": mode != "off",
+        "validator_map": {
+            "parameter": CompiledParameterValidator,
+            "body": CompiledRequestBodyValidator,
+            "response": response_validator,
+        },
+    }
@@ -0,0 +1,149 @@
+# versions.py
+
+import hashlib
+from flask import Response, request
+from sqlalchemy import bindparam, insert, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from config import db
+from models import Trail, ResourceVersion, utc_now
+from serializers import IN_CHUNK_SIZE
+from signals import notify_trails_changed, notify_features_changed
+
+# Collections whose change counters are bumped by the write paths
+TRAILS = "trails"
+FEATURES = "features"
+
+
+# Statement reading the change counters of the named collections
+def collection_versions_statement(names):
+
+    return (
+        select(ResourceVersion.name, ResourceVersion.version, ResourceVersion.updated_at)
+        .where(ResourceVersion.name.in_(names))
+    )
+
+
+# (version, updated_at) of each named collection from the rows of collection_versions_statement
+def versions_from_rows(rows, names):
+
+    found = {row.name: (row.version, row.updated_at) for row in rows}
+    return [found.get(name, (0, None)) for name in names]
+
+
+# Current (version, updated_at) of each named collection. One small query, no rows of the collection are read.
+def collection_versions(*names):
+
+    return versions_from_rows(db.session.execute(collection_versions_statement(names)).all(), names)
+
+
+def trail_version_statement(trail_id):
+
+    return select(Trail.version, Trail.updated_at).where(Trail.trail_id == trail_id)
+
+
+# Current (version, updated_at) of a single trail, or None if it does not exist
+def trail_version(trail_id):
+
+    row = db.session.execute(trail_version_statement(trail_id)).first()
+    return (row.version, row.updated_at) if row else None
+
+
+# Build a strong ETag and Last-Modified date from resource versions and the representation key
+def validators(versions, key=""):
+
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    etag = "-".join(str(version) for version, updated_at in versions) + "-" + digest
+    dates = [updated_at for version, updated_at in versions if updated_at is not None]
+    return etag, (max(dates) if dates else None)
+
+
+# Whether a client sending these conditional headers already holds the representation
+def is_fresh(etag, last_modified, if_none_match, if_modified_since):
+
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None)
+    return False
+
+
+# Return a 304 response when the client already holds the current representation, otherwise None
+def not_modified(etag, last_modified):
+
+    if not is_fresh(etag, last_modified, request.if_none_match, request.if_modified_since):
+        return None
+
+    response = Response(status=304)
+    return with_validators(response, etag, last_modified)
+
+
+# Attach ETag and Last-Modified headers to a response
+def with_validators(response, etag, last_modified):
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+# Statement adding one to the change counter of a collection, creating it on first use.
+# An upsert, so two writers creating the same counter at once do not collide.
+def version_upsert(dialect_name, name, now):
+
+    if dialect_name in ("sqlite", "postgresql"):
+        dialect_insert = sqlite.insert if dialect_name == "sqlite" else postgresql.insert
+        statement = dialect_insert(ResourceVersion).values(name=name, version=1, updated_at=now)
+        return statement.on_conflict_do_update(
+            index_elements=[ResourceVersion.name],
+            set_={"version": ResourceVersion.version + 1, "updated_at": statement.excluded.updated_at},
+        )
+    if dialect_name == "mssql":
+        # HOLDLOCK keeps the row range locked from the match to the insert
+        return text(
+            f"MERGE {ResourceVersion.__table__.fullname} WITH (HOLDLOCK) AS target "
+            "USING (SELECT :name AS name, :updated_at AS updated_at) AS source ON target.name = source.name "
+            "WHEN MATCHED THEN UPDATE SET version = target.version + 1, updated_at = source.updated_at "
+            "WHEN NOT MATCHED THEN INSERT (name, version, updated_at) VALUES (source.name, 1, source.updated_at);"
+        ).bindparams(bindparam("name", name), bindparam("updated_at", now, type_=ResourceVersion.updated_at.type))
+    return None
+
+
+# Bump the change counters of collections in the session's transaction
+def bump_collections(names, now):
+
+    dialect_name = db.engine.dialect.name
+    for name in names:
+        statement = version_upsert(dialect_name, name, now)
+        if statement is not None:
+            db.session.execute(statement)
+            continue
+        result = db.session.execute(
+            update(ResourceVersion)
+            .where(ResourceVersion.name == name)
+            .values(version=ResourceVersion.version + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            db.session.execute(insert(ResourceVersion).values(name=name, version=1, updated_at=now))
+
+
+# Commit the session's changes together with the version bumps of the trails and features they
+# touched, so that no reader sees the new data under an old ETag and a failed bump rolls the
+# write back, then announce the changes to the caches and indexes
+def commit_changes(trail_ids=(), feature_ids=()):
+
+    trail_ids = [trail_id for trail_id in trail_ids if trail_id is not None]
+    feature_ids = [feature_id for feature_id in feature_ids if feature_id is not None]
+    now = utc_now()
+
+    for start in range(0, len(trail_ids), IN_CHUNK_SIZE):
+        db.session.execute(
+            update(Trail)
+            .where(Trail.trail_id.in_(trail_ids[start:start + IN_CHUNK_SIZE]))
+            .values(version=Trail.version + 1, updated_at=now),
+            execution_options={"synchronize_session": False},
+        )
+    bump_collections(([TRAILS] if trail_ids else []) + ([FEATURES] if feature_ids else []), now)
+    db.session.commit()
+
+    notify_trails_changed(trail_ids)
+    notify_features_changed(feature_ids)
@@ -0,0 +1,9 @@
+# wsgi.py
+#
+# WSGI entry point for production servers:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:application
+
+from app import app
+
+application = app.app